@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""
+Dry-run cost estimator for the splitting pipeline
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import io
+import json
+import time
+import shutil
+import contextlib
+import numpy as np
+
+from raster_util import read_label_window, read_raster_list_info, read_raster_list_window, open_raster_list
+from memory_planner import MemoryPlanner, format_memory_size
+from grid.grid_label_slice import GridLabelSlice
+
+# .npy文件头字节数（np.save写出的小数组）
+NPY_HEADER_BYTES = 128
+# 集中存储中每个切片名称'{r_s}_{r_e}_{c_s}_{c_e}'的字节数（<U23）
+GRID_KEY_BYTES = 4 * 23
+
+# 默认吞吐量，calibrate_throughput()可在目标机器上实测并保存
+DEFAULT_THROUGHPUT = {
+    'read_mbs': 150.0,        # GDAL窗口读取源栅格，MB/s
+    'write_mbs': 200.0,       # 写出切片数据，MB/s
+    'files_per_s': 1500.0,    # 每秒创建的切片文件数
+    'slices_per_s': 4000.0,   # 每秒生成的分层切片数
+}
+
+
+class _NullWriter(object):
+    """
+    丢弃写入的切片，只用于计时分层切片。
+    """
+    def write(self, name, array):
+        pass
+
+
+def calibrate_throughput(temp_folder, patch_size=32, num_band=60, num_files=2000, raster_path=None, read_strips=16):
+    """
+    在临时目录中实测写出吞吐量、建文件速率与分层切片速率；给出raster_path时按条带窗口读取该栅格实测读取速率，
+    否则读取速率沿用默认值或已保存值。
+    :param temp_folder: 临时目录，应与结果目录位于同一存储
+    :param patch_size:
+    :param num_band:
+    :param num_files: 测试切片数
+    :param raster_path: 用于实测读取速率的源栅格（如raster_list中的一个）
+    :param read_strips: 读取的条带数（每条为一行切片）
+    :return: dict
+    """
+    print('### Calibrating throughput on {}'.format(temp_folder))
+    bench_folder = os.path.join(temp_folder, 'throughput_bench')
+    if not os.path.exists(bench_folder):
+        os.makedirs(bench_folder)
+    throughput = load_throughput(temp_folder)
+
+    # large patches: bytes per second
+    raster_patch = np.random.randint(0, 10000, (num_band, patch_size, patch_size)).astype(np.uint16)
+    time_start = time.time()
+    for ii in range(num_files // 10):
+        np.save(os.path.join(bench_folder, 'raster_{}.npy'.format(ii)), raster_patch)
+    throughput['write_mbs'] = raster_patch.nbytes * (num_files // 10) / 1e6 / max(time.time() - time_start, 1e-9)
+
+    # small patches: files per second
+    label_patch = np.random.randint(0, 2, (patch_size, patch_size)).astype(np.uint8)
+    time_start = time.time()
+    for ii in range(num_files):
+        np.save(os.path.join(bench_folder, 'label_{}.npy'.format(ii)), label_patch)
+    throughput['files_per_s'] = num_files / max(time.time() - time_start, 1e-9)
+
+    # per-class slicing of multi-class label patches with GridLabelSlice, without writing
+    class_patch = np.random.randint(0, 8, (patch_size, patch_size)).astype(np.uint8)
+    num_slices = int(np.count_nonzero(np.bincount(class_patch.ravel())[1:]))
+    null_writer = _NullWriter()
+    time_start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for ii in range(num_files):
+            GridLabelSlice._slice_label(class_patch, 0.0, 'grid_{}'.format(ii), bench_folder, null_writer)
+    throughput['slices_per_s'] = num_slices * num_files / max(time.time() - time_start, 1e-9)
+
+    # windowed strip reads of a source raster, spread over its rows
+    if raster_path is not None:
+        info_list = open_raster_list(read_raster_list_info([raster_path]))
+        rows, cols = info_list[0]['rows'], info_list[0]['cols']
+        strip_rows = np.unique(np.linspace(0, max(0, rows - patch_size), read_strips).astype(np.int64))
+        strip_data = None
+        time_start = time.time()
+        for row_start in strip_rows:
+            strip_data = read_raster_list_window(info_list, 0, int(row_start), cols, min(patch_size, rows),
+                                                 buf_obj=strip_data, native_dtype=True)
+        throughput['read_mbs'] = strip_data.nbytes * strip_rows.size / 1e6 / max(time.time() - time_start, 1e-9)
+
+    shutil.rmtree(bench_folder, ignore_errors=True)
+    save_throughput(temp_folder, throughput)
+    return throughput
+
+
+def save_throughput(temp_folder, throughput):
+    with open(os.path.join(temp_folder, 'throughput.json'), 'w') as f:
+        json.dump(throughput, f, indent=2)
+
+
+def load_throughput(temp_folder):
+    """
+    读取已保存的实测吞吐量，没有则为默认值。
+    :param temp_folder:
+    :return: dict
+    """
+    throughput = dict(DEFAULT_THROUGHPUT)
+    throughput_path = os.path.join(temp_folder, 'throughput.json') if temp_folder else None
+    if throughput_path and os.path.exists(throughput_path):
+        with open(throughput_path, 'r') as f:
+            throughput.update(json.load(f))
+    return throughput
+
+
+class CostEstimator(object):
+    """
+    划分流程的试运行估算。
+    只读取栅格与标记的元数据，并抽样读取若干条标记条带统计切片内的类别直方图，估算切片数、有标记的切片数、
+    每类分层切片数、各阶段输出字节数与文件数、内存峰值（见MemoryPlanner）以及耗时（按实测吞吐量）。
+    """
+    def __init__(self, raster_list, label_path, patch_size=32, min_pixel_percent=0.01, memory_budget='8GB',
+                 temp_folder=None, sample_strips=64, workers=1, incremental=False):
+        """
+        初始化
+        :param raster_list: 栅格数据列表
+        :param label_path: 标记栅格（类别或地块栅格）
+        :param patch_size: 切片大小
+        :param min_pixel_percent: 分层时类别像元比例阈值
+        :param memory_budget: 内存预算
+        :param temp_folder: 临时目录，其中的throughput.json为实测吞吐量
+        :param sample_strips: 抽样的标记条带数（每条为一行切片）
+        :param workers: 并行进程数（见MemoryPlanner）
+        :param incremental: 是否增量更新（栅格划分为RasterGroupAccumulate）
+        """
+        self.patch_size = patch_size
+        self.min_pixel_percent = min_pixel_percent
+        self.sample_strips = sample_strips
+        self.incremental = incremental
+        self.throughput = load_throughput(temp_folder)
+
+        self.planner = MemoryPlanner(raster_list, label_path, patch_size, memory_budget, workers=workers)
+        self.estimate = None
+
+    def prepare_data(self):
+        self.planner.prepare_data()
+        self.planner.make_plan()
+
+    def sample_label_histogram(self):
+        """
+        均匀抽样若干条带，统计每个切片各标记值的像元数。以(标记值, 切片列号)为键计数，适用于类别与地块ID栅格。
+        :return: (抽样切片数, 有标记的切片数, {标记值: 分层切片数})
+        """
+        label_info = self.planner.label_info
+        rows_patch = label_info['rows'] // self.patch_size
+        cols_patch = label_info['cols'] // self.patch_size
+        strip_cols = cols_patch * self.patch_size
+        patch_size2 = self.patch_size * self.patch_size
+
+        sample_rows = np.unique(np.linspace(0, rows_patch - 1, min(self.sample_strips, rows_patch)).astype(np.int64))
+        grid_col = np.arange(strip_cols, dtype=np.int64) // self.patch_size
+
+        num_labelled = 0
+        slice_counts = {}
+        strip_data = None
+        for rr in sample_rows:
+            strip_data = read_label_window(self.planner.label_path, 0, rr * self.patch_size, strip_cols,
+                                           self.patch_size, buf_obj=strip_data)
+            strip_keys = strip_data.astype(np.int64) * cols_patch + grid_col[np.newaxis, :]
+            keys, counts = np.unique(strip_keys, return_counts=True)
+            values, cols = keys // cols_patch, keys % cols_patch
+
+            labelled = values != 0
+            num_labelled += np.unique(cols[labelled]).size
+            sliced = labelled & (counts / patch_size2 > self.min_pixel_percent)
+            for vv, num in zip(*np.unique(values[sliced], return_counts=True)):
+                slice_counts[int(vv)] = slice_counts.get(int(vv), 0) + int(num)
+        # for
+
+        return sample_rows.size * cols_patch, num_labelled, slice_counts
+
+    def estimate_cost(self):
+        """
+        估算各项代价。
+        :return: dict
+        """
+        plan = self.planner.plan
+        first_info = self.planner.raster_info_list[0]
+        label_info = self.planner.label_info
+        patch_size2 = self.patch_size * self.patch_size
+        num_grid = (first_info['rows'] // self.patch_size) * (first_info['cols'] // self.patch_size)
+
+        num_sampled, num_labelled, slice_counts = self.sample_label_histogram()
+        scale = num_grid / max(1, num_sampled)
+        labelled_grid = int(round(num_labelled * scale))
+        class_slices = {vv: int(round(num * scale)) for vv, num in slice_counts.items()}
+        num_slices = sum(class_slices.values())
+
+        label_itemsize = label_info['dtype'].itemsize
+        raster_grid_bytes = plan['num_band'] * patch_size2 * plan['itemsize']
+        label_grid_bytes = patch_size2 * label_itemsize
+        # the stages run by split_train_dataset.py: the label split, then the raster split chosen from the plan
+        stages = {'label_split': {'files': num_grid, 'bytes': num_grid * (label_grid_bytes + NPY_HEADER_BYTES)}}
+        if self.incremental or plan['group_size'] < plan['num_dates']:
+            # RasterGroupAccumulate as a store: one (N, C, P, P) part file and its grid names
+            stages['raster_accumulate'] = {'files': 2, 'bytes': num_grid * (raster_grid_bytes + GRID_KEY_BYTES) +
+                                                                2 * NPY_HEADER_BYTES}
+        else:
+            stages['raster_split'] = {'files': num_grid, 'bytes': num_grid * (raster_grid_bytes + NPY_HEADER_BYTES)}
+        source_bytes = sum(info['bands'] * info['rows'] * info['cols'] * info['dtype'].itemsize
+                           for info in self.planner.raster_info_list)
+        source_bytes += label_info['rows'] * label_info['cols'] * label_itemsize
+
+        throughput = self.throughput
+        output_bytes = sum(stage['bytes'] for stage in stages.values())
+        output_files = sum(stage['files'] for stage in stages.values())
+        seconds = (source_bytes / 1e6 / throughput['read_mbs'] + output_bytes / 1e6 / throughput['write_mbs'] +
+                   output_files / throughput['files_per_s'])
+        # the slicing stages are run separately, their cost is reported outside the totals
+        slice_bytes = num_slices * (label_grid_bytes + NPY_HEADER_BYTES)
+        slice_seconds = (slice_bytes / 1e6 / throughput['write_mbs'] + num_slices / throughput['files_per_s'] +
+                         num_slices / throughput['slices_per_s'])
+
+        self.estimate = {
+            'grid_count': num_grid, 'labelled_grid_count': labelled_grid, 'slice_count': num_slices,
+            'class_slices': class_slices, 'slice_bytes': slice_bytes, 'slice_hours': slice_seconds / 3600,
+            'stages': stages, 'source_bytes': source_bytes,
+            'output_bytes': output_bytes, 'output_files': output_files,
+            # the label and raster stages run one after the other
+            'peak_bytes': max(plan['raster_peak'], plan.get('label_peak', 0)), 'hours': seconds / 3600,
+        }
+        return self.estimate
+
+    def report(self, max_classes=50):
+        """
+        打印估算结果。
+        :param max_classes: 标记值（类别）数不超过该值时逐类列出分层切片数，地块ID栅格则只给出总数
+        :return:
+        """
+        estimate = self.estimate if self.estimate is not None else self.estimate_cost()
+
+        print('### Dry run estimate')
+        print(f'Grids: {estimate["grid_count"]}, labelled grids: {estimate["labelled_grid_count"]}')
+        for name, stage in estimate['stages'].items():
+            print('Stage {:<14s} {:>10d} files {:>10s}'.format(name, stage['files'], format_memory_size(stage['bytes'])))
+        print('Source read: {}, output: {} in {} files'.format(format_memory_size(estimate['source_bytes']),
+                                                               format_memory_size(estimate['output_bytes']),
+                                                               estimate['output_files']))
+        print('Peak RAM: {}'.format(format_memory_size(estimate['peak_bytes'])))
+        print('Time: {:.2f} hours ({:.0f} min), throughput {}'.format(estimate['hours'], estimate['hours'] * 60,
+                                                                      self.throughput))
+        print('Slicing (run separately, not in the totals above): {} slices over {} label values, {}, {:.2f} hours'
+              .format(estimate['slice_count'], len(estimate['class_slices']),
+                      format_memory_size(estimate['slice_bytes']), estimate['slice_hours']))
+        if len(estimate['class_slices']) <= max_classes:
+            for vv, num in sorted(estimate['class_slices'].items()):
+                print(f'  class {vv:>4d}: {num} slices')
+        return estimate
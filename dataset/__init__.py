@@ -0,0 +1,10 @@
+# -*- utf-8 -*-
+# @Time: 2022/9/27 22:02
+# @Author:
+# @File:
+# @Software: PyCharm
+
+# export
+from .slice_dataset import SliceDataset
+from .pixel_set import PixelSetExport, PixelSetStore, PixelSetDataset
+from .parcel_statistics import ParcelStatistics
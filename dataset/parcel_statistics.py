@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-parcel temporal statistics over the stacked rasters
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+from tqdm import tqdm
+
+from raster_util import read_raster_list_info, read_raster_list_window, read_label_window, open_raster_list
+from pre.parcel_pixel_index import ParcelPixelIndex
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = None
+
+
+def grouped_percentiles(values, group_index, num_groups, percentiles):
+    """
+    分组百分位数（线性插值，与np.nanpercentile相同）。
+    每个通道一次排序：各组的值加上组序号*跨度后整体排序，即得到按组、组内按值排列的结果；NaN排在各组末尾且不计入。
+    :param values: (C, N)
+    :param group_index: (N,)，各像元的组序号（0...num_groups-1）
+    :param num_groups:
+    :param percentiles: 百分位数列表（0-100）
+    :return: (len(percentiles), C, num_groups)，无有效值的组为NaN
+    """
+    num_channels = values.shape[0]
+    result = np.full((len(percentiles), num_channels, num_groups), np.nan, dtype=np.float64)
+    if values.shape[1] == 0:
+        return result
+
+    order = np.argsort(group_index, kind='stable')
+    group_index = group_index[order]
+    values = values[:, order].astype(np.float64)
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return result
+
+    value_min, value_max = np.nanmin(values), np.nanmax(values)
+    span = (value_max - value_min) + 2.0
+    # invalid values go after every valid value of their group
+    group_offset = group_index * span
+    shifted = np.where(valid, values - value_min, span - 1.0) + group_offset[np.newaxis, :]
+    shifted.sort(axis=1)
+
+    group_counts = np.bincount(group_index, minlength=num_groups)
+    group_starts = np.concatenate([[0], np.cumsum(group_counts)[:-1]])
+    valid_counts = np.stack([np.bincount(group_index, weights=valid[cc], minlength=num_groups)
+                             for cc in range(num_channels)], axis=0)
+    has_valid = valid_counts > 0
+
+    for qq, percentile in enumerate(percentiles):
+        position = group_starts[np.newaxis, :] + percentile / 100.0 * np.maximum(valid_counts - 1, 0)
+        # groups without valid values (empty trailing groups start past the end) are masked below
+        position = np.minimum(position, values.shape[1] - 1)
+        lower, upper = np.floor(position).astype(np.int64), np.ceil(position).astype(np.int64)
+        lower_value = np.take_along_axis(shifted, lower, axis=1)
+        upper_value = np.take_along_axis(shifted, upper, axis=1)
+        percentile_value = lower_value + (position - lower) * (upper_value - lower_value)
+        percentile_value -= np.arange(num_groups)[np.newaxis, :] * span - value_min
+        result[qq] = np.where(has_valid, percentile_value, np.nan)
+    return result
+
+
+class ParcelStatistics(object):
+    """
+    地块时序统计量。
+    按条带流式读取堆叠的时序栅格与地块ID栅格（RSTIZE_ID），对每个地块、每个时相与波段累计像元数、均值、方差、最小值与最大值：
+    条带内以np.unique/np.bincount分组求和，条带间以Welford（Chan）公式合并均值与二阶中心矩；最小/最大值为排序后的fmin/fmax.reduceat。
+    地块像元索引（ParcelPixelIndex，过期时重建）给出有像元的地块，累计数组按其紧凑行号分配(C, 地块数)，与地块ID的取值范围无关；
+    百分位数需要地块的全部像元：由索引得到每个地块的最后一行，地块像元缓存至其最后一行读完后一次计算。
+    nodata（NaN）不计入统计。结果为地块×特征表，写出为Parquet（需pyarrow）或NPZ。
+    """
+    def __init__(self, raster_list, parcel_path, result_path, block_rows=64, percentiles=(10, 25, 50, 75, 90)):
+        """
+        初始化
+        :param raster_list: 栅格数据列表（全部时相）
+        :param parcel_path: 地块ID栅格（RSTIZE_ID，0为背景）
+        :param result_path: 结果文件，'.parquet'或'.npz'
+        :param block_rows: 每个条带的行数，内存占用约为T*B*block_rows*W*4字节
+        :param percentiles: 百分位数，None或空则不计算
+        """
+        self.raster_path_list = raster_list
+        self.parcel_path = parcel_path
+        self.result_path = result_path
+        self.block_rows = block_rows
+        self.percentiles = list(percentiles) if percentiles else []
+
+        self.info_list = None
+        self.rows, self.cols = 0, 0
+        self.num_band, self.date_bands = 0, 0
+        self.pixel_index = None
+        self.parcel_ids = None
+        self.parcel_last_row = None
+
+        self.pixel_count = None
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.percentile_values = None
+
+    def prepare_data(self):
+        """
+        读取元数据与地块像元索引（不存在或过期时重建），按有像元的地块分配累计数组。
+        :return:
+        """
+        self.info_list = read_raster_list_info(self.raster_path_list)
+        self.rows, self.cols = self.info_list[0]['rows'], self.info_list[0]['cols']
+        self.num_band = sum(info['bands'] for info in self.info_list)
+        self.date_bands = self.info_list[0]['bands']
+
+        self.pixel_index = ParcelPixelIndex.open(self.parcel_path)
+        assert ((self.pixel_index.rows, self.pixel_index.cols) == (self.rows, self.cols))
+        self.parcel_ids = self.pixel_index.parcel_ids()
+        num_parcels = self.parcel_ids.size
+
+        self.pixel_count = np.zeros(num_parcels, dtype=np.int64)
+        self.count = np.zeros((self.num_band, num_parcels), dtype=np.int64)
+        self.mean = np.zeros((self.num_band, num_parcels), dtype=np.float64)
+        self.m2 = np.zeros((self.num_band, num_parcels), dtype=np.float64)
+        self.min = np.full((self.num_band, num_parcels), np.nan, dtype=np.float32)
+        self.max = np.full((self.num_band, num_parcels), np.nan, dtype=np.float32)
+
+        if self.percentiles:
+            self.percentile_values = np.full((len(self.percentiles), self.num_band, num_parcels), np.nan,
+                                             dtype=np.float32)
+            # parcel pixels are sorted, so the last one is on the last row
+            indptr = self.pixel_index.indptr
+            self.parcel_last_row = self.pixel_index.indices[indptr[self.parcel_ids + 1] - 1] // self.cols
+
+    def _parcel_rows(self, parcel_ids):
+        """
+        地块ID对应的累计数组行号。
+        :param parcel_ids: 有序、不重复的地块ID
+        :return:
+        """
+        parcel_rows = np.searchsorted(self.parcel_ids, parcel_ids)
+        assert (parcel_rows[-1] < self.parcel_ids.size and np.array_equal(self.parcel_ids[parcel_rows], parcel_ids)), \
+            'parcel IDs missing from the parcel pixel index of {}'.format(self.parcel_path)
+        return parcel_rows
+
+    def _accumulate_block(self, block_ids, block_values):
+        """
+        一个条带的分组统计，并与已有结果合并（Chan等的并行Welford公式）。
+        :param block_ids: (N,)地块ID
+        :param block_values: (C, N)
+        :return:
+        """
+        parcel_ids, group_index = np.unique(block_ids, return_inverse=True)
+        num_groups = parcel_ids.size
+        parcel_rows = self._parcel_rows(parcel_ids)
+        self.pixel_count[parcel_rows] += np.bincount(group_index, minlength=num_groups)
+
+        order = np.argsort(group_index, kind='stable')
+        group_starts = np.searchsorted(group_index[order], np.arange(num_groups))
+        for cc in range(self.num_band):
+            values = block_values[cc]
+            valid = ~np.isnan(values)
+            count_b = np.bincount(group_index, weights=valid, minlength=num_groups)
+            sum_b = np.bincount(group_index, weights=np.where(valid, values, 0), minlength=num_groups)
+            mean_b = np.divide(sum_b, count_b, out=np.zeros(num_groups), where=count_b > 0)
+            deviation = np.where(valid, values - mean_b[group_index], 0)
+            m2_b = np.bincount(group_index, weights=deviation * deviation, minlength=num_groups)
+
+            count_a, mean_a = self.count[cc, parcel_rows], self.mean[cc, parcel_rows]
+            count = count_a + count_b
+            delta = mean_b - mean_a
+            safe_count = np.maximum(count, 1)
+            self.mean[cc, parcel_rows] = mean_a + delta * count_b / safe_count
+            self.m2[cc, parcel_rows] += m2_b + delta * delta * count_a * count_b / safe_count
+            self.count[cc, parcel_rows] = count
+
+            # fmin/fmax ignore NaN, a group without valid values stays NaN
+            sorted_values = values[order]
+            min_b, max_b = np.fmin.reduceat(sorted_values, group_starts), np.fmax.reduceat(sorted_values, group_starts)
+            self.min[cc, parcel_rows] = np.fmin(self.min[cc, parcel_rows], min_b)
+            self.max[cc, parcel_rows] = np.fmax(self.max[cc, parcel_rows], max_b)
+        # for
+
+    def _close_parcels(self, pending, next_row):
+        """
+        计算最后一行已读完的地块的百分位数，其余像元继续缓存。
+        :param pending: [(rows, values), ...]缓存的像元，rows为累计数组行号
+        :param next_row: 下一个条带的起始行
+        :return: 仍需缓存的像元
+        """
+        if not pending:
+            return pending
+        pending_rows = np.concatenate([rows for rows, _ in pending])
+        pending_values = np.concatenate([values for _, values in pending], axis=1)
+        closing = self.parcel_last_row[pending_rows] < next_row
+        if not closing.any():
+            return [(pending_rows, pending_values)]
+
+        parcel_rows, group_index = np.unique(pending_rows[closing], return_inverse=True)
+        self.percentile_values[:, :, parcel_rows] = grouped_percentiles(pending_values[:, closing], group_index,
+                                                                        parcel_rows.size, self.percentiles)
+        if closing.all():
+            return []
+        return [(pending_rows[~closing], pending_values[:, ~closing])]
+
+    def compute_statistics(self):
+        """
+        流式计算统计量。
+        :return:
+        """
+        print('### Computing parcel statistics...')
+
+        pending = []
+        block_data, parcel_block = None, None
+        opened_info_list = open_raster_list(self.info_list)
+        for row_start in tqdm(range(0, self.rows, self.block_rows), desc='Parcel statistics ...'):
+            num_rows = min(self.block_rows, self.rows - row_start)
+            if block_data is not None and block_data.shape[1] != num_rows:
+                block_data, parcel_block = None, None
+            block_data = read_raster_list_window(opened_info_list, 0, row_start, self.cols, num_rows, buf_obj=block_data)
+            parcel_block = read_label_window(self.parcel_path, 0, row_start, self.cols, num_rows, buf_obj=parcel_block)
+
+            pixel_index = np.flatnonzero(parcel_block)
+            if pixel_index.size > 0:
+                block_ids = parcel_block.ravel()[pixel_index].astype(np.int64)
+                block_values = block_data.reshape(self.num_band, -1)[:, pixel_index]
+                self._accumulate_block(block_ids, block_values)
+                if self.percentiles:
+                    block_rows = np.searchsorted(self.parcel_ids, block_ids)
+                    pending.append((block_rows, block_values.astype(np.float32, copy=False)))
+            if self.percentiles:
+                pending = self._close_parcels(pending, row_start + num_rows)
+        # for
+
+        # every parcel must have been read in full, as the index says
+        assert (not pending)
+        assert np.array_equal(self.pixel_count, np.diff(self.pixel_index.indptr)[self.parcel_ids]), \
+            'parcel pixel counts differ from the parcel pixel index of {}'.format(self.parcel_path)
+
+        print(f'{self.parcel_ids.size} parcels')
+        return self.count
+
+    def feature_table(self):
+        """
+        地块×特征表。特征名为'{统计量}_t{时相}_b{波段}'，标准差为总体标准差，无有效像元时为NaN。
+        :return: (parcel_id, pixel_count, feature_names, features)
+        """
+        count = self.count
+        stat_list = [
+            ('mean', np.where(count > 0, self.mean, np.nan)),
+            ('std', np.sqrt(np.divide(self.m2, count, out=np.full(count.shape, np.nan), where=count > 0))),
+            ('min', self.min),
+            ('max', self.max),
+        ]
+        for qq, percentile in enumerate(self.percentiles):
+            stat_list.append(('p{:0>2d}'.format(int(percentile)), self.percentile_values[qq]))
+
+        channel_names = ['t{:0>2d}_b{:0>2d}'.format(cc // self.date_bands, cc % self.date_bands)
+                         for cc in range(self.num_band)]
+        feature_names = ['{}_{}'.format(stat, name) for stat, _ in stat_list for name in channel_names]
+        features = np.concatenate([values.T.astype(np.float32) for _, values in stat_list], axis=1)
+        return self.parcel_ids, self.pixel_count, feature_names, features
+
+    def save(self):
+        """
+        写出特征表：'.parquet'且安装了pyarrow时为Parquet，否则为NPZ。
+        :return: 结果文件路径
+        """
+        parcel_ids, pixel_count, feature_names, features = self.feature_table()
+        parent_dir = os.path.dirname(self.result_path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+
+        result_path = self.result_path
+        if result_path.endswith('.parquet') and pyarrow is None:
+            print('### WARNING: pyarrow is not installed, writing NPZ instead of Parquet')
+            result_path = os.path.splitext(result_path)[0] + '.npz'
+
+        temp_path = result_path + '.tmp'
+        if result_path.endswith('.parquet'):
+            columns = {'parcel_id': parcel_ids, 'pixel_count': pixel_count}
+            columns.update((name, features[:, ff]) for ff, name in enumerate(feature_names))
+            pyarrow_parquet.write_table(pyarrow.table(columns), temp_path)
+        else:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, parcel_id=parcel_ids, pixel_count=pixel_count, feature_names=np.array(feature_names),
+                         features=features)
+        os.replace(temp_path, result_path)
+
+        print(f'### Parcel statistics of {parcel_ids.size} parcels, {len(feature_names)} features saved on {result_path}')
+        return result_path
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    parcel_path = r'G:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\polygon\parcel_dirong_maincrop_removesmall_utm_polygon.tif'
+    result_path = r'G:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\parcel_statistics.parquet'
+    raster_list = [
+        r'G:\FF\application_dataset\2020-france-agri\s2_l2a_tif_masked\10m\L1C_T31TFN_20190103_masked_10m.tif',
+    ]
+
+    #######################################################
+    # do
+    pst = ParcelStatistics(raster_list, parcel_path, result_path, block_rows=64)
+    pst.prepare_data()
+    pst.compute_statistics()
+    pst.save()
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pixel-set export of whole parcels for parcel-based classifiers
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import glob
+import numpy as np
+from tqdm import tqdm
+
+from raster_util import read_raster_info, read_raster_list_info, read_raster_list, read_label_data
+
+try:
+    import torch
+    from torch.utils.data import Dataset
+except ImportError:
+    torch = None
+    Dataset = object
+
+
+class PixelSetExport(object):
+    """
+    像元集导出。
+    以read_raster_list()读入的(T*B, H, W)时序栅格与read_label_data()读入的地块ID栅格为输入，对全部地块像元按地块ID做一次稳定排序
+    （地块内像元按位置顺序），可选地每个地块随机保留不超过sample_pixels个像元，
+    将每个地块的像元连续写为(N, T, B)数组：一个或若干分片文件'pixels_{seq:0>5d}.npy'（地块不跨分片，可内存映射），
+    以及地块表'parcels.npz'（parcel_id, label, shard, start, count，及每个像元在栅格中的展平位置position）。
+    默认为float32，nodata为NaN；保持源数据类型时另写出同形状的nodata掩膜分片'masks_{seq:0>5d}.npy'。
+    代替按切片写出的大量补零的32*32掩膜副本。
+    """
+    def __init__(self, raster_list, parcel_path, result_folder, label_path=None, sample_pixels=None,
+                 shard_pixels=None, native_dtype=False, seed=0):
+        """
+        初始化
+        :param raster_list: 栅格数据列表（全部时相）
+        :param parcel_path: 地块ID栅格（RSTIZE_ID，0为背景）
+        :param result_folder: 结果目录
+        :param label_path: 类别栅格，地块类别为其像元的众数；None则类别为0
+        :param sample_pixels: 每个地块最多保留的像元数，None则全部保留
+        :param shard_pixels: 每个分片文件的最大像元数，None则只有一个分片；像元数超过该值的地块单独成为一个分片
+        :param native_dtype: 是否保持源数据类型（如UInt16），此时nodata保持原值并另写出掩膜
+        :param seed: 像元抽样的随机种子
+        """
+        self.raster_path_list = raster_list
+        self.parcel_path = parcel_path
+        self.result_folder = result_folder
+        self.label_path = label_path
+        self.sample_pixels = sample_pixels
+        self.shard_pixels = shard_pixels
+        self.native_dtype = native_dtype
+        self.seed = seed
+
+        self.raster_data = None
+        self.parcel_data = None
+        self.label_data = None
+        self.date_bands = 0
+        self.channel_nodata = None
+
+    def prepare_data(self):
+        self.raster_data = read_raster_list(self.raster_path_list, native_dtype=self.native_dtype)
+        self.date_bands = read_raster_info(self.raster_path_list[0])['bands']
+        if self.native_dtype:
+            # nodata of every channel, compared per chunk instead of keeping a full-size mask
+            info_list = read_raster_list_info(self.raster_path_list)
+            self.channel_nodata = [info['nodata'] for info in info_list for _ in range(info['bands'])]
+        self.parcel_data = read_label_data(self.parcel_path)
+        if self.label_path is not None:
+            self.label_data = read_label_data(self.label_path)
+        assert (self.parcel_data.shape == self.raster_data.shape[1:])
+
+    def group_parcel_pixels(self):
+        """
+        按地块ID对全部地块像元做一次稳定排序，并按sample_pixels抽样。
+        :return: (像元序号, 地块ID, 每个地块在像元序号中的起点, 像元数)
+        """
+        parcel_flat = self.parcel_data.ravel()
+        pixel_index = np.flatnonzero(parcel_flat)
+        pixel_index = pixel_index[np.argsort(parcel_flat[pixel_index], kind='stable')]
+        parcel_ids, parcel_starts, parcel_counts = np.unique(parcel_flat[pixel_index], return_index=True,
+                                                             return_counts=True)
+
+        if self.sample_pixels is not None:
+            # a random order within every parcel, keep the first sample_pixels, then restore the pixel order
+            rng = np.random.default_rng(self.seed)
+            pixel_parcel = np.repeat(np.arange(parcel_ids.size), parcel_counts)
+            random_order = np.lexsort((rng.random(pixel_index.size), pixel_parcel))
+            rank = np.arange(pixel_index.size) - np.repeat(parcel_starts, parcel_counts)
+            pixel_index = pixel_index[np.sort(random_order[rank < self.sample_pixels])]
+            parcel_counts = np.minimum(parcel_counts, self.sample_pixels)
+            parcel_starts = np.concatenate([[0], np.cumsum(parcel_counts)[:-1]]).astype(np.int64)
+
+        print(f'{parcel_ids.size} parcels, {pixel_index.size} pixels')
+        return pixel_index, parcel_ids, parcel_starts, parcel_counts
+
+    def parcel_labels(self, parcel_ids):
+        """
+        地块类别：地块全部像元的类别众数。
+        :param parcel_ids: 有序的地块ID
+        :return:
+        """
+        if self.label_data is None:
+            return np.zeros(parcel_ids.size, dtype=np.int64)
+
+        parcel_flat = self.parcel_data.ravel()
+        pixel_index = np.flatnonzero(parcel_flat)
+        num_classes = int(self.label_data.max()) + 1
+        pair_keys = parcel_flat[pixel_index].astype(np.int64) * num_classes + self.label_data.ravel()[pixel_index]
+        pair_unique, pair_counts = np.unique(pair_keys, return_counts=True)
+        pair_parcel, pair_class = pair_unique // num_classes, pair_unique % num_classes
+
+        # last pair of every parcel after sorting by (parcel, count) is the most frequent class
+        order = np.lexsort((pair_counts, pair_parcel))
+        last = np.append(pair_parcel[order][1:] != pair_parcel[order][:-1], True)
+        majority = dict(zip(pair_parcel[order][last].tolist(), pair_class[order][last].tolist()))
+        return np.array([majority[int(pp)] for pp in parcel_ids], dtype=np.int64)
+
+    @staticmethod
+    def shard_bounds(parcel_starts, parcel_counts, shard_pixels):
+        """
+        按地块顺序贪心划分分片：下一个地块的终点超出shard_pixels时关闭当前分片，地块不跨分片。
+        :param parcel_starts: 各地块在像元序列中的起点
+        :param parcel_counts: 各地块像元数
+        :param shard_pixels: 每个分片的最大像元数，None则只有一个分片
+        :return: 各分片的起始地块序号，末尾为地块总数
+        """
+        num_parcels = parcel_counts.size
+        if not shard_pixels:
+            return np.array([0, num_parcels], dtype=np.int64)
+
+        parcel_ends = parcel_starts + parcel_counts
+        shard_first = [0]
+        while shard_first[-1] < num_parcels:
+            first = shard_first[-1]
+            last = np.searchsorted(parcel_ends, parcel_starts[first] + shard_pixels, side='right')
+            shard_first.append(max(int(last), first + 1))
+        # while
+        return np.array(shard_first, dtype=np.int64)
+
+    def export_pixel_set(self, chunk_pixels=1024 * 1024):
+        """
+        写出分片文件与地块表。
+        :param chunk_pixels: 每次从栅格中取出的像元数
+        :return:
+        """
+        print('### Exporting parcel pixel sets...')
+        if not os.path.exists(self.result_folder):
+            os.makedirs(self.result_folder)
+        # a previous export may have written more shards, or masks that this export does not write;
+        # the table goes first, so an interrupted export never leaves a table over missing shards
+        stale_list = [os.path.join(self.result_folder, 'parcels.npz')]
+        for pattern in ('pixels_*.npy*', 'masks_*.npy*', 'parcels.npz.tmp'):
+            stale_list += sorted(glob.glob(os.path.join(self.result_folder, pattern)))
+        for stale_path in stale_list:
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+        pixel_index, parcel_ids, parcel_starts, parcel_counts = self.group_parcel_pixels()
+        parcel_labels = self.parcel_labels(parcel_ids)
+
+        num_band = self.raster_data.shape[0]
+        num_dates = num_band // self.date_bands
+        raster_flat = self.raster_data.reshape(num_band, -1)
+
+        shard_first = self.shard_bounds(parcel_starts, parcel_counts, self.shard_pixels)
+        parcel_shard = np.repeat(np.arange(shard_first.size - 1), np.diff(shard_first))
+        shard_bounds = np.append(parcel_starts, pixel_index.size)[shard_first]
+        shard_starts = parcel_starts - shard_bounds[parcel_shard]
+
+        for ss in tqdm(range(shard_first.size - 1), desc='Writing shards ...'):
+            pixel_start, pixel_end = int(shard_bounds[ss]), int(shard_bounds[ss + 1])
+            shard_shape = (pixel_end - pixel_start, num_dates, self.date_bands)
+            shard_path = os.path.join(self.result_folder, 'pixels_{:0>5d}.npy'.format(ss))
+            shard_array = np.lib.format.open_memmap(shard_path + '.tmp', mode='w+', dtype=self.raster_data.dtype,
+                                                    shape=shard_shape)
+            mask_path = os.path.join(self.result_folder, 'masks_{:0>5d}.npy'.format(ss))
+            mask_array = None
+            if self.channel_nodata is not None:
+                mask_array = np.lib.format.open_memmap(mask_path + '.tmp', mode='w+', dtype=bool, shape=shard_shape)
+
+            for chunk_start in range(pixel_start, pixel_end, chunk_pixels):
+                chunk_end = min(chunk_start + chunk_pixels, pixel_end)
+                chunk_data = raster_flat[:, pixel_index[chunk_start:chunk_end]]
+                shard_array[chunk_start - pixel_start:chunk_end - pixel_start] = \
+                    chunk_data.T.reshape(-1, num_dates, self.date_bands)
+                if mask_array is not None:
+                    chunk_mask = np.zeros(chunk_data.shape, dtype=bool)
+                    for cc, no_data in enumerate(self.channel_nodata):
+                        if no_data is not None:
+                            chunk_mask[cc] = chunk_data[cc] == no_data
+                    mask_array[chunk_start - pixel_start:chunk_end - pixel_start] = \
+                        chunk_mask.T.reshape(-1, num_dates, self.date_bands)
+            # for
+
+            shard_array.flush()
+            del shard_array
+            os.replace(shard_path + '.tmp', shard_path)
+            if mask_array is not None:
+                mask_array.flush()
+                del mask_array
+                os.replace(mask_path + '.tmp', mask_path)
+        # for
+
+        table_path = os.path.join(self.result_folder, 'parcels.npz')
+        with open(table_path + '.tmp', 'wb') as f:
+            np.savez(f, parcel_id=parcel_ids, label=parcel_labels, shard=parcel_shard, start=shard_starts,
+                     count=parcel_counts, position=pixel_index)
+        os.replace(table_path + '.tmp', table_path)
+
+        print('### Exporting parcel pixel sets complete!')
+        return self.result_folder
+
+
+class PixelSetStore(object):
+    """
+    像元集读取：按序号或地块ID返回地块的(N, T, B)像元数组（分片文件内存映射），有掩膜分片时可读取nodata掩膜。
+    """
+    def __init__(self, store_folder, mmap_mode='r'):
+        self.store_folder = store_folder
+        self.mmap_mode = mmap_mode
+
+        table_data = np.load(os.path.join(store_folder, 'parcels.npz'))
+        self.parcel_id = table_data['parcel_id']
+        self.label = table_data['label']
+        self.shard = table_data['shard']
+        self.start = table_data['start']
+        self.count = table_data['count']
+        self.shard_path_list = sorted(glob.glob(os.path.join(store_folder, 'pixels_*.npy')))
+        self.mask_path_list = sorted(glob.glob(os.path.join(store_folder, 'masks_*.npy')))
+        self.has_mask = len(self.mask_path_list) > 0
+
+        self._parcel_index = {int(pp): ii for ii, pp in enumerate(self.parcel_id)}
+        self._shard_data = {}
+        self._mask_data = {}
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in the receiving process
+        state = self.__dict__.copy()
+        state['_shard_data'] = {}
+        state['_mask_data'] = {}
+        return state
+
+    def _shard(self, ss):
+        if ss not in self._shard_data:
+            self._shard_data[ss] = np.load(self.shard_path_list[ss], mmap_mode=self.mmap_mode)
+        return self._shard_data[ss]
+
+    def _mask(self, ss):
+        if ss not in self._mask_data:
+            self._mask_data[ss] = np.load(self.mask_path_list[ss], mmap_mode=self.mmap_mode)
+        return self._mask_data[ss]
+
+    def get(self, index):
+        """
+        按序号读取地块像元。
+        :param index:
+        :return: (N, T, B)
+        """
+        start = self.start[index]
+        return self._shard(int(self.shard[index]))[start:start + self.count[index]]
+
+    def get_mask(self, index):
+        """
+        按序号读取地块像元的nodata掩膜，没有掩膜分片（float32导出，nodata为NaN）时返回None。
+        :param index:
+        :return: (N, T, B)布尔数组
+        """
+        if not self.has_mask:
+            return None
+        start = self.start[index]
+        return self._mask(int(self.shard[index]))[start:start + self.count[index]]
+
+    def parcel(self, parcel_id):
+        return self.get(self._parcel_index[int(parcel_id)])
+
+    def __getitem__(self, index):
+        return self.get(index)
+
+    def __len__(self):
+        return len(self.parcel_id)
+
+
+class PixelSetDataset(Dataset):
+    """
+    像元集的PyTorch Dataset：每个样本为一个地块随机抽取的sample_pixels个像元(S, T, B)（像元不足时有放回抽样）、
+    有效像元掩膜(S,)与类别。分片文件在每个DataLoader工作进程中首次读取时才打开。
+    源数据类型导出的nodata按掩膜分片置为NaN（输出为浮点型时）。
+    """
+    def __init__(self, store_folder, sample_pixels=64, dtype=np.float32, to_tensor=True):
+        """
+        初始化
+        :param store_folder: PixelSetExport的结果目录
+        :param sample_pixels: 每个样本的像元数
+        :param dtype: 输出数据类型
+        :param to_tensor: 是否返回torch.Tensor（未安装torch时返回numpy数组）
+        """
+        self.store = PixelSetStore(store_folder)
+        self.sample_pixels = sample_pixels
+        self.dtype = np.dtype(dtype)
+        self.to_tensor = to_tensor and torch is not None
+
+    def __getitem__(self, index):
+        parcel_pixels = self.store.get(index)
+        num_pixels = parcel_pixels.shape[0]
+        if num_pixels >= self.sample_pixels:
+            choice = np.sort(np.random.choice(num_pixels, self.sample_pixels, replace=False))
+            pixel_mask = np.ones(self.sample_pixels, dtype=np.float32)
+        else:
+            choice = np.concatenate([np.arange(num_pixels),
+                                     np.random.choice(num_pixels, self.sample_pixels - num_pixels, replace=True)])
+            pixel_mask = (np.arange(self.sample_pixels) < num_pixels).astype(np.float32)
+
+        pixel_data = np.asarray(parcel_pixels[choice], dtype=self.dtype)
+        if self.store.has_mask and np.issubdtype(self.dtype, np.floating):
+            pixel_data[self.store.get_mask(index)[choice]] = np.nan
+        label = int(self.store.label[index])
+        if not self.to_tensor:
+            return pixel_data, pixel_mask, label
+        return torch.from_numpy(pixel_data), torch.from_numpy(pixel_mask), label
+
+    def __len__(self):
+        return len(self.store)
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    parcel_path = r'G:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\polygon\parcel_dirong_maincrop_removesmall_utm_polygon.tif'
+    label_path = r'G:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\polygon\parcel_dirong_maincrop_removesmall_utm_type.tif'
+    result_folder = r'G:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\pixel_set'
+    raster_list = [
+        r'G:\FF\application_dataset\2020-france-agri\s2_l2a_tif_masked\10m\L1C_T31TFN_20190103_masked_10m.tif',
+    ]
+
+    #######################################################
+    # do
+    pse = PixelSetExport(raster_list, parcel_path, result_folder, label_path, sample_pixels=None,
+                         shard_pixels=64 * 1024 * 1024)
+    pse.prepare_data()
+    pse.export_pixel_set()
+
+    store = PixelSetStore(result_folder)
+    print(f'{len(store)} parcels, first parcel {store.parcel_id[0]}: {store[0].shape}')
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+
+"""
+PyTorch Dataset over the generated patch outputs
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import json
+import numpy as np
+
+from raster_util import load_numpy_array
+from patch_store import PatchStore, SliceMaskTable, SampleIndex, is_patch_store, has_sample_index
+from grid.virtual_layer_stack import VirtualLayerStack
+
+try:
+    import torch
+    from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+except ImportError:
+    torch = None
+    Dataset = object
+
+
+def _list_npy_files(folder):
+    """
+    列出切片目录及其编号子目录（切片过多时每10000个一个子目录'00'、'01'...）中的.npy文件，返回相对路径。
+    :param folder:
+    :return:
+    """
+    path_list = []
+    for entry in os.scandir(folder):
+        if entry.is_dir() and entry.name.isdigit():
+            path_list.extend(os.path.join(entry.name, path) for path in sorted(os.listdir(entry.path))
+                             if path.endswith('.npy'))
+        elif entry.name.endswith('.npy'):
+            path_list.append(entry.name)
+    return sorted(path_list)
+
+
+def _folder_signature(folder):
+    """
+    目录及其直接子目录的修改时间，文件增删时随之变化，用于判断索引缓存是否过期（无需重新列出文件）。
+    :param folder:
+    :return:
+    """
+    signature = {'': os.path.getmtime(folder)}
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            signature[entry.name] = entry.stat().st_mtime
+    return signature
+
+
+def _has_mask_table(folder):
+    return any(path.endswith('.masks.npy') for path in os.listdir(folder))
+
+
+def _list_grids(folder):
+    """
+    列出切片目录（.npy目录或集中存储）中的切片。
+    :param folder:
+    :return: (来源类型, 切片引用（相对路径或存储中的序号）, 切片编码)
+    """
+    if is_patch_store(folder):
+        keys = PatchStore(folder).keys
+        return 'store', np.arange(len(keys)), keys
+    path_list = np.array(_list_npy_files(folder))
+    return 'npy', path_list, [os.path.basename(path)[:-4] for path in path_list]
+
+
+def _match_grids(grid_code, codes):
+    """
+    按切片编码匹配切片，无对应切片时为-1。
+    :param grid_code: (N, 4)
+    :param codes: 切片编码列表
+    :return: (N,)
+    """
+    code_index = {code: ii for ii, code in enumerate(codes)}
+    return np.array([code_index.get('{:0>5d}_{:0>5d}_{:0>5d}_{:0>5d}'.format(*code), -1) for code in grid_code],
+                    dtype=np.int64)
+
+
+class SliceDataset(Dataset):
+    """
+    分层切片样本的PyTorch Dataset。
+    每个样本为一个分层切片'{class}_{parcel}_{grid}'（GridLabelSlice或GridParcelSlice的输出：.npy目录、集中存储或位压缩分层表）
+    与其所在切片的堆叠栅格数据（.npy目录、集中存储，或多个切片目录组成的VirtualLayerStack），返回(raster, label_slice, class_id)。
+    样本索引（类别、地块ID、切片编码及其在两个来源中的位置）只在首次使用时列出目录、解析文件名建立，并缓存于'{slice_folder}.index.npz'。
+    来源以内存映射方式打开，且在每个DataLoader工作进程中首次读取时才打开（fork之后），不在进程间共享文件句柄。
+    以索引列表访问（或__getitems__）时整批读取：集中存储与分层表按分块排序后一次花式索引读取，batch_loader()即按批读取的DataLoader。
+    分层也可以是虚拟样本索引（output_format='index'，见patch_store.SampleIndex）：读取时由label_source中的标记（或地块）切片
+    与parcel_id（或class_id）比较得到分层；mask_raster时栅格切片再乘以该掩膜，即代替写出的按地块掩膜的栅格副本。
+    """
+    def __init__(self, slice_folder, raster_source, patch_size=32, mmap_mode='r', dtype=np.float32, index_path=None,
+                 rebuild_index=False, to_tensor=True, label_source=None, mask_raster=False):
+        """
+        初始化
+        :param slice_folder: 分层切片目录（.npy目录、集中存储或位压缩分层表）
+        :param raster_source: 堆叠栅格切片目录（.npy目录或集中存储），或多个切片目录的列表（按VirtualLayerStack堆叠读取）
+        :param patch_size: 切片大小（VirtualLayerStack堆叠后的大小）
+        :param mmap_mode: 来源的读取方式，None则整体读入
+        :param dtype: 栅格数据的输出类型
+        :param index_path: 索引缓存文件，None则为'{slice_folder}.index.npz'
+        :param rebuild_index: 是否忽略已有缓存重新建立索引
+        :param to_tensor: 是否返回torch.Tensor（未安装torch时返回numpy数组）
+        :param label_source: 虚拟样本索引对应的标记（或地块）切片目录（.npy目录或集中存储）
+        :param mask_raster: 是否以分层掩膜栅格切片（掩膜外像元为0）
+        """
+        self.slice_folder = slice_folder
+        self.raster_source = raster_source
+        self.patch_size = patch_size
+        self.mmap_mode = mmap_mode
+        self.dtype = np.dtype(dtype)
+        self.index_path = index_path if index_path else slice_folder.rstrip('/\\') + '.index.npz'
+        self.to_tensor = to_tensor and torch is not None
+        self.label_source = label_source
+        self.mask_raster = mask_raster
+
+        self.slice_kind = None
+        self.label_kind = None
+        self.raster_kind = None
+        self.class_id = None
+        self.parcel_id = None
+        self.grid_code = None
+        self.slice_ref = None
+        self.raster_ref = None
+        self.raster_names = None
+        self.raster_shape = None
+
+        # opened lazily in each process
+        self._pid = None
+        self._slice_store = None
+        self._raster_store = None
+
+        if rebuild_index or not self._load_index():
+            self._build_index()
+            self._save_index()
+
+    def _signature(self):
+        raster_folder_list = self.raster_source if isinstance(self.raster_source, (list, tuple)) else [self.raster_source]
+        signature = {'slice_folder': [os.path.abspath(self.slice_folder), _folder_signature(self.slice_folder)],
+                     'raster_source': [[os.path.abspath(folder), _folder_signature(folder)] for folder in raster_folder_list]}
+        if self.label_source is not None:
+            signature['label_source'] = [os.path.abspath(self.label_source), _folder_signature(self.label_source)]
+        return signature
+
+    def _build_index(self):
+        """
+        建立样本索引：列出分层与栅格来源一次，解析类别、地块ID与切片编码，并匹配每个分层的栅格切片。
+        :return:
+        """
+        print(f'### Indexing slices in {self.slice_folder}')
+
+        # slices
+        label_ref = None
+        if has_sample_index(self.slice_folder):
+            assert (self.label_source is not None), 'virtual samples need the label grids in label_source'
+            self.slice_kind = 'index'
+            records = SampleIndex(self.slice_folder).records
+            class_id = records['class_id'].astype(np.int64)
+            parcel_id = records['parcel_id'].astype(np.int64)
+            grid_code = records['grid_code'].astype(np.int64)
+            # slices are masked from the label grids, referenced like the slices of an npy folder or store
+            self.label_kind, label_names, label_codes = _list_grids(self.label_source)
+            label_ref = _match_grids(grid_code, label_codes)
+            slice_ref = label_names[np.maximum(label_ref, 0)] if len(label_names) else label_ref
+        elif _has_mask_table(self.slice_folder):
+            self.slice_kind = 'mask'
+            records = SliceMaskTable(self.slice_folder).records
+            class_id = records['class_id'].astype(np.int64)
+            parcel_id = records['parcel_id'].astype(np.int64)
+            grid_code = records['grid_code'].astype(np.int64)
+            slice_ref = np.arange(len(records))
+        else:
+            if is_patch_store(self.slice_folder):
+                self.slice_kind = 'store'
+                slice_names = PatchStore(self.slice_folder).keys
+                slice_ref = np.arange(len(slice_names))
+            else:
+                self.slice_kind = 'npy'
+                slice_ref = np.array(_list_npy_files(self.slice_folder))
+                slice_names = [os.path.basename(path)[:-4] for path in slice_ref]
+            parsed = np.array([[int(ss) for ss in name.split('_')[:6]] for name in slice_names],
+                              dtype=np.int64).reshape(-1, 6)
+            class_id, parcel_id, grid_code = parsed[:, 0], parsed[:, 1], parsed[:, 2:6]
+        # if
+
+        # rasters
+        if isinstance(self.raster_source, (list, tuple)):
+            self.raster_kind = 'virtual'
+            self.raster_names = np.array(VirtualLayerStack(list(self.raster_source)).list_grid_codes())
+            raster_codes = self.raster_names
+        elif is_patch_store(self.raster_source):
+            self.raster_kind = 'store'
+            self.raster_names = np.array(PatchStore(self.raster_source).keys)
+            raster_codes = self.raster_names
+        else:
+            self.raster_kind = 'npy'
+            self.raster_names = np.array(_list_npy_files(self.raster_source))
+            raster_codes = [os.path.basename(path)[:-4] for path in self.raster_names]
+        # if
+
+        raster_ref = _match_grids(grid_code, raster_codes)
+        matched = raster_ref >= 0
+        if label_ref is not None:
+            matched &= label_ref >= 0
+        if not matched.all():
+            print(f'{np.count_nonzero(~matched)} slices without raster (or label) grid are skipped')
+
+        self.class_id, self.parcel_id, self.grid_code = class_id[matched], parcel_id[matched], grid_code[matched]
+        self.slice_ref, self.raster_ref = slice_ref[matched], raster_ref[matched]
+        self.raster_shape = self._read_raster(int(self.raster_ref[0])).shape if len(self.raster_ref) else (0, 0, 0)
+        print(f'{len(self.class_id)} slices indexed, raster shape {self.raster_shape}')
+
+    def _save_index(self):
+        np.savez(self.index_path, class_id=self.class_id, parcel_id=self.parcel_id, grid_code=self.grid_code,
+                 slice_ref=self.slice_ref, raster_ref=self.raster_ref, raster_names=self.raster_names,
+                 raster_shape=self.raster_shape, slice_kind=self.slice_kind, raster_kind=self.raster_kind,
+                 label_kind=str(self.label_kind), signature=json.dumps(self._signature()))
+        return self.index_path
+
+    def _load_index(self):
+        """
+        读取索引缓存，来源目录有变化时视为过期。
+        :return: 是否读取成功
+        """
+        if not os.path.exists(self.index_path):
+            return False
+        index_data = np.load(self.index_path)
+        if str(index_data['signature']) != json.dumps(self._signature()):
+            print(f'Slice index {self.index_path} is out of date, rebuilding')
+            return False
+
+        self.class_id, self.parcel_id = index_data['class_id'], index_data['parcel_id']
+        self.grid_code, self.slice_ref = index_data['grid_code'], index_data['slice_ref']
+        self.raster_ref, self.raster_names = index_data['raster_ref'], index_data['raster_names']
+        self.raster_shape = tuple(int(vv) for vv in index_data['raster_shape'])
+        self.slice_kind, self.raster_kind = str(index_data['slice_kind']), str(index_data['raster_kind'])
+        self.label_kind = str(index_data['label_kind'])
+        return True
+
+    def __getstate__(self):
+        # sources are reopened lazily in each worker process
+        state = self.__dict__.copy()
+        state.update(_pid=None, _slice_store=None, _raster_store=None)
+        return state
+
+    def _open(self):
+        """
+        在当前进程中打开来源（DataLoader工作进程fork后首次读取时）。
+        :return:
+        """
+        if self._pid == os.getpid():
+            return
+        self._slice_store, self._raster_store = None, None
+        slice_folder, slice_kind = self._slice_source()
+        if slice_kind == 'mask':
+            self._slice_store = SliceMaskTable(slice_folder)
+        elif slice_kind == 'store':
+            self._slice_store = PatchStore(slice_folder, self.mmap_mode)
+
+        if self.raster_kind == 'virtual':
+            self._raster_store = VirtualLayerStack(list(self.raster_source), self.patch_size, self.mmap_mode)
+            self._raster_store.list_grid_codes()
+        elif self.raster_kind == 'store':
+            self._raster_store = PatchStore(self.raster_source, self.mmap_mode)
+        self._pid = os.getpid()
+
+    def _read_raster(self, rr, out=None):
+        self._open()
+        if self.raster_kind == 'virtual':
+            return self._raster_store.read(str(self.raster_names[rr]), out)
+        if self.raster_kind == 'store':
+            raster_data = self._raster_store.get(rr)
+        else:
+            raster_data = load_numpy_array(os.path.join(self.raster_source, str(self.raster_names[rr])), self.mmap_mode)
+        if out is None:
+            return raster_data
+        out[...] = raster_data
+        return out
+
+    def _slice_source(self):
+        """
+        分层的读取来源：虚拟样本时为标记切片。
+        :return: (目录, 来源类型)
+        """
+        if self.slice_kind == 'index':
+            return self.label_source, self.label_kind
+        return self.slice_folder, self.slice_kind
+
+    def mask_values(self, indices):
+        """
+        样本在标记切片中的像元值：地块样本为parcel_id，类别样本为class_id。
+        """
+        return np.where(self.parcel_id[indices] != 0, self.parcel_id[indices], self.class_id[indices])
+
+    @staticmethod
+    def _mask_label(label_data, values):
+        """
+        由标记切片得到分层：与样本值比较，其余像元为0。
+        :param label_data: (P, P)或(B, P, P)
+        :param values: 标量或(B,)
+        :return:
+        """
+        values = np.asarray(values)[..., np.newaxis, np.newaxis]
+        return np.where(label_data == values, label_data, 0)
+
+    def _read_slice(self, index):
+        self._open()
+        slice_folder, slice_kind = self._slice_source()
+        ss = self.slice_ref[index]
+        if slice_kind == 'mask':
+            slice_data = self._slice_store.decode(int(ss), dtype=np.int64)
+        elif slice_kind == 'store':
+            slice_data = self._slice_store.get(int(ss)).astype(np.int64)
+        else:
+            slice_data = load_numpy_array(os.path.join(slice_folder, str(ss)), self.mmap_mode).astype(np.int64)
+
+        if self.slice_kind == 'index':
+            slice_data = self._mask_label(slice_data, self.mask_values(index))
+        return slice_data
+
+    @staticmethod
+    def _gather_store(store, refs, out):
+        """
+        从集中存储整批读取：按(分块, 行)排序，每个分块一次花式索引，按递增的行顺序读取内存映射。
+        :param store: PatchStore
+        :param refs: 存储中的序号
+        :param out: (B, ...)
+        :return: out
+        """
+        part_rows = store._part_index[refs]
+        order = np.lexsort((part_rows[:, 1], part_rows[:, 0]))
+        parts, part_starts = np.unique(part_rows[order, 0], return_index=True)
+        part_ends = np.append(part_starts[1:], len(order))
+        for pp, start, end in zip(parts, part_starts, part_ends):
+            out[order[start:end]] = store._part(pp)[part_rows[order[start:end], 1]]
+        return out
+
+    def get_batch(self, indices):
+        """
+        整批读取样本。
+        :param indices: 样本序号
+        :return: (B, C, P, P)栅格, (B, P, P)分层, (B,)类别
+        """
+        self._open()
+        indices = np.asarray(indices, dtype=np.int64)
+        raster_batch = np.empty((len(indices),) + self.raster_shape, dtype=self.dtype)
+        raster_refs = self.raster_ref[indices]
+        if self.raster_kind == 'store':
+            self._gather_store(self._raster_store, raster_refs, raster_batch)
+        else:
+            for bb, rr in enumerate(raster_refs):
+                self._read_raster(rr, raster_batch[bb])
+
+        slice_folder, slice_kind = self._slice_source()
+        slice_refs = self.slice_ref[indices]
+        if slice_kind == 'mask':
+            slice_batch = self._slice_store.decode(slice_refs, dtype=np.int64)
+        elif slice_kind == 'store':
+            slice_batch = np.empty((len(indices),) + self.raster_shape[-2:], dtype=np.int64)
+            self._gather_store(self._slice_store, slice_refs, slice_batch)
+        else:
+            slice_batch = np.stack([load_numpy_array(os.path.join(slice_folder, str(ss)), self.mmap_mode)
+                                    for ss in slice_refs], axis=0).astype(np.int64)
+
+        if self.slice_kind == 'index':
+            slice_batch = self._mask_label(slice_batch, self.mask_values(indices))
+        if self.mask_raster:
+            raster_batch *= (slice_batch != 0)[:, np.newaxis]
+        return self._output(raster_batch, slice_batch, self.class_id[indices])
+
+    def _output(self, raster_data, slice_data, class_id):
+        if not self.to_tensor:
+            return raster_data, slice_data, class_id
+        return torch.from_numpy(raster_data), torch.from_numpy(slice_data), torch.as_tensor(class_id)
+
+    def __getitem__(self, index):
+        if not np.isscalar(index):
+            return self.get_batch(index)
+
+        raster_data = np.array(self._read_raster(int(self.raster_ref[index])), dtype=self.dtype)
+        slice_data = self._read_slice(index)
+        if self.mask_raster:
+            raster_data *= slice_data != 0
+        return self._output(raster_data, slice_data, int(self.class_id[index]))
+
+    def __getitems__(self, indices):
+        """
+        DataLoader自动分批时（torch>=2.1）整批读取，返回样本列表再由collate_fn合并。
+        """
+        raster_batch, slice_batch, class_batch = self.get_batch(indices)
+        return [(raster_batch[bb], slice_batch[bb], class_batch[bb]) for bb in range(len(indices))]
+
+    def __len__(self):
+        return len(self.class_id)
+
+    def batch_loader(self, batch_size=64, shuffle=True, num_workers=0, drop_last=False, **kwargs):
+        """
+        按批读取的DataLoader：采样器给出整批序号，每批由get_batch()一次读取，无需逐样本读取与合并。
+        :param batch_size:
+        :param shuffle:
+        :param num_workers:
+        :param drop_last:
+        :param kwargs: 传给DataLoader的其他参数，如pin_memory
+        :return:
+        """
+        assert (torch is not None), 'batch_loader requires PyTorch'
+        sampler = RandomSampler(self) if shuffle else SequentialSampler(self)
+        return DataLoader(self, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last),
+                          num_workers=num_workers, **kwargs)
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    slice_folder = r'K:\FF\application_dataset\2020-france-agri-grid\dijon_train\label_slice'
+    raster_folder = r'K:\FF\application_dataset\2020-france-agri-grid\dijon_train\raster'
+
+    #######################################################
+    # do
+    dataset = SliceDataset(slice_folder, raster_folder, patch_size=32)
+    print(f'{len(dataset)} samples, raster shape {dataset.raster_shape}, {len(np.unique(dataset.class_id))} classes')
+    if torch is not None:
+        for raster_batch, slice_batch, class_batch in dataset.batch_loader(batch_size=64, num_workers=4):
+            print(raster_batch.shape, slice_batch.shape, class_batch.shape)
+            break
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
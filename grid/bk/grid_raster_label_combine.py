@@ -12,8 +12,9 @@ import warnings
 from tqdm import tqdm
 from osgeo import gdal
 
-from raster_util import read_label_data, write_patch_sample
+from raster_util import read_label_data, write_patch_sample, label_type_counts
 from raster_util import write_numpy_array, load_numpy_array
+from patch_store import SampleIndexWriter
 
 warnings.filterwarnings('ignore')
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
@@ -22,13 +23,23 @@ gdal.UseExceptions()
 
 
 class GridRasterLabelCombine(object):
-    def __init__(self, label_folder, raster_folder_list, result_folder, patch_size=32, min_pixel_percent=0.01):
+    """
+    按类别将堆叠栅格切片掩膜为样本。
+    virtual=True时不写出每个类别的掩膜副本（每个切片的全部时相按类别数重复存储），只写出(grid_code, class_id)样本索引，
+    读取时由标记切片即时掩膜堆叠栅格切片（见dataset.SliceDataset，raster_source为raster_folder_list）。
+    """
+    def __init__(self, label_folder, raster_folder_list, result_folder, patch_size=32, min_pixel_percent=0.01,
+                 codec=None, virtual=False):
         self.label_folder = label_folder
         self.raster_folder_list = raster_folder_list
         self.result_folder = result_folder
 
         self.patch_size = patch_size
         self.min_pixel_percent = min_pixel_percent
+        # compression codec of the masked samples (see patch_codec), mostly zeros and highly compressible
+        self.codec = codec
+        # only a sample index is written, samples are masked at read time
+        self.virtual = virtual
 
         self.grid_code_list = []
 
@@ -37,7 +48,8 @@ class GridRasterLabelCombine(object):
         # fast version
         item_list = os.listdir(self.label_folder)
         for path in item_list:
-            self.grid_code_list.append(path[:-4])
+            if path.endswith(filter_ext):
+                self.grid_code_list.append(path[:-4])
         self.grid_code_list.sort()
 
         # item_list = os.listdir(self.label_folder)
@@ -64,7 +76,7 @@ class GridRasterLabelCombine(object):
         return grid_array.astype(np.float32)
 
     @staticmethod
-    def _slice_grid_sample(label_data, raster_data, min_pixel_percent, grid_code, folder):
+    def _slice_grid_sample(label_data, raster_data, min_pixel_percent, grid_code, folder, codec=None):
         print(f'Slicing types for {grid_code} ...')
 
         patch_size2 = label_data.size
@@ -91,16 +103,35 @@ class GridRasterLabelCombine(object):
                 raster_data_current[raster_mask] = 0
 
                 # save to disk
-                write_patch_sample(vv, raster_data_current, sample_path)
+                write_patch_sample(vv, raster_data_current, sample_path, codec)
             # if
         # for
         return folder
 
+    @staticmethod
+    def _index_grid_sample(label_data, min_pixel_percent, grid_code, writer):
+        """
+        虚拟样本：只记录切片中满足比例的类别。
+        """
+        types, counts = label_type_counts(label_data)
+        for vv in types[counts / label_data.size > min_pixel_percent]:
+            writer.write('{:0>2d}_00000000_{}'.format(int(vv), grid_code), label_data == vv)
+        return grid_code
+
     def combine_label_raster_data(self):
         print('### Combining grid samples...')
 
         combine_folder = os.path.join(self.result_folder, 'label_raster')
-        os.makedirs(combine_folder)
+        if not os.path.exists(combine_folder):
+            os.makedirs(combine_folder)
+
+        if self.virtual:
+            with SampleIndexWriter(combine_folder) as writer:
+                for code in tqdm(self.grid_code_list):
+                    label_grid_data = load_numpy_array(os.path.join(self.result_folder, code + '.npy'))
+                    self._index_grid_sample(label_grid_data, self.min_pixel_percent, code, writer)
+            print(f'### {writer.num_written} virtual samples indexed!')
+            return combine_folder
 
         # combine grid data
         num_grid = len(self.grid_code_list)
@@ -130,7 +161,8 @@ class GridRasterLabelCombine(object):
             label_grid_data = load_numpy_array(label_grid_path)
 
             # slice sample data by type
-            self._slice_grid_sample(label_grid_data, all_raster_grid_data, self.min_pixel_percent, code, write_folder)
+            self._slice_grid_sample(label_grid_data, all_raster_grid_data, self.min_pixel_percent, code, write_folder,
+                                   self.codec)
         # for
 
         print('### Combining grid samples complete!')
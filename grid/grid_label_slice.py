@@ -12,8 +12,11 @@ import warnings
 from tqdm import tqdm
 from osgeo import gdal
 
-from raster_util import read_label_data, write_slice_array
-from raster_util import write_numpy_array, load_numpy_array
+from raster_util import read_label_data, write_slice_batch, label_type_counts
+from raster_util import write_numpy_array, load_numpy_array, NumpyArrayReader, async_write
+from patch_store import PatchStore, is_patch_store, open_patch_writer
+from parallel_util import run_chunks, make_grid_folders, ChunkManifest, chunk_result, manifest_signature
+from grid.label_occupancy_index import parse_grid_names
 
 warnings.filterwarnings('ignore')
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
@@ -22,9 +25,23 @@ gdal.UseExceptions()
 
 
 class GridLabelSlice(object):
-    def __init__(self, label_folder, result_folder, patch_size=32, min_pixel_percent=0.01):
+    def __init__(self, label_folder, result_folder, patch_size=32, min_pixel_percent=0.01, output_format='npy',
+                 mmap_mode=None, reuse_buffer=False, workers=1, write_threads=0, codec=None, resume=False):
+        assert (output_format in ('npy', 'store', 'mask', 'index'))
         self.label_folder = label_folder
         self.result_folder = result_folder
+        self.output_format = output_format
+        self.workers = workers
+        # >0: slices are written by background threads while the next grids are sliced
+        self.write_threads = write_threads
+        # compression codec of 'npy' slices (see patch_codec), None writes plain .npy files
+        self.codec = codec
+        # chunked processing with a manifest of finished chunks, so a rerun skips them (see ChunkManifest)
+        self.resume = resume
+        # input grids may also come from a patch store (LabelDatasetSplit with output_format='store')
+        self.label_store = None
+        # only the label values are inspected, so memory-mapped or buffer-reusing reads are enough
+        self.reader = NumpyArrayReader(mmap_mode, reuse_buffer)
 
         self.patch_size = patch_size
         self.min_pixel_percent = min_pixel_percent
@@ -33,10 +50,16 @@ class GridLabelSlice(object):
 
     def list_grid_codes(self, filter_ext='.npy'):
 
+        if is_patch_store(self.label_folder):
+            self.label_store = PatchStore(self.label_folder)
+            self.grid_code_list = sorted(self.label_store.keys)
+            return self.grid_code_list
+
         # fast version
         item_list = os.listdir(self.label_folder)
         for path in item_list:
-            self.grid_code_list.append(path[:-4])
+            if path.endswith(filter_ext):
+                self.grid_code_list.append(path[:-4])
         self.grid_code_list.sort()
 
         # item_list = os.listdir(self.label_folder)
@@ -50,31 +73,41 @@ class GridLabelSlice(object):
 
         return self.grid_code_list
 
+    def apply_occupancy_index(self, occupancy):
+        """
+        根据占用索引（LabelOccupancyIndex）筛选切片，跳过没有任何类别像元比例大于min_pixel_percent的切片，无需读取其像元。
+        :param occupancy: LabelOccupancyIndex
+        :return:
+        """
+        grid_mask = occupancy.grid_mask(parse_grid_names(self.grid_code_list), self.min_pixel_percent)
+        num_grid = len(self.grid_code_list)
+        self.grid_code_list = [code for code, keep in zip(self.grid_code_list, grid_mask) if keep]
+
+        print(f'{len(self.grid_code_list)} of {num_grid} grids occupied')
+        return self.grid_code_list
+
     @staticmethod
-    def _slice_label(label_data, min_pixel_percent, grid_code, folder):
+    def _slice_label(label_data, min_pixel_percent, grid_code, folder, writer=None, codec=None):
         print(f'Slicing types for {grid_code} ...')
         patch_size2 = label_data.size
 
-        # 1. the number of types in parcel_data, and their values
-        unique, counts = np.unique(label_data, return_counts=True, axis=None)
-
-        # 2. for each type in parcel_data
-        for vv, num in zip(unique, counts):
-
-            if (vv != 0) and (num / patch_size2 > min_pixel_percent):
-
-                slice_path = os.path.join(folder, '{:0>2d}_00000000_{}'.format(vv, grid_code))
-                print(f'generating sample on {slice_path}')
-                label_data_current = label_data.copy()
-
-                # mask non-target values
-                label_mask = label_data_current != vv
-                label_data_current[label_mask] = 0
-
-                # save to disk
-                write_slice_array(vv, label_data_current, slice_path)
-            # if
-        # for
+        # 1. the number of pixels of every type
+        types, counts = label_type_counts(label_data)
+        types = types[counts / patch_size2 > min_pixel_percent]
+        if types.size == 0:
+            return grid_code
+
+        # 2. all masked slices in one broadcast, shape (K, P, P), non-target values set to 0
+        label_slices = np.where(label_data[np.newaxis] == types[:, np.newaxis, np.newaxis], label_data[np.newaxis], 0)
+        label_slices = label_slices.astype(label_data.dtype, copy=False)
+
+        # 3. save to disk as a batch
+        slice_paths = [os.path.join(folder, '{:0>2d}_00000000_{}'.format(int(vv), grid_code)) for vv in types]
+        if writer is not None:
+            for slice_path, label_slice in zip(slice_paths, label_slices):
+                writer.write(os.path.basename(slice_path), label_slice)
+        else:
+            write_slice_batch(types, label_slices, slice_paths, codec)
         return grid_code
 
     def slice_label_grid(self):
@@ -86,11 +119,52 @@ class GridLabelSlice(object):
 
         # combine grid data
         num_grid = len(self.grid_code_list)
-        for gg, code in tqdm(enumerate(self.grid_code_list)):
+        manifest = ChunkManifest(combine_folder, manifest_signature(
+            num_grid, self.grid_code_list, output_format=self.output_format, patch_size=self.patch_size,
+            min_pixel_percent=self.min_pixel_percent, codec=self.codec))
+        if not self.resume:
+            manifest.reset()
+        if self.workers > 1 or self.resume:
+            if self.output_format == 'npy':
+                make_grid_folders(combine_folder, num_grid)
+            run_chunks(self, '_slice_grid_chunk', num_grid, self.workers, desc='Slicing grids ...',
+                       manifest=manifest if self.resume else None)
+            print('### Combining grid samples complete!')
+            return combine_folder
+
+        writer = open_patch_writer(self.output_format, combine_folder)
+        with async_write(self.write_threads):
+            self._slice_grid_range(writer, combine_folder, 0, num_grid, progress=True)
+        if writer is not None:
+            writer.close()
+
+        print('### Combining grid samples complete!')
+        return combine_folder
+
+    def _slice_grid_chunk(self, start, end, chunk_id):
+        """
+        并行处理的一块切片，集中存储时每块写入独立前缀的分块文件。
+        :return: 处理的切片数
+        """
+        combine_folder = os.path.join(self.result_folder, 'label_slice')
+        writer = open_patch_writer(self.output_format, combine_folder, prefix='part_{:0>8d}'.format(chunk_id))
+        with async_write(self.write_threads):
+            self._slice_grid_range(writer, combine_folder, start, end)
+        if writer is not None:
+            writer.close()
+        return chunk_result(end - start, writer)
+
+    def _slice_grid_range(self, writer, combine_folder, start, end, progress=False):
+        num_grid = len(self.grid_code_list)
+        grid_range = range(start, end)
+        if progress:
+            grid_range = tqdm(grid_range)
+        for gg in grid_range:
+            code = self.grid_code_list[gg]
             print(f'Grid {code}')
 
             # target folder
-            if num_grid > 10000:
+            if num_grid > 10000 and writer is None:
                 sub = gg // 10000
                 write_folder = os.path.join(combine_folder, '{:0>2d}'.format(sub))
                 if gg % 10000 == 0 and not os.path.exists(write_folder):
@@ -99,15 +173,17 @@ class GridLabelSlice(object):
                 write_folder = combine_folder
 
             # load label grid data
-            label_grid_path = os.path.join(self.label_folder, code + '.npy')
-            label_grid_data = load_numpy_array(label_grid_path)
+            if self.label_store is not None:
+                label_grid_data = self.label_store[code]
+            else:
+                label_grid_path = os.path.join(self.label_folder, code + '.npy')
+                label_grid_data = self.reader.read(label_grid_path)
 
             # slice grid label by type
-            self._slice_label(label_grid_data, self.min_pixel_percent, code, write_folder)
+            self._slice_label(label_grid_data, self.min_pixel_percent, code, write_folder, writer, self.codec)
         # for
 
-        print('### Combining grid samples complete!')
-        return combine_folder
+        return end - start
 
 
 def main():
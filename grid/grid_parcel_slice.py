@@ -12,8 +12,10 @@ import warnings
 from tqdm import tqdm
 from osgeo import gdal
 
-from raster_util import read_label_data, write_slice_array
-from raster_util import write_numpy_array, load_numpy_array
+from raster_util import read_label_data, write_slice_array, write_slice_batch
+from raster_util import write_numpy_array, load_numpy_array, NumpyArrayReader, async_write
+from patch_store import PatchStore, is_patch_store, open_patch_writer
+from parallel_util import run_chunks, make_grid_folders, ChunkManifest, chunk_result, manifest_signature
 
 warnings.filterwarnings('ignore')
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
@@ -27,10 +29,28 @@ class GridParcelSlice(object):
     输入：32*32大小的切片，可能含有多个地块的像元；
     处理：根据像元ID不同，生成每个ID对应的切片，该切片中仅保留该ID像元的值，其余像元值=0；
     输出：多个32*32切片，每个切片只有一种像元值。
+    output_format='mask'时，每个分层只记录(grid_code, parcel_id, class_id, packbits(mask))，见patch_store.SliceMaskTable。
+    output_format='index'时为虚拟样本：只记录(grid_code, parcel_id)索引，读取时由地块切片掩膜堆叠栅格切片（见dataset.SliceDataset）。
+    batch_size>0时，每次将batch_size个切片堆叠为(N, P, P)数组，一次性找出全部满足条件的(切片, 地块)组合并批量生成分层，输出与逐切片处理相同。
     """
-    def __init__(self, parcel_folder, result_folder, patch_size=32, min_pixel_percent=0.01):
+    def __init__(self, parcel_folder, result_folder, patch_size=32, min_pixel_percent=0.01, output_format='npy',
+                 mmap_mode=None, reuse_buffer=False, workers=1, write_threads=0, batch_size=0, codec=None, resume=False):
+        assert (output_format in ('npy', 'store', 'mask', 'index'))
         self.parcel_folder = parcel_folder
         self.result_folder = result_folder
+        self.output_format = output_format
+        self.workers = workers
+        # >0: slices are written by background threads while the next grids are sliced
+        self.write_threads = write_threads
+        self.batch_size = batch_size
+        # compression codec of 'npy' slices (see patch_codec), None writes plain .npy files
+        self.codec = codec
+        # chunked processing with a manifest of finished chunks, so a rerun skips them (see ChunkManifest)
+        self.resume = resume
+        # input grids may also come from a patch store (LabelDatasetSplit with output_format='store')
+        self.parcel_store = None
+        # only the label values are inspected, so memory-mapped or buffer-reusing reads are enough
+        self.reader = NumpyArrayReader(mmap_mode, reuse_buffer)
 
         self.patch_size = patch_size
         self.min_pixel_percent = min_pixel_percent
@@ -43,10 +63,16 @@ class GridParcelSlice(object):
         :param filter_ext:
         :return:
         """
+        if is_patch_store(self.parcel_folder):
+            self.parcel_store = PatchStore(self.parcel_folder)
+            self.grid_code_list = sorted(self.parcel_store.keys)
+            return self.grid_code_list
+
         # fast version
         item_list = os.listdir(self.parcel_folder)
         for path in item_list:
-            self.grid_code_list.append(path[:-4])
+            if path.endswith(filter_ext):
+                self.grid_code_list.append(path[:-4])
         self.grid_code_list.sort()
 
         # item_list = os.listdir(self.label_folder)
@@ -60,13 +86,14 @@ class GridParcelSlice(object):
         return self.grid_code_list
 
     @staticmethod
-    def _slice_parcel(parcel_data, min_pixel_percent, grid_code, folder):
+    def _slice_parcel(parcel_data, min_pixel_percent, grid_code, folder, writer=None, codec=None):
         """
         对切片进行分层
         :param parcel_data: 输入切片数据
         :param min_pixel_percent: 类别的最小像元个数比例
         :param grid_code: 切片编码
         :param folder: 输出目录
+        :param codec: 压缩编码，None为不压缩
         :return:
         """
         print(f'Slicing types for {grid_code} ...')
@@ -88,7 +115,10 @@ class GridParcelSlice(object):
                 label_mask = parcel_data_current != vv
                 parcel_data_current[label_mask] = 0
                 # save to disk
-                write_slice_array(vv, parcel_data_current, slice_path)
+                if writer is not None:
+                    writer.write(os.path.basename(slice_path), parcel_data_current)
+                else:
+                    write_slice_array(vv, parcel_data_current, slice_path, codec)
             # if
         # for
         return grid_code
@@ -107,28 +137,150 @@ class GridParcelSlice(object):
 
         # combine grid data
         num_grid = len(self.grid_code_list)
-        for gg, code in tqdm(enumerate(self.grid_code_list)):
-            print(f'Grid {code}')
+        manifest = ChunkManifest(combine_folder, manifest_signature(
+            num_grid, self.grid_code_list, output_format=self.output_format, patch_size=self.patch_size,
+            min_pixel_percent=self.min_pixel_percent, codec=self.codec))
+        if not self.resume:
+            manifest.reset()
+        if self.workers > 1 or self.resume:
+            if self.output_format == 'npy':
+                make_grid_folders(combine_folder, num_grid)
+            run_chunks(self, '_slice_grid_chunk', num_grid, self.workers, desc='Slicing grids ...',
+                       manifest=manifest if self.resume else None)
+            print('### Combining grid samples complete!')
+            return combine_folder
+
+        writer = open_patch_writer(self.output_format, combine_folder)
+        with async_write(self.write_threads):
+            self._slice_grid_range(writer, combine_folder, 0, num_grid, progress=True)
+        if writer is not None:
+            writer.close()
 
-            # target folder for too many grid.
-            if num_grid > 10000:
-                sub = gg // 10000
-                write_folder = os.path.join(combine_folder, '{:0>2d}'.format(sub))
-                if gg % 10000 == 0 and not os.path.exists(write_folder):
-                    os.makedirs(write_folder)
-            else:
-                write_folder = combine_folder
+        print('### Combining grid samples complete!')
+        return combine_folder
+
+    def _slice_grid_chunk(self, start, end, chunk_id):
+        """
+        并行处理的一块切片，集中存储时每块写入独立前缀的分块文件。
+        :return: 处理的切片数
+        """
+        combine_folder = os.path.join(self.result_folder, 'parcel_slice')
+        writer = open_patch_writer(self.output_format, combine_folder, prefix='part_{:0>8d}'.format(chunk_id))
+        with async_write(self.write_threads):
+            self._slice_grid_range(writer, combine_folder, start, end)
+        if writer is not None:
+            writer.close()
+        return chunk_result(end - start, writer)
 
-            # load parcel grid data
-            parcel_grid_path = os.path.join(self.parcel_folder, code + '.npy')
-            parcel_grid_data = load_numpy_array(parcel_grid_path)
+    def _grid_write_folder(self, combine_folder, gg, num_grid, writer=None):
+        # target folder for too many grid.
+        if num_grid > 10000 and writer is None:
+            sub = gg // 10000
+            write_folder = os.path.join(combine_folder, '{:0>2d}'.format(sub))
+            if gg % 10000 == 0 and not os.path.exists(write_folder):
+                os.makedirs(write_folder)
+        else:
+            write_folder = combine_folder
+        return write_folder
+
+    def _load_grid(self, code):
+        # load parcel grid data
+        if self.parcel_store is not None:
+            return self.parcel_store[code]
+        parcel_grid_path = os.path.join(self.parcel_folder, code + '.npy')
+        return self.reader.read(parcel_grid_path)
+
+    def _slice_grid_range(self, writer, combine_folder, start, end, progress=False):
+        if self.batch_size > 0:
+            return self._slice_grid_range_batch(writer, combine_folder, start, end, progress)
+
+        num_grid = len(self.grid_code_list)
+        grid_range = range(start, end)
+        if progress:
+            grid_range = tqdm(grid_range)
+        for gg in grid_range:
+            code = self.grid_code_list[gg]
+            print(f'Grid {code}')
+
+            write_folder = self._grid_write_folder(combine_folder, gg, num_grid, writer)
+            parcel_grid_data = self._load_grid(code)
 
             # slice grid parcel by type
-            self._slice_parcel(parcel_grid_data, self.min_pixel_percent, code, write_folder)
+            self._slice_parcel(parcel_grid_data, self.min_pixel_percent, code, write_folder, writer, self.codec)
         # for
 
-        print('### Combining grid samples complete!')
-        return combine_folder
+        return end - start
+
+    @staticmethod
+    def _slice_parcel_batch(parcel_batch, min_pixel_percent, grid_code_list, folder_list, writer=None, codec=None):
+        """
+        对一批切片进行分层
+        :param parcel_batch: 输入切片数据，形状为(N, P, P)
+        :param min_pixel_percent: 类别的最小像元个数比例
+        :param grid_code_list: N个切片编码
+        :param folder_list: N个输出目录
+        :param writer: 集中存储写入者
+        :param codec: 压缩编码，None为不压缩
+        :return: 生成的分层数
+        """
+        num_grid = parcel_batch.shape[0]
+        patch_size2 = parcel_batch[0].size
+
+        # 1. every (grid, parcel) pair and its pixel count, from one np.unique over combined keys
+        parcel_flat = parcel_batch.reshape(num_grid, -1).astype(np.int64)
+        key_base = int(parcel_flat.max()) + 1
+        pair_keys = (np.arange(num_grid, dtype=np.int64)[:, np.newaxis] * key_base + parcel_flat).ravel()
+        pair_unique, pair_counts = np.unique(pair_keys, return_counts=True)
+        grid_index, parcel_ids = pair_unique // key_base, pair_unique % key_base
+
+        # 2. check not background pixels, and percent of target pixel is enough
+        keep = (parcel_ids != 0) & (pair_counts / patch_size2 > min_pixel_percent)
+        grid_index, parcel_ids = grid_index[keep], parcel_ids[keep]
+        if grid_index.size == 0:
+            return 0
+
+        # 3. all slices together, shape (M, P, P), non-target values set to 0
+        parcel_source = parcel_batch[grid_index]
+        parcel_slices = np.where(parcel_source == parcel_ids[:, np.newaxis, np.newaxis], parcel_source, 0)
+        parcel_slices = parcel_slices.astype(parcel_batch.dtype, copy=False)
+
+        # 4. save to disk
+        slice_paths = [os.path.join(folder_list[gg], '00_{:0>8d}_{}'.format(vv, grid_code_list[gg]))
+                       for gg, vv in zip(grid_index, parcel_ids)]
+        if writer is not None:
+            for slice_path, parcel_slice in zip(slice_paths, parcel_slices):
+                writer.write(os.path.basename(slice_path), parcel_slice)
+        else:
+            write_slice_batch(parcel_ids, parcel_slices, slice_paths, codec)
+        return len(slice_paths)
+
+    def _slice_grid_range_batch(self, writer, combine_folder, start, end, progress=False):
+        num_grid = len(self.grid_code_list)
+        batch_range = range(start, end, self.batch_size)
+        if progress:
+            batch_range = tqdm(batch_range)
+
+        parcel_batch = None
+        for batch_start in batch_range:
+            batch_end = min(batch_start + self.batch_size, end)
+            code_list = self.grid_code_list[batch_start:batch_end]
+            print(f'Grid {code_list[0]} - {code_list[-1]}')
+
+            # stack the parcel grids of this batch into one (N, P, P) array
+            folder_list = []
+            for bb, gg in enumerate(range(batch_start, batch_end)):
+                parcel_grid_data = self._load_grid(code_list[bb])
+                if parcel_batch is None:
+                    parcel_batch = np.empty((self.batch_size,) + parcel_grid_data.shape, dtype=parcel_grid_data.dtype)
+                parcel_batch[bb] = parcel_grid_data
+                folder_list.append(self._grid_write_folder(combine_folder, gg, num_grid, writer))
+            # for
+
+            self._slice_parcel_batch(parcel_batch[:batch_end - batch_start], self.min_pixel_percent,
+                                     code_list, folder_list, writer, self.codec)
+        # for
+
+        return end - start
 
 
 def main():
@@ -12,8 +12,11 @@ import warnings
 from tqdm import tqdm
 from osgeo import gdal
 
-from raster_util import read_label_data
-from raster_util import write_numpy_array
+from raster_util import read_label_data, read_raster_info, read_label_window
+from raster_util import write_numpy_array, async_write
+from patch_store import PatchStoreWriter
+from parallel_util import run_chunks, make_grid_folders, create_shared_array, attach_shared_array
+from parallel_util import ChunkManifest, chunk_result, manifest_signature
 
 warnings.filterwarnings('ignore')
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
@@ -24,18 +27,36 @@ gdal.UseExceptions()
 class LabelDatasetSplit(object):
     """
     对标记栅格进行空间划分。标记栅格可以是面样本栅格数据，也可以是地块栅格数据。
+    流式模式下不整体读入标记栅格，每次窗口读取strip_patches*patch_size行的条带。
     """
-    def __init__(self, label_path, result_folder, patch_size=32):
+    def __init__(self, label_path, result_folder, patch_size=32, output_format='npy', workers=1, write_threads=0,
+                 codec=None, streaming=False, strip_patches=1, resume=False):
         """
         初始化。
         :param label_path:
         :param result_folder:
         :param patch_size:
+        :param output_format: 'npy'每个切片一个文件，'store'写入集中存储
+        :param workers: 并行进程数，大于1时标记栅格置于共享内存中
+        :param write_threads: 后台写盘线程数，0为同步写出
+        :param codec: 'npy'切片的压缩编码（见patch_codec），None为不压缩
+        :param streaming: 是否按条带流式读取与划分
+        :param strip_patches: 流式模式下每个条带包含的切片行数（见memory_planner）
+        :param resume: 分块处理并记录已完成块的清单（见parallel_util.ChunkManifest），中断后重新运行时跳过已完成的块
         """
+        assert (output_format in ('npy', 'store'))
         self.label_path = label_path
         self.result_folder = result_folder
+        self.output_format = output_format
+        self.workers = workers
+        self.write_threads = write_threads
+        self.codec = codec
+        self.streaming = streaming
+        self.strip_patches = strip_patches
+        self.resume = resume
 
         self.label_data = None
+        self._shared_memory, self._shared_spec = None, None
         self.grid_code = None
         self.label_rows, self.label_cols = 0, 0
 
@@ -44,10 +65,40 @@ class LabelDatasetSplit(object):
     def prepare_data(self):
         # todo check the list of raster
 
+        if self.streaming:
+            # only metadata, pixels are read strip by strip in split_grid_label()
+            label_info = read_raster_info(self.label_path)
+            self.label_rows, self.label_cols = label_info['rows'], label_info['cols']
+            return
+
         self.label_data = read_label_data(self.label_path)
+        if self.workers > 1:
+            label_data = self.label_data
+            self._shared_memory, self.label_data, self._shared_spec = create_shared_array(label_data.shape, label_data.dtype)
+            self.label_data[...] = label_data
+            del label_data
         self.label_rows = self.label_data.shape[0]
         self.label_cols = self.label_data.shape[1]
 
+    def release_data(self):
+        self.label_data = None
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory.unlink()
+            self._shared_memory, self._shared_spec = None, None
+
+    def __getstate__(self):
+        # pool workers re-attach the shared label raster instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['label_data'] = None
+        state['_shared_memory'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared_spec is not None:
+            self._shared_memory, self.label_data = attach_shared_array(self._shared_spec)
+
     def generate_grid_code(self):
         print("### Generating grid codes for study area...")
         assert (self.label_rows > 0 and self.label_cols > 0)
@@ -68,38 +119,148 @@ class LabelDatasetSplit(object):
         print(f'{self.grid_code.shape[0]} patch searched')
         return self.grid_code
 
+    def apply_occupancy_index(self, occupancy, min_pixel_percent=0.0):
+        """
+        根据占用索引（LabelOccupancyIndex）筛选切片，跳过无标记像元（或类别比例不足）的切片。
+        :param occupancy: LabelOccupancyIndex
+        :param min_pixel_percent:
+        :return:
+        """
+        grid_mask = occupancy.grid_mask(self.grid_code, min_pixel_percent)
+        self.grid_code = self.grid_code[grid_mask]
+
+        print(f'{self.grid_code.shape[0]} of {grid_mask.size} patch occupied')
+        return self.grid_code
+
     def split_grid_label(self):
         print('### Splitting label data into grids...')
-        assert self.label_data
+        assert self.streaming or self.label_data is not None
 
         # create folder for grid data
         if not os.path.exists(self.result_folder):
             os.makedirs(self.result_folder)
 
-        # split raster and write
         num_grid = self.grid_code.shape[0]
-        for gg in tqdm(range(num_grid), desc='Splitting label datasets ...'):
-
-            # folder
-            if num_grid > 10000:
-                sub = gg // 10000
-                write_folder = os.path.join(self.result_folder, '{:0>2d}'.format(sub))
-                if gg % 10000 == 0 and not os.path.exists(write_folder):
-                    os.makedirs(write_folder)
+        if self.output_format == 'npy':
+            make_grid_folders(self.result_folder, num_grid)
+
+        num_item = self._num_strips() if self.streaming else num_grid
+        manifest = ChunkManifest(self.result_folder, manifest_signature(
+            num_item, self.grid_code, label_path=self.label_path, output_format=self.output_format,
+            patch_size=self.patch_size, streaming=self.streaming, strip_patches=self.strip_patches, codec=self.codec))
+        if not self.resume:
+            manifest.reset()
+        if self.workers > 1 or self.resume:
+            run_chunks(self, '_split_grid_chunk', num_item, self.workers, desc='Splitting label datasets ...',
+                       manifest=manifest if self.resume else None)
+            return self.result_folder
+
+        writer = PatchStoreWriter(self.result_folder) if self.output_format == 'store' else None
+        with async_write(self.write_threads):
+            if self.streaming:
+                self._split_grid_stream(writer, 0, self._num_strips(), progress=True)
             else:
-                write_folder = self.result_folder
+                self._split_grid_range(writer, 0, num_grid, progress=True)
+        if writer is not None:
+            writer.close()
+        return self.result_folder
+
+    def _split_grid_chunk(self, start, end, chunk_id):
+        """
+        并行处理的一块切片（流式模式下为条带），集中存储时每块写入独立前缀的分块文件。
+        :return: 处理的条目数
+        """
+        writer = None
+        if self.output_format == 'store':
+            writer = PatchStoreWriter(self.result_folder, prefix='part_{:0>8d}'.format(chunk_id))
+        with async_write(self.write_threads):
+            if self.streaming:
+                self._split_grid_stream(writer, start, end)
+            else:
+                self._split_grid_range(writer, start, end)
+        if writer is not None:
+            writer.close()
+        return chunk_result(end - start, writer)
+
+    def _split_grid_range(self, writer, start, end, progress=False):
+        # split raster and write
+        num_grid = self.grid_code.shape[0]
+        grid_range = range(start, end)
+        if progress:
+            grid_range = tqdm(grid_range, desc='Splitting label datasets ...')
+        for gg in grid_range:
 
             # data
             r_s, r_e, c_s, c_e = self.grid_code[gg, :]
             grid_name = '{:0>5d}_{:0>5d}_{:0>5d}_{:0>5d}'.format(r_s, r_e, c_s, c_e)
             grid_label_data = self.label_data[r_s:r_e, c_s:c_e]
 
-            # save to disk
-            write_path = os.path.join(write_folder, grid_name)
-            write_numpy_array(grid_label_data, write_path)
+            self._write_grid(writer, gg, num_grid, grid_name, grid_label_data)
         # for
 
-        return self.result_folder
+        return end - start
+
+    def _write_grid(self, writer, gg, num_grid, grid_name, grid_label_data):
+        if writer is not None:
+            writer.write(grid_name, grid_label_data)
+            return
+
+        # folder
+        if num_grid > 10000:
+            sub = gg // 10000
+            write_folder = os.path.join(self.result_folder, '{:0>2d}'.format(sub))
+            if gg % 10000 == 0 and not os.path.exists(write_folder):
+                os.makedirs(write_folder)
+        else:
+            write_folder = self.result_folder
+
+        # save to disk
+        write_path = os.path.join(write_folder, grid_name)
+        write_numpy_array(grid_label_data, write_path, self.codec)
+
+    def _num_strips(self):
+        rows_patch = self.label_rows // self.patch_size
+        return (rows_patch + self.strip_patches - 1) // self.strip_patches
+
+    def _split_grid_stream(self, writer, start, end, progress=False):
+        """
+        流式空间划分：逐条带窗口读取标记栅格（strip_patches行切片），写出条带内的全部切片。
+        :param writer: 集中存储写入者，None则每个切片一个.npy文件
+        :param start: 起始条带序号
+        :param end: 终止条带序号
+        :param progress: 是否显示进度
+        :return: 处理的条带数
+        """
+        num_grid = self.grid_code.shape[0]
+        rows_patch = self.label_rows // self.patch_size
+        strip_rows = self.strip_patches * self.patch_size
+        strip_cols = (self.label_cols // self.patch_size) * self.patch_size
+        # grids of strip rr are grid_code[strip_bounds[rr]:strip_bounds[rr + 1]]
+        strip_bounds = np.searchsorted(self.grid_code[:, 0], np.arange(self._num_strips() + 1) * strip_rows)
+
+        strip_range = range(start, end)
+        if progress:
+            strip_range = tqdm(strip_range, desc='Splitting label strips ...')
+        strip_data = None
+        for rr in strip_range:
+            grid_start, grid_end = strip_bounds[rr], strip_bounds[rr + 1]
+            if grid_start == grid_end:
+                continue
+            row_start = rr * strip_rows
+            window_rows = min(strip_rows, rows_patch * self.patch_size - row_start)
+            if strip_data is not None and strip_data.shape[0] != window_rows:
+                # the last strip may hold fewer patch rows
+                strip_data = None
+            strip_data = read_label_window(self.label_path, 0, row_start, strip_cols, window_rows, buf_obj=strip_data)
+
+            for gg in range(grid_start, grid_end):
+                r_s, r_e, c_s, c_e = self.grid_code[gg, :]
+                grid_name = '{:0>5d}_{:0>5d}_{:0>5d}_{:0>5d}'.format(r_s, r_e, c_s, c_e)
+                self._write_grid(writer, gg, num_grid, grid_name, strip_data[r_s - row_start:r_e - row_start, c_s:c_e])
+            # for
+        # for
+
+        return end - start
 
 
 def main():
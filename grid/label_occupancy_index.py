@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for time-series dataset
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+import warnings
+from tqdm import tqdm
+from osgeo import gdal
+
+from raster_util import read_raster_info, read_label_window
+
+warnings.filterwarnings('ignore')
+os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
+os.environ['PROJ_LIB'] = r'D:\develop-envi\anaconda3\envs\py38\Lib\site-packages\pyproj\proj_dir\share\proj'
+gdal.UseExceptions()
+
+# 类别数上限；最大值远超该值的栅格多为地块ID（RSTIZE_ID）栅格，不应建立类别直方图
+MAX_NUM_CLASSES = 4096
+
+
+def parse_grid_names(grid_name_list):
+    """
+    将切片名称'{r_s}_{r_e}_{c_s}_{c_e}'解析为(N, 4)的切片编码。
+    :param grid_name_list:
+    :return:
+    """
+    grid_code = np.zeros((len(grid_name_list), 4), dtype=np.int64)
+    for gg, name in enumerate(grid_name_list):
+        grid_code[gg, :] = [int(ss) for ss in name.split('_')[-4:]]
+    return grid_code
+
+
+class LabelOccupancyIndex(object):
+    """
+    切片类别直方图（占用索引）。
+    按条带流式读取一次标记栅格，对每个切片统计各类别像元数，得到(N_grids, N_classes)的计数矩阵并压缩保存。
+    后续的划分、分层阶段据此跳过无标记或类别比例不足的切片，无需读取其像元。
+    """
+    def __init__(self, label_path, index_path, patch_size=32, num_classes=None):
+        """
+        初始化
+        :param label_path: 标记栅格（类别栅格）
+        :param index_path: 索引文件（.npz）
+        :param patch_size: 切片大小
+        :param num_classes: 类别数（最大类别值+1），None则由栅格统计得到
+        """
+        self.label_path = label_path
+        self.index_path = index_path
+        self.patch_size = patch_size
+        self.num_classes = num_classes
+
+        self.label_rows, self.label_cols = 0, 0
+        self.grid_code = None
+        self.class_counts = None
+
+    def prepare_data(self):
+        label_info = read_raster_info(self.label_path)
+        self.label_rows, self.label_cols = label_info['rows'], label_info['cols']
+
+        if self.num_classes is None:
+            label_ds = gdal.Open(self.label_path, gdal.GA_ReadOnly)
+            _, label_max = label_ds.GetRasterBand(1).ComputeRasterMinMax(False)
+            label_ds = None
+            self.num_classes = int(label_max) + 1
+        assert (self.num_classes <= MAX_NUM_CLASSES), \
+            f'{self.num_classes} classes in {self.label_path}, a parcel ID raster is not a class raster'
+
+    def generate_grid_code(self):
+        print("### Generating grid codes for study area...")
+        assert (self.label_rows > 0 and self.label_cols > 0)
+
+        rows_patch = self.label_rows // self.patch_size
+        cols_patch = self.label_cols // self.patch_size
+        row_start = np.repeat(np.arange(rows_patch), cols_patch) * self.patch_size
+        col_start = np.tile(np.arange(cols_patch), rows_patch) * self.patch_size
+        self.grid_code = np.stack([row_start, row_start + self.patch_size,
+                                   col_start, col_start + self.patch_size], axis=1).astype(np.int64)
+
+        print(f'{self.grid_code.shape[0]} patch searched')
+        return self.grid_code
+
+    def count_grid_classes(self):
+        """
+        逐条带统计每个切片的类别像元数。条带内以(切片列号*类别数+类别)为键做一次bincount，得到该条带全部切片的直方图。
+        :return: (N_grids, N_classes)计数矩阵
+        """
+        print('### Counting classes of grids...')
+
+        rows_patch = self.label_rows // self.patch_size
+        cols_patch = self.label_cols // self.patch_size
+        strip_cols = cols_patch * self.patch_size
+        num_classes = self.num_classes
+
+        # a full patch of one class is patch_size ** 2 pixels
+        count_dtype = np.uint16 if self.patch_size ** 2 <= np.iinfo(np.uint16).max else np.uint32
+        self.class_counts = np.zeros((rows_patch * cols_patch, num_classes), dtype=count_dtype)
+        grid_col_key = (np.arange(strip_cols) // self.patch_size) * num_classes
+
+        strip_data = None
+        for rr in tqdm(range(rows_patch), desc='Counting label strips ...'):
+            strip_data = read_label_window(self.label_path, 0, rr * self.patch_size, strip_cols, self.patch_size,
+                                           buf_obj=strip_data)
+            assert (strip_data.max() < num_classes)
+
+            strip_keys = grid_col_key[np.newaxis, :] + strip_data.astype(np.int64)
+            strip_counts = np.bincount(strip_keys.ravel(), minlength=cols_patch * num_classes)
+            self.class_counts[rr * cols_patch:(rr + 1) * cols_patch, :] = strip_counts.reshape(cols_patch, num_classes)
+        # for
+
+        return self.class_counts
+
+    def save(self):
+        parent_dir = os.path.dirname(self.index_path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+
+        np.savez_compressed(self.index_path, class_counts=self.class_counts, grid_code=self.grid_code,
+                            patch_size=self.patch_size, label_shape=(self.label_rows, self.label_cols))
+        print(f'### Occupancy index saved on {self.index_path}')
+        return self.index_path
+
+    @staticmethod
+    def load(index_path):
+        """
+        读取已保存的索引。
+        :param index_path:
+        :return: LabelOccupancyIndex
+        """
+        index_data = np.load(index_path)
+        occupancy = LabelOccupancyIndex(None, index_path, int(index_data['patch_size']))
+        occupancy.class_counts = index_data['class_counts']
+        occupancy.grid_code = index_data['grid_code']
+        occupancy.num_classes = occupancy.class_counts.shape[1]
+        occupancy.label_rows, occupancy.label_cols = [int(vv) for vv in index_data['label_shape']]
+        return occupancy
+
+    def occupied(self, min_pixel_percent=0.0):
+        """
+        每个切片是否含有像元比例大于min_pixel_percent的非0类别。
+        :param min_pixel_percent: 0则只要有标记像元即可
+        :return: (N_grids,) bool
+        """
+        patch_size2 = self.patch_size * self.patch_size
+        return (self.class_counts[:, 1:] / patch_size2 > min_pixel_percent).any(axis=1)
+
+    def grid_mask(self, grid_code, min_pixel_percent=0.0):
+        """
+        按切片编码查询是否占用。
+        :param grid_code: (N, 4)切片编码
+        :param min_pixel_percent:
+        :return: (N,) bool
+        """
+        cols_patch = self.label_cols // self.patch_size
+        grid_index = (grid_code[:, 0] // self.patch_size) * cols_patch + grid_code[:, 2] // self.patch_size
+        return self.occupied(min_pixel_percent)[grid_index]
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    patch_size = 32
+    label_path = r'K:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\polygon_rasterize\parcel_dirong_maincrop_removesmall_utm_label40.tif'
+    index_path = r'K:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\polygon_rasterize\parcel_dirong_label40_occupancy_32.npz'
+
+    #######################################################
+    # do
+    loi = LabelOccupancyIndex(label_path, index_path, patch_size)
+    loi.prepare_data()
+    loi.generate_grid_code()
+    loi.count_grid_classes()
+    loi.save()
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for time-series dataset
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import numpy as np
+from osgeo import gdal, gdal_array
+
+gdal.UseExceptions()
+
+RESAMPLE_ALGS = {
+    'nearest': gdal.GRIORA_NearestNeighbour,
+    'bilinear': gdal.GRIORA_Bilinear,
+    'cubic': gdal.GRIORA_Cubic,
+    'average': gdal.GRIORA_Average,
+}
+
+
+class PatchHarmonise(object):
+    """
+    切片分辨率统一。
+    将不同分辨率的来源切片（如20m与10m波段）统一到patch_size，并直接写入预分配输出数组中各自的波段区间：
+    整数倍时为步长广播（赋值给输出的(C, p, f, p, f)视图，无中间数组）；非整数倍时以GDAL重采样读入输出区间；
+    分辨率与数据类型都相同时只是一次赋值，不做多余的类型转换。
+    """
+    def __init__(self, patch_size=32, resample_alg='bilinear'):
+        """
+        初始化
+        :param patch_size: 输出切片大小
+        :param resample_alg: 非整数倍时的GDAL重采样方法，'nearest'、'bilinear'、'cubic'或'average'
+        """
+        assert (resample_alg in RESAMPLE_ALGS)
+        self.patch_size = patch_size
+        self.resample_alg = resample_alg
+
+    def allocate(self, source_list, dtype=None):
+        """
+        按来源切片分配输出数组。
+        :param source_list: 来源切片列表，每个形状为(C_i, p_i, p_i)
+        :param dtype: 输出数据类型，None则为各来源数据类型的公共类型
+        :return: (sum(C_i), P, P)
+        """
+        num_band = sum(source.shape[0] for source in source_list)
+        if dtype is None:
+            dtype = np.result_type(*[source.dtype for source in source_list])
+        return np.empty((num_band, self.patch_size, self.patch_size), dtype=dtype)
+
+    def write_into(self, source, out):
+        """
+        将一个来源切片统一分辨率后写入out。
+        :param source: (C, p, p)
+        :param out: (C, P, P)，C连续
+        :return: out
+        """
+        grid_size = source.shape[-1]
+        assert (source.shape[-2] == grid_size)
+        assert (out.shape == (source.shape[0], self.patch_size, self.patch_size) and out.flags.c_contiguous)
+
+        if grid_size == self.patch_size:
+            out[...] = source
+        elif self.patch_size % grid_size == 0:
+            factor = self.patch_size // grid_size
+            out.reshape(source.shape[0], grid_size, factor, grid_size, factor)[...] = \
+                source[:, :, np.newaxis, :, np.newaxis]
+        else:
+            self._resample_into(source, out)
+        return out
+
+    def _resample_into(self, source, out):
+        """
+        非整数倍：将来源切片作为内存栅格，由GDAL重采样读入out的每个波段。
+        :return:
+        """
+        source_ds = gdal_array.OpenArray(np.ascontiguousarray(source))
+        for bb in range(source.shape[0]):
+            source_ds.GetRasterBand(bb + 1).ReadAsArray(buf_xsize=self.patch_size, buf_ysize=self.patch_size,
+                                                        buf_obj=out[bb],
+                                                        resample_alg=RESAMPLE_ALGS[self.resample_alg])
+        source_ds = None
+        return out
+
+    def harmonise(self, source_list, out=None, dtype=None):
+        """
+        将多个来源切片依次写入out中各自的波段区间（代替统一分辨率后再np.concatenate）。
+        :param source_list: 来源切片列表
+        :param out: 可复用的输出数组，None则分配
+        :param dtype: out为None时的输出数据类型
+        :return: out
+        """
+        if out is None:
+            out = self.allocate(source_list, dtype)
+
+        channel = 0
+        for source in source_list:
+            num_band = source.shape[0]
+            self.write_into(source, out[channel:channel + num_band])
+            channel += num_band
+        assert (channel == out.shape[0])
+        return out
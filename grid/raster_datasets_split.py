@@ -13,7 +13,12 @@ from tqdm import tqdm
 from osgeo import gdal
 
 from raster_util import read_raster_list, read_label_data, write_patch_sample
-from raster_util import load_numpy_array, write_numpy_array
+from raster_util import read_raster_list_info, read_raster_list_window, raster_list_dtype, open_raster_list
+from raster_util import load_numpy_array, write_numpy_array, async_write
+from patch_store import PatchStoreWriter
+from parallel_util import run_chunks, make_grid_folders, create_shared_array, attach_shared_array
+from parallel_util import ChunkManifest, chunk_result, manifest_signature
+from grid.label_occupancy_index import LabelOccupancyIndex
 
 warnings.filterwarnings('ignore')
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
@@ -25,18 +30,44 @@ class RasterDatasetsSplit(object):
     """
     栅格数据空间划分。（不重叠，不留空）
     将输入的栅格数据集，按照指定的分块大小，空间划分，并保存到指定目录。
+    流式模式下不整体读入栅格，而是每次窗口读取strip_patches*patch_size行的条带，内存占用约为T*B*strip_patches*patch_size*W。
+    输出格式为'npy'时每个切片一个.npy文件；为'store'时所有切片写入结果目录下的集中存储（见patch_store）。
+    workers>1时，切片（流式模式下为条带）分块后由进程池并行处理；非流式模式下栅格读入共享内存，各进程直接挂接而不序列化。
+    native_dtype时切片保持源数据类型（如UInt16，体积为float32的一半），nodata为nodata_fill或源nodata值，转换为浮点推迟到训练时进行。
     """
-    def __init__(self, raster_list, result_folder, patch_size=32):
+    def __init__(self, raster_list, result_folder, patch_size=32, streaming=False, output_format='npy', workers=1,
+                 write_threads=0, native_dtype=False, nodata_fill=None, codec=None, strip_patches=1, resume=False):
         """
         初始化
         :param raster_list: 栅格数据列表
         :param result_folder: 结果数据目录
         :param patch_size: 分片大小
+        :param streaming: 是否按条带流式读取与划分
+        :param output_format: 'npy'或'store'
+        :param workers: 并行进程数
+        :param write_threads: 后台写盘线程数，0为同步写出
+        :param native_dtype: 是否保持源数据类型，否则转换为float32且nodata为NaN
+        :param nodata_fill: nodata填充值，None则float32时为NaN、源数据类型时保持原值
+        :param codec: 'npy'切片的压缩编码（见patch_codec），如'shuffle+zstd'，None为不压缩
+        :param strip_patches: 流式模式下每个条带包含的切片行数（见memory_planner）
+        :param resume: 分块处理并记录已完成块的清单（见parallel_util.ChunkManifest），中断后重新运行时跳过已完成的块
         """
+        assert (output_format in ('npy', 'store'))
         self.raster_path_list = raster_list
         self.result_folder = result_folder
+        self.streaming = streaming
+        self.output_format = output_format
+        self.workers = workers
+        self.write_threads = write_threads
+        self.native_dtype = native_dtype
+        self.nodata_fill = nodata_fill
+        self.codec = codec
+        self.strip_patches = strip_patches
+        self.resume = resume
 
         self.raster_data = None
+        self.raster_info_list = None
+        self._shared_memory, self._shared_spec = None, None
         self.grid_code = None
         self.raster_rows, self.raster_cols = 0, 0
 
@@ -47,12 +78,50 @@ class RasterDatasetsSplit(object):
         读入栅格数据
         :return:
         """
-        # todo check the list of raster
+        if self.streaming:
+            # only metadata, pixels are read strip by strip in split_grid_raster()
+            self.raster_info_list = read_raster_list_info(self.raster_path_list)
+            self.raster_rows = self.raster_info_list[0]['rows']
+            self.raster_cols = self.raster_info_list[0]['cols']
+            return
 
-        self.raster_data = read_raster_list(self.raster_path_list)
+        if self.workers > 1:
+            # read straight into shared memory, so the pool workers can attach it without pickling
+            self.raster_info_list = read_raster_list_info(self.raster_path_list)
+            num_band = sum(info['bands'] for info in self.raster_info_list)
+            rows, cols = self.raster_info_list[0]['rows'], self.raster_info_list[0]['cols']
+            raster_dtype = raster_list_dtype(self.raster_info_list, self.native_dtype)
+            self._shared_memory, self.raster_data, self._shared_spec = create_shared_array((num_band, rows, cols), raster_dtype)
+            read_raster_list_window(self.raster_info_list, 0, 0, cols, rows, buf_obj=self.raster_data,
+                                    nodata_fill=self.nodata_fill)
+        else:
+            self.raster_data = read_raster_list(self.raster_path_list, self.native_dtype, self.nodata_fill)
         self.raster_rows = self.raster_data.shape[1]
         self.raster_cols = self.raster_data.shape[2]
 
+    def release_data(self):
+        """
+        释放读入的栅格数据（及共享内存）。
+        :return:
+        """
+        self.raster_data = None
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory.unlink()
+            self._shared_memory, self._shared_spec = None, None
+
+    def __getstate__(self):
+        # pool workers re-attach the shared raster instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['raster_data'] = None
+        state['_shared_memory'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared_spec is not None:
+            self._shared_memory, self.raster_data = attach_shared_array(self._shared_spec)
+
     def generate_grid_code(self):
         """
         根据栅格数据大小，生成分块编码。编码记录[起始行，终止行，起始列，终止列]
@@ -77,6 +146,68 @@ class RasterDatasetsSplit(object):
         print(f'{self.grid_code.shape[0]} patch searched')
         return self.grid_code
 
+    def apply_occupancy_index(self, occupancy, min_pixel_percent=0.0):
+        """
+        根据占用索引（LabelOccupancyIndex）筛选切片，只保留含有标记像元（或类别比例大于min_pixel_percent）的切片。
+        :param occupancy: LabelOccupancyIndex
+        :param min_pixel_percent:
+        :return:
+        """
+        grid_mask = occupancy.grid_mask(self.grid_code, min_pixel_percent)
+        self.grid_code = self.grid_code[grid_mask]
+
+        print(f'{self.grid_code.shape[0]} of {grid_mask.size} patch occupied')
+        return self.grid_code
+
+    def restrict_to_labelled(self, label_source, min_pixel_percent=0.0):
+        """
+        标记驱动的稀疏划分：只划分含有标记像元的切片。流式模式下，栅格读取与切片写出都只针对这些切片，
+        同一条带内相邻的切片合并为连续窗口读取；非流式模式下只减少写出。
+        :param label_source: 标记栅格路径，或已保存的占用索引（.npz）路径
+        :param min_pixel_percent: 类别像元比例阈值，0则只要有标记像元即可
+        :return:
+        """
+        if label_source.endswith('.npz'):
+            occupancy = LabelOccupancyIndex.load(label_source)
+        else:
+            occupancy = LabelOccupancyIndex(label_source, None, self.patch_size)
+            occupancy.prepare_data()
+            occupancy.generate_grid_code()
+            occupancy.count_grid_classes()
+        assert (occupancy.patch_size == self.patch_size)
+        assert ((occupancy.label_rows, occupancy.label_cols) == (self.raster_rows, self.raster_cols))
+
+        return self.apply_occupancy_index(occupancy, min_pixel_percent)
+
+    def _grid_write_folder(self, gg, num_grid):
+        """
+        切片数量过多时，每10000个切片存放于一个子目录。
+        :param gg: 切片序号
+        :param num_grid: 切片总数
+        :return:
+        """
+        if num_grid > 10000:
+            sub = gg // 10000
+            write_folder = os.path.join(self.result_folder, '{:0>2d}'.format(sub))
+            if gg % 10000 == 0 and not os.path.exists(write_folder):
+                os.makedirs(write_folder)
+        else:
+            write_folder = self.result_folder
+        return write_folder
+
+    def _write_grid(self, writer, gg, num_grid, grid_name, grid_raster_data):
+        """
+        写出一个切片，writer不为None时写入集中存储。
+        :return:
+        """
+        if writer is not None:
+            writer.write(grid_name, grid_raster_data)
+            return
+
+        write_folder = self._grid_write_folder(gg, num_grid)
+        write_path = os.path.join(write_folder, grid_name)
+        write_numpy_array(grid_raster_data, write_path, self.codec)
+
     def split_grid_raster(self):
         """
         空间划分。
@@ -89,18 +220,69 @@ class RasterDatasetsSplit(object):
         if not os.path.exists(self.result_folder):
             os.makedirs(self.result_folder)
 
+        # windows of a strip may span several patch rows, so grids are not always written in order
+        if self.output_format == 'npy':
+            make_grid_folders(self.result_folder, self.grid_code.shape[0])
+
+        num_item = self._num_strips() if self.streaming else self.grid_code.shape[0]
+        manifest = ChunkManifest(self.result_folder, manifest_signature(
+            num_item, self.grid_code, raster_list=list(self.raster_path_list), output_format=self.output_format,
+            patch_size=self.patch_size, streaming=self.streaming, strip_patches=self.strip_patches,
+            native_dtype=self.native_dtype, codec=self.codec))
+        if not self.resume:
+            manifest.reset()
+        if self.workers > 1 or self.resume:
+            run_chunks(self, '_split_grid_chunk', num_item, self.workers, desc='Splitting raster datasets ...',
+                       manifest=manifest if self.resume else None)
+            return self.result_folder
+
+        writer = PatchStoreWriter(self.result_folder) if self.output_format == 'store' else None
+        with async_write(self.write_threads):
+            if self.streaming:
+                self._split_grid_raster_stream(writer)
+            else:
+                self._split_grid_raster_mem(writer)
+        if writer is not None:
+            writer.close()
+
+        return self.result_folder
+
+    def _split_grid_chunk(self, start, end, chunk_id):
+        """
+        并行处理的一块：非流式模式下为切片序号区间，流式模式下为条带序号区间。
+        集中存储时每块写入独立前缀的分块文件，输出命名与进程调度无关。
+        :return: 处理的条目数
+        """
+        writer = None
+        if self.output_format == 'store':
+            writer = PatchStoreWriter(self.result_folder, prefix='part_{:0>8d}'.format(chunk_id))
+
+        with async_write(self.write_threads):
+            if self.streaming:
+                self._split_grid_raster_stream(writer, start, end, progress=False)
+            else:
+                self._split_grid_raster_mem(writer, start, end, progress=False)
+
+        if writer is not None:
+            writer.close()
+        return chunk_result(end - start, writer)
+
+    def _split_grid_raster_mem(self, writer=None, start=0, end=None, progress=True):
+        """
+        对已整体读入的栅格进行空间划分。
+        :param writer: 集中存储写入者，None则每个切片一个.npy文件
+        :param start: 起始切片序号
+        :param end: 终止切片序号，None为全部
+        :param progress: 是否显示进度
+        :return:
+        """
         # split raster and write
         num_grid = self.grid_code.shape[0]
-        for gg in tqdm(range(num_grid), desc='Splitting raster datasets ...'):
-
-            # folder
-            if num_grid > 10000:
-                sub = gg // 10000
-                write_folder = os.path.join(self.result_folder, '{:0>2d}'.format(sub))
-                if gg % 10000 == 0 and not os.path.exists(write_folder):
-                    os.makedirs(write_folder)
-            else:
-                write_folder = self.result_folder
+        end = num_grid if end is None else end
+        grid_range = range(start, end)
+        if progress:
+            grid_range = tqdm(grid_range, desc='Splitting raster datasets ...')
+        for gg in grid_range:
 
             # data
             r_s, r_e, c_s, c_e = self.grid_code[gg, :]
@@ -108,8 +290,78 @@ class RasterDatasetsSplit(object):
             grid_raster_data = self.raster_data[:, r_s:r_e, c_s:c_e]
 
             # save to disk
-            write_path = os.path.join(write_folder, grid_name)
-            write_numpy_array(grid_raster_data, write_path)
+            self._write_grid(writer, gg, num_grid, grid_name, grid_raster_data)
+        # for
+
+        return self.result_folder
+
+    def _num_strips(self):
+        rows_patch = self.raster_rows // self.patch_size
+        return (rows_patch + self.strip_patches - 1) // self.strip_patches
+
+    def _split_grid_raster_stream(self, writer=None, start=0, end=None, progress=True):
+        """
+        流式空间划分。grid_code按行优先排列，每次窗口读取strip_patches行切片对应的条带，写出该条带的全部切片后再读下一条带。
+        grid_code经占用索引筛选后，不含切片的条带不再读取，条带内只读取由相邻切片列合并而成的连续窗口。
+        :param writer: 集中存储写入者，None则每个切片一个.npy文件
+        :param start: 起始条带序号
+        :param end: 终止条带序号，None为全部
+        :param progress: 是否显示进度
+        :return:
+        """
+        num_grid = self.grid_code.shape[0]
+        rows_patch = self.raster_rows // self.patch_size
+        cols_patch = self.raster_cols // self.patch_size
+        strip_rows = self.strip_patches * self.patch_size
+        # grids of strip rr are grid_code[strip_bounds[rr]:strip_bounds[rr + 1]]
+        strip_bounds = np.searchsorted(self.grid_code[:, 0], np.arange(self._num_strips() + 1) * strip_rows)
+
+        # flat buffer, every window of every strip is read into a contiguous view of it
+        num_band = sum(info['bands'] for info in self.raster_info_list)
+        strip_cols = cols_patch * self.patch_size
+        strip_buffer = np.empty(num_band * strip_rows * strip_cols,
+                                dtype=raster_list_dtype(self.raster_info_list, self.native_dtype))
+
+        # the T datasets are opened once for all windows of this chunk of strips
+        opened_info_list = open_raster_list(self.raster_info_list)
+
+        end = self._num_strips() if end is None else end
+        strip_range = range(start, end)
+        if progress:
+            strip_range = tqdm(strip_range, desc='Splitting raster strips ...')
+        for rr in strip_range:
+            grid_start, grid_end = strip_bounds[rr], strip_bounds[rr + 1]
+            if grid_start == grid_end:
+                continue
+            row_start = rr * strip_rows
+            window_rows = min(strip_rows, rows_patch * self.patch_size - row_start)
+
+            # runs of horizontally adjacent grid columns (over all patch rows of the strip), each read as one window
+            strip_code = self.grid_code[grid_start:grid_end]
+            strip_col = np.unique(strip_code[:, 2])
+            run_breaks = np.flatnonzero(np.diff(strip_col) != self.patch_size) + 1
+            run_starts = strip_col[np.concatenate([[0], run_breaks])]
+            run_ends = strip_col[np.concatenate([run_breaks, [strip_col.size]]) - 1] + self.patch_size
+            grid_run = np.searchsorted(run_starts, strip_code[:, 2], side='right') - 1
+
+            for run, (window_start, window_end) in enumerate(zip(run_starts, run_ends)):
+                window_cols = window_end - window_start
+                window_data = strip_buffer[:num_band * window_rows * window_cols]
+                window_data = window_data.reshape(num_band, window_rows, window_cols)
+                read_raster_list_window(opened_info_list, window_start, row_start, window_cols, window_rows,
+                                        buf_obj=window_data, nodata_fill=self.nodata_fill)
+
+                for gg in grid_start + np.flatnonzero(grid_run == run):
+
+                    # data
+                    r_s, r_e, c_s, c_e = self.grid_code[gg, :]
+                    grid_name = '{:0>5d}_{:0>5d}_{:0>5d}_{:0>5d}'.format(r_s, r_e, c_s, c_e)
+                    grid_raster_data = window_data[:, r_s - row_start:r_e - row_start, c_s - window_start:c_e - window_start]
+
+                    # save to disk
+                    self._write_grid(writer, gg, num_grid, grid_name, grid_raster_data)
+                # for
+            # for
         # for
 
         return self.result_folder
@@ -13,7 +13,10 @@ from tqdm import tqdm
 from osgeo import gdal
 
 from raster_util import read_label_data, write_patch_sample
-from raster_util import write_numpy_array, load_numpy_array
+from raster_util import write_numpy_array, load_numpy_array, NumpyArrayReader, async_write
+from parallel_util import run_chunks, make_grid_folders, ChunkManifest, manifest_signature
+from grid.virtual_layer_stack import VirtualLayerStack
+from grid.patch_harmonise import PatchHarmonise
 
 warnings.filterwarnings('ignore')
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
@@ -25,12 +28,34 @@ class RasterGridLayerStack(object):
     """
     栅格切片堆叠。
     在栅格数据集合切片程序中，由于内存限制而不能一次性对所有栅格集合切片，考虑将其分为多个子集合分别切片，进而合并多个切片。
+    不需要写出堆叠结果时，可用virtual_stack()得到按切片编码读取时组装的虚拟堆叠（见VirtualLayerStack）。
     """
-    def __init__(self, raster_folder_list, result_folder, patch_size=32):
-
+    def __init__(self, raster_folder_list, result_folder, patch_size=32, mmap_mode=None, reuse_buffer=False, workers=1,
+                 write_threads=0, codec=None, dtype=np.float32, resample_alg='bilinear', resume=False):
+        """
+        初始化
+        :param raster_folder_list: 切片目录列表
+        :param result_folder: 结果目录
+        :param patch_size: 切片大小
+        :param mmap_mode: 以内存映射方式读取切片，如'r'
+        :param reuse_buffer: 每个目录复用一个读取缓冲区
+        :param workers: 并行进程数
+        :param write_threads: 后台写盘线程数，0为同步写出
+        :param codec: 切片的压缩编码（见patch_codec），None为不压缩
+        :param dtype: 堆叠结果的数据类型，None则保持来源数据类型（不做转换）
+        :param resample_alg: 来源切片大小不是patch_size的整数分之一时的GDAL重采样方法
+        :param resume: 分块处理并记录已完成块的清单（见parallel_util.ChunkManifest），中断后重新运行时跳过已完成的块
+        """
         self.raster_folder_list = raster_folder_list
         self.result_folder = result_folder
         self.patch_size = patch_size
+        self.reader = NumpyArrayReader(mmap_mode, reuse_buffer)
+        self.workers = workers
+        self.write_threads = write_threads
+        self.codec = codec
+        self.dtype = dtype
+        self.harmonise = PatchHarmonise(patch_size, resample_alg)
+        self.resume = resume
 
         self.grid_code_list = []
 
@@ -45,7 +70,8 @@ class RasterGridLayerStack(object):
         # fast version
         item_list = os.listdir(folder)
         for path in item_list:
-            self.grid_code_list.append(path[:-4])
+            if path.endswith(filter_ext):
+                self.grid_code_list.append(path[:-4])
         self.grid_code_list.sort()
 
         # item_list = os.listdir(folder)
@@ -58,23 +84,26 @@ class RasterGridLayerStack(object):
 
         return self.grid_code_list
 
-    @staticmethod
-    def _warp_raster_grid_data(grid_array, target_size):
+    def virtual_stack(self):
+        """
+        不写出堆叠结果，返回相同目录列表的虚拟堆叠，训练读取可直接使用。数据类型与layerstack_raster_data()的写出结果一致。
+        :return: VirtualLayerStack
+        """
+        stack = VirtualLayerStack(self.raster_folder_list, self.patch_size, mmap_mode='r', dtype=self.dtype,
+                                  resample_alg=self.harmonise.resample_alg)
+        stack.list_grid_codes()
+        return stack
+
+    def _warp_raster_grid_data(self, grid_array):
         """
         对要堆叠的数据进行包装处理，比如数据类型、空间插值等。
+        堆叠时各来源直接写入输出数组（见_layerstack_grid_range），本方法用于单独处理一个切片。
         :param grid_array:
-        :param target_size:
         :return:
         """
-        grid_row, grid_col = grid_array.shape[1], grid_array.shape[2]
-        assert(grid_row == grid_col)
-        assert(target_size % grid_row == 0)
-
-        if grid_row != target_size:
-            factor = int(target_size / grid_row)
-            grid_array = grid_array.repeat(factor, axis=-1).repeat(factor, axis=-2)
-
-        return grid_array.astype(np.float32)
+        if grid_array.shape[-1] == self.patch_size and (self.dtype is None or grid_array.dtype == self.dtype):
+            return grid_array
+        return self.harmonise.harmonise([grid_array], dtype=self.dtype)
 
     def layerstack_raster_data(self):
         """
@@ -90,7 +119,36 @@ class RasterGridLayerStack(object):
 
         # combine grid data
         num_grid = len(self.grid_code_list)
-        for gg, code in tqdm(enumerate(self.grid_code_list)):
+        manifest = ChunkManifest(combine_folder, manifest_signature(
+            num_grid, self.grid_code_list, raster_folder_list=list(self.raster_folder_list), patch_size=self.patch_size,
+            dtype=None if self.dtype is None else np.dtype(self.dtype).str, codec=self.codec))
+        if not self.resume:
+            manifest.reset()
+        if self.workers > 1 or self.resume:
+            make_grid_folders(combine_folder, num_grid)
+            run_chunks(self, '_layerstack_grid_chunk', num_grid, self.workers, desc='Layer-stacking grids ...',
+                       manifest=manifest if self.resume else None)
+        else:
+            with async_write(self.write_threads):
+                self._layerstack_grid_range(combine_folder, 0, num_grid, progress=True)
+
+        print('### Combining grid samples complete!')
+        return combine_folder
+
+    def _layerstack_grid_chunk(self, start, end, chunk_id):
+        first_folder = os.path.basename(self.raster_folder_list[0])
+        combine_folder = os.path.join(self.result_folder, first_folder)
+        with async_write(self.write_threads):
+            return self._layerstack_grid_range(combine_folder, start, end)
+
+    def _layerstack_grid_range(self, combine_folder, start, end, progress=False):
+        num_grid = len(self.grid_code_list)
+        grid_range = range(start, end)
+        if progress:
+            grid_range = tqdm(grid_range)
+        all_raster_grid_data = None
+        for gg in grid_range:
+            code = self.grid_code_list[gg]
             print(f'Grid {code}')
 
             # target folder
@@ -102,22 +160,22 @@ class RasterGridLayerStack(object):
             else:
                 write_folder = combine_folder
 
-            # load raster grid data
+            # load raster grid data, each one harmonised straight into its band range of the stacked patch
             raster_grid_data_list = []
-            for folder in self.raster_folder_list:
+            for ff, folder in enumerate(self.raster_folder_list):
                 raster_grid_path = os.path.join(folder, code + '.npy')
-                raster_grid_data = load_numpy_array(raster_grid_path)
-                raster_grid_data = self._warp_raster_grid_data(raster_grid_data, self.patch_size)
-                raster_grid_data_list.append(raster_grid_data)
-            all_raster_grid_data = np.concatenate(raster_grid_data_list, axis=0)
+                raster_grid_data_list.append(self.reader.read(raster_grid_path, slot=ff))
+            if all_raster_grid_data is None or self.write_threads > 0:
+                # background writes keep a reference to the patch, so it is not reused then
+                all_raster_grid_data = self.harmonise.allocate(raster_grid_data_list, self.dtype)
+            self.harmonise.harmonise(raster_grid_data_list, all_raster_grid_data)
 
             # save to disk
             write_path = os.path.join(write_folder, code)
-            write_numpy_array(all_raster_grid_data, write_path)
+            write_numpy_array(all_raster_grid_data, write_path, self.codec)
         # for
 
-        print('### Combining grid samples complete!')
-        return combine_folder
+        return end - start
 
 
 def main():
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for time-series dataset
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import warnings
+from tqdm import tqdm
+from osgeo import gdal
+
+from raster_util import read_raster_list_info, read_raster_list_window, raster_list_dtype, open_raster_list
+from patch_store import grow_npy_channels
+from parallel_util import make_grid_folders
+from grid.label_occupancy_index import LabelOccupancyIndex
+
+warnings.filterwarnings('ignore')
+os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
+os.environ['PROJ_LIB'] = r'D:\develop-envi\anaconda3\envs\py38\Lib\site-packages\pyproj\proj_dir\share\proj'
+gdal.UseExceptions()
+
+
+class RasterGroupAccumulate(object):
+    """
+    分组累加的栅格数据空间划分。
+    代替“RasterDatasetsSplit按每6个时相分组划分 + RasterGridLayerStack合并”的流程：按group_size个时相一组遍历完整的raster_list，
+    每组按条带窗口读取，并将该组波段直接写入预分配的内存映射输出中其所在的波段区间。遍历一次源栅格即得到最终的堆叠切片，无中间切片目录。
+    输出格式为'npy'时每个切片一个(C, P, P)的.npy文件；为'store'时所有切片为一个(N, C, P, P)的集中存储分块（见patch_store）。
+    'npy'输出中一组波段在文件内是连续的一段，每组对每个切片文件打开一次并写入该段，共N*组数次打开与写入；切片多时宜用'store'。
+    内存占用约为group_size*B*patch_size*W。
+    incremental时，在结果目录旁的'{result_folder}.cache.json'中记录各源栅格的标识（路径、大小、修改时间，或内容哈希）与划分参数；
+    重新运行时只读取新增或变化的时相，新增时相的波段追加到已有输出之后，未变化时相的输出原样保留。
+    """
+    def __init__(self, raster_list, result_folder, patch_size=32, group_size=6, output_format='npy',
+                 native_dtype=False, nodata_fill=None, incremental=False, hash_sources=False):
+        """
+        初始化
+        :param raster_list: 完整的栅格数据列表（全部时相）
+        :param result_folder: 结果数据目录
+        :param patch_size: 分片大小
+        :param group_size: 每组的栅格（时相）数
+        :param output_format: 'npy'或'store'
+        :param native_dtype: 是否保持源数据类型，否则转换为float32且nodata为NaN
+        :param nodata_fill: nodata填充值，None则float32时为NaN、源数据类型时保持原值
+        :param incremental: 是否按缓存增量更新
+        :param hash_sources: 以文件内容哈希（而非大小与修改时间）标识源栅格
+        """
+        assert (output_format in ('npy', 'store'))
+        self.raster_path_list = raster_list
+        self.result_folder = result_folder
+        self.patch_size = patch_size
+        self.group_size = group_size
+        self.output_format = output_format
+        self.native_dtype = native_dtype
+        self.nodata_fill = nodata_fill
+        self.incremental = incremental
+        self.hash_sources = hash_sources
+        self.cache_path = result_folder.rstrip('/\\') + '.cache.json'
+
+        self.raster_info_list = None
+        self.raster_dtype = None
+        self.group_offsets = None
+        self.source_offsets = None
+        self.grid_code = None
+        self.raster_rows, self.raster_cols = 0, 0
+
+    def prepare_data(self):
+        """
+        读取全部栅格的元数据并检查一致性，计算每组在堆叠切片中的起始波段。
+        :return:
+        """
+        self.raster_info_list = read_raster_list_info(self.raster_path_list)
+        self.raster_rows = self.raster_info_list[0]['rows']
+        self.raster_cols = self.raster_info_list[0]['cols']
+        self.raster_dtype = raster_list_dtype(self.raster_info_list, self.native_dtype)
+
+        group_bands = [sum(info['bands'] for info in group) for group in self.raster_groups()]
+        self.group_offsets = np.concatenate([[0], np.cumsum(group_bands)]).astype(np.int64)
+        self.source_offsets = np.concatenate([[0], np.cumsum([info['bands'] for info in self.raster_info_list])])
+        print(f'{len(group_bands)} groups of {self.group_size} rasters, {self.group_offsets[-1]} bands')
+
+    def raster_groups(self):
+        """
+        按group_size划分的栅格元数据分组。
+        :return: list of list
+        """
+        return [self.raster_info_list[ii:ii + self.group_size]
+                for ii in range(0, len(self.raster_info_list), self.group_size)]
+
+    def generate_grid_code(self):
+        """
+        根据栅格数据大小，生成分块编码。编码记录[起始行，终止行，起始列，终止列]
+        :return:
+        """
+        print("### Generating grid codes for study area...")
+        assert (self.raster_rows > 0 and self.raster_cols > 0)
+
+        rows_patch = self.raster_rows // self.patch_size
+        cols_patch = self.raster_cols // self.patch_size
+        row_start = np.repeat(np.arange(rows_patch), cols_patch) * self.patch_size
+        col_start = np.tile(np.arange(cols_patch), rows_patch) * self.patch_size
+        self.grid_code = np.stack([row_start, row_start + self.patch_size,
+                                   col_start, col_start + self.patch_size], axis=1).astype(np.int64)
+
+        print(f'{self.grid_code.shape[0]} patch searched')
+        return self.grid_code
+
+    def apply_occupancy_index(self, occupancy, min_pixel_percent=0.0):
+        """
+        根据占用索引（LabelOccupancyIndex）筛选切片，只保留含有标记像元（或类别比例大于min_pixel_percent）的切片。
+        :param occupancy: LabelOccupancyIndex，或已保存的索引（.npz）路径
+        :param min_pixel_percent:
+        :return:
+        """
+        if isinstance(occupancy, str):
+            occupancy = LabelOccupancyIndex.load(occupancy)
+        grid_mask = occupancy.grid_mask(self.grid_code, min_pixel_percent)
+        self.grid_code = self.grid_code[grid_mask]
+
+        print(f'{self.grid_code.shape[0]} of {grid_mask.size} patch occupied')
+        return self.grid_code
+
+    @staticmethod
+    def grid_name(code):
+        r_s, r_e, c_s, c_e = code
+        return '{:0>5d}_{:0>5d}_{:0>5d}_{:0>5d}'.format(r_s, r_e, c_s, c_e)
+
+    def _grid_path(self, gg, num_grid):
+        """
+        'npy'输出时切片的路径，切片数量过多时每10000个切片存放于一个子目录。
+        :return:
+        """
+        write_folder = self.result_folder
+        if num_grid > 10000:
+            write_folder = os.path.join(self.result_folder, '{:0>2d}'.format(gg // 10000))
+        return os.path.join(write_folder, self.grid_name(self.grid_code[gg]) + '.npy')
+
+    def _create_outputs(self):
+        """
+        预分配输出：'store'为一个(N, C, P, P)的分块文件及其编码文件；'npy'为每个切片一个(C, P, P)的文件。
+        :return: 'store'时为内存映射数组，'npy'时为None
+        """
+        num_grid = self.grid_code.shape[0]
+        grid_shape = (int(self.group_offsets[-1]), self.patch_size, self.patch_size)
+
+        if self.output_format == 'store':
+            np.save(os.path.join(self.result_folder, 'part_00000.keys.npy'),
+                    np.array([self.grid_name(code) for code in self.grid_code]))
+            return np.lib.format.open_memmap(os.path.join(self.result_folder, 'part_00000.npy'), mode='w+',
+                                             dtype=self.raster_dtype, shape=(num_grid,) + grid_shape)
+
+        make_grid_folders(self.result_folder, num_grid)
+        for gg in tqdm(range(num_grid), desc='Allocating grids ...'):
+            grid_array = np.lib.format.open_memmap(self._grid_path(gg, num_grid), mode='w+',
+                                                   dtype=self.raster_dtype, shape=grid_shape)
+            del grid_array
+        return None
+
+    def accumulate_grid_raster(self):
+        """
+        分组累加：逐组、逐条带读取，并写入输出中该组所在的波段区间。
+        :return:
+        """
+        print('### Accumulating raster groups into grids...')
+
+        if not os.path.exists(self.result_folder):
+            os.makedirs(self.result_folder)
+
+        dirty_sources = self._dirty_sources() if self.incremental else None
+        if dirty_sources is None:
+            # full build, an old cache no longer describes the outputs once they are reallocated
+            if os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+            dirty_sources = list(range(len(self.raster_info_list)))
+            store_array = self._create_outputs()
+        else:
+            print(f'{len(dirty_sources)} of {len(self.raster_info_list)} rasters new or changed')
+            store_array = self._grow_outputs()
+
+        dirty_groups = self._dirty_groups(dirty_sources)
+        for gr, group in enumerate(dirty_groups):
+            group_info = [self.raster_info_list[ii] for ii in group]
+            self._accumulate_group(group_info, self.source_offsets[group[0]], self.source_offsets[group[-1] + 1],
+                                   store_array, desc='Accumulating group {}/{} ...'.format(gr + 1, len(dirty_groups)))
+        # for
+
+        if store_array is not None:
+            store_array.flush()
+            del store_array
+        if self.incremental:
+            self._save_cache()
+        return self.result_folder
+
+    def _dirty_groups(self, dirty_sources):
+        """
+        将需要读取的栅格按连续区间、每组不超过group_size个分组（每组在堆叠切片中占一段连续的波段）。
+        :param dirty_sources: 栅格序号列表
+        :return: list of list
+        """
+        group_list = []
+        for ii in dirty_sources:
+            if group_list and group_list[-1][-1] == ii - 1 and len(group_list[-1]) < self.group_size:
+                group_list[-1].append(ii)
+            else:
+                group_list.append([ii])
+        return group_list
+
+    def _source_identity(self, info):
+        """
+        源栅格标识：路径、大小与修改时间，hash_sources时为文件内容的SHA-1。
+        :return: dict
+        """
+        path = os.path.abspath(info['path'])
+        identity = {'path': path, 'size': os.path.getsize(path), 'bands': info['bands']}
+        if self.hash_sources:
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+                    sha1.update(block)
+            identity['sha1'] = sha1.hexdigest()
+        else:
+            identity['mtime'] = os.path.getmtime(path)
+        return identity
+
+    def _grid_params(self):
+        """
+        决定输出布局的划分参数，与缓存不一致时需要全部重建。
+        :return: dict
+        """
+        first_info = self.raster_info_list[0]
+        return {'patch_size': self.patch_size, 'output_format': self.output_format, 'dtype': self.raster_dtype.str,
+                'nodata_fill': None if self.nodata_fill is None else float(self.nodata_fill),
+                'shape': [self.raster_rows, self.raster_cols], 'geo_transform': list(first_info['geo_transform']),
+                'grid_code': hashlib.sha1(np.ascontiguousarray(self.grid_code, dtype=np.int64)).hexdigest()}
+
+    def _dirty_sources(self):
+        """
+        与缓存比较，找出需要读取的栅格（新增，或同一位置上标识变化的）。
+        划分参数变化、栅格被删除或同一位置的波段数变化时返回None，需要全部重建。
+        :return: 栅格序号列表或None
+        """
+        if not os.path.exists(self.cache_path):
+            return None
+        with open(self.cache_path, 'r') as f:
+            cache = json.load(f)
+        if cache['grid_params'] != json.loads(json.dumps(self._grid_params())):
+            print('Grid parameters changed, rebuilding all')
+            return None
+
+        cached_sources = cache['sources']
+        if len(cached_sources) > len(self.raster_info_list):
+            print('Rasters removed from the list, rebuilding all')
+            return None
+        dirty_sources = []
+        for ii, info in enumerate(self.raster_info_list):
+            identity = self._source_identity(info)
+            if ii >= len(cached_sources):
+                dirty_sources.append(ii)
+            elif cached_sources[ii]['bands'] != identity['bands']:
+                print('Band count of {} changed, rebuilding all'.format(info['path']))
+                return None
+            elif cached_sources[ii] != identity:
+                dirty_sources.append(ii)
+        # for
+        return dirty_sources
+
+    def _save_cache(self):
+        cache = {'grid_params': self._grid_params(),
+                 'sources': [self._source_identity(info) for info in self.raster_info_list]}
+        with open(self.cache_path + '.tmp', 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+    def _grow_outputs(self):
+        """
+        将已有输出扩展到当前的总波段数，原有波段不变。
+        'npy'输出只需改写每个文件的文件头并延长文件；'store'输出的波段不是第一维，需复制为新的分块文件。
+        :return: 'store'时为内存映射数组，'npy'时为None
+        """
+        num_grid = self.grid_code.shape[0]
+        num_band = int(self.source_offsets[-1])
+
+        if self.output_format == 'npy':
+            for gg in tqdm(range(num_grid), desc='Growing grids ...'):
+                grow_npy_channels(self._grid_path(gg, num_grid), num_band)
+            return None
+
+        store_path = os.path.join(self.result_folder, 'part_00000.npy')
+        old_array = np.load(store_path, mmap_mode='r')
+        if old_array.shape[1] != num_band:
+            temp_path = store_path + '.grow.npy'
+            new_array = np.lib.format.open_memmap(temp_path, mode='w+', dtype=old_array.dtype,
+                                                  shape=(num_grid, num_band) + old_array.shape[2:])
+            for gg in tqdm(range(0, num_grid, 1024), desc='Growing store ...'):
+                new_array[gg:gg + 1024, :old_array.shape[1]] = old_array[gg:gg + 1024]
+            new_array.flush()
+            del new_array, old_array
+            os.replace(temp_path, store_path)
+        return np.lib.format.open_memmap(store_path, mode='r+')
+
+    @staticmethod
+    def _write_grid_bands(grid_path, band_start, grid_data):
+        """
+        将(C_g, P, P)的连续数组写入.npy切片文件中从band_start开始的波段，不建立内存映射。
+        :return:
+        """
+        with open(grid_path, 'r+b') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                np.lib.format.read_array_header_1_0(f)
+            else:
+                np.lib.format.read_array_header_2_0(f)
+            f.seek(f.tell() + band_start * grid_data[0].nbytes)
+            f.write(grid_data.tobytes())
+
+    def _accumulate_group(self, group_info, band_start, band_end, store_array, desc=''):
+        """
+        一组栅格：按条带窗口读取，条带内的切片写入波段区间[band_start, band_end)。
+        :param group_info: 该组栅格的元数据
+        :param band_start: 该组在堆叠切片中的起始波段
+        :param band_end: 终止波段
+        :param store_array: 'store'输出的内存映射数组，'npy'输出时为None
+        :return:
+        """
+        num_grid = self.grid_code.shape[0]
+        rows_patch = self.raster_rows // self.patch_size
+        cols_patch = self.raster_cols // self.patch_size
+        strip_cols = cols_patch * self.patch_size
+        # grids of strip rr are grid_code[strip_bounds[rr]:strip_bounds[rr + 1]]
+        strip_bounds = np.searchsorted(self.grid_code[:, 0], np.arange(rows_patch + 1) * self.patch_size)
+
+        strip_data = np.empty((band_end - band_start, self.patch_size, strip_cols), dtype=self.raster_dtype)
+        opened_info = open_raster_list(group_info)
+        for rr in tqdm(range(rows_patch), desc=desc):
+            grid_start, grid_end = strip_bounds[rr], strip_bounds[rr + 1]
+            if grid_start == grid_end:
+                continue
+            read_raster_list_window(opened_info, 0, rr * self.patch_size, strip_cols, self.patch_size,
+                                    buf_obj=strip_data, nodata_fill=self.nodata_fill)
+
+            # (C_g, P, cols_patch, P) view of the strip, grids along the third axis
+            strip_grids = strip_data.reshape(strip_data.shape[0], self.patch_size, cols_patch, self.patch_size)
+            grid_cols = self.grid_code[grid_start:grid_end, 2] // self.patch_size
+
+            if store_array is not None:
+                store_array[grid_start:grid_end, band_start:band_end] = strip_grids[:, :, grid_cols, :].transpose(2, 0, 1, 3)
+                continue
+
+            # the group's bands are one contiguous run of each (C, P, P) file, written in place
+            strip_block = np.ascontiguousarray(strip_grids[:, :, grid_cols, :].transpose(2, 0, 1, 3))
+            for gg, grid_data in zip(range(grid_start, grid_end), strip_block):
+                self._write_grid_bands(self._grid_path(gg, num_grid), band_start, grid_data)
+            # for
+        # for
+
+        return band_end - band_start
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    patch_size = 32
+    group_size = 6
+    raster_folder = r'k:\FF\application_dataset\2020-france-agri\s2_l2a_tif_masked\20m_10m'
+    result_folder = r'K:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\01_48'
+    raster_list = sorted(glob.glob(os.path.join(raster_folder, 'L1C_T31TFN_*_masked_10m.tif')))
+
+    #######################################################
+    # do
+    rga = RasterGroupAccumulate(raster_list, result_folder, patch_size, group_size, output_format='store',
+                                native_dtype=True)
+    rga.prepare_data()
+    rga.generate_grid_code()
+    rga.accumulate_grid_raster()
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
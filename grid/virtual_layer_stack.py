@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for time-series dataset
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+import warnings
+
+from raster_util import load_numpy_array
+from patch_store import PatchStore, is_patch_store
+from grid.patch_harmonise import PatchHarmonise
+
+warnings.filterwarnings('ignore')
+
+
+class VirtualLayerStack(object):
+    """
+    虚拟栅格切片堆叠。
+    与RasterGridLayerStack相同地将多个切片目录（或集中存储）沿波段维堆叠，但不写出堆叠结果：按切片编码访问时，
+    从内存映射的各来源切片读取并组装。各来源由PatchHarmonise统一分辨率后直接写入输出数组中各自的波段区间。
+    训练读取可直接使用本对象，RasterGridLayerStack的写出阶段成为可选。
+    """
+    def __init__(self, raster_folder_list, patch_size=32, mmap_mode='r', dtype=None, resample_alg='bilinear'):
+        """
+        初始化
+        :param raster_folder_list: 切片目录（或集中存储目录）列表，堆叠顺序即列表顺序
+        :param patch_size: 堆叠后的切片大小
+        :param mmap_mode: 来源切片的读取方式，None则整体读入
+        :param dtype: 输出数据类型，None则为各来源数据类型的公共类型（不做转换）
+        :param resample_alg: 来源切片大小不是patch_size的整数分之一时的GDAL重采样方法
+        """
+        self.raster_folder_list = raster_folder_list
+        self.patch_size = patch_size
+        self.mmap_mode = mmap_mode
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.harmonise = PatchHarmonise(patch_size, resample_alg)
+
+        self.source_store_list = [PatchStore(folder, mmap_mode) if is_patch_store(folder) else None
+                                  for folder in raster_folder_list]
+        self.source_channels = None
+        self.channel_offsets = None
+
+        self.grid_code_list = []
+        self._code_index = {}
+
+    def list_grid_codes(self):
+        """
+        根据第一个来源生成切片编码。
+        :return:
+        """
+        store = self.source_store_list[0]
+        if store is not None:
+            self.grid_code_list = sorted(store.keys)
+        else:
+            self.grid_code_list = sorted(path[:-4] for path in os.listdir(self.raster_folder_list[0])
+                                         if path.endswith('.npy'))
+        self._code_index = {code: ii for ii, code in enumerate(self.grid_code_list)}
+
+        self._probe_sources()
+        return self.grid_code_list
+
+    def _probe_sources(self):
+        """
+        读取第一个切片的各来源，确定每个来源的波段数、在堆叠中的起始波段及输出数据类型。
+        :return:
+        """
+        if not self.grid_code_list:
+            return
+        source_list = self.source_arrays(self.grid_code_list[0])
+        self.source_channels = [source.shape[0] for source in source_list]
+        self.channel_offsets = np.concatenate([[0], np.cumsum(self.source_channels)]).tolist()
+        if self.dtype is None:
+            self.dtype = np.result_type(*[source.dtype for source in source_list])
+
+    @property
+    def shape(self):
+        """
+        单个堆叠切片的形状(C, P, P)。
+        """
+        return self.channel_offsets[-1], self.patch_size, self.patch_size
+
+    def source_arrays(self, code):
+        """
+        切片在各来源中的数据（内存映射时不读入像元）。
+        :param code: 切片编码
+        :return: list of (C_i, p_i, p_i)
+        """
+        source_list = []
+        for folder, store in zip(self.raster_folder_list, self.source_store_list):
+            if store is not None:
+                source_list.append(store[code])
+            else:
+                source_list.append(load_numpy_array(os.path.join(folder, code + '.npy'), self.mmap_mode))
+        return source_list
+
+    def read(self, code, out=None):
+        """
+        组装堆叠切片，每个来源直接写入输出数组中其所在的波段区间（见PatchHarmonise）。
+        :param code: 切片编码
+        :param out: 可复用的(C, P, P)输出数组
+        :return: (C, P, P)
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        assert (out.shape == self.shape)
+
+        return self.harmonise.harmonise(self.source_arrays(code), out)
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            key = self.grid_code_list[key]
+        return self.read(key)
+
+    def __contains__(self, code):
+        return code in self._code_index
+
+    def __len__(self):
+        return len(self.grid_code_list)
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    patch_size = 32
+    raster_folder_list = [
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\01_06\08',
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\07_12\08',
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\13_18\08',
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\19_24\08',
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\25_30\08',
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\31_36\08',
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\37_42\08',
+        r'k:\FF\application_dataset\2020-france-agri-grid\s2_l2a_tif_masked\grid_20m_10m_32\43_48\08'
+    ]
+
+    #######################################################
+    # do
+    vls = VirtualLayerStack(raster_folder_list, patch_size, dtype=np.float32)
+    vls.list_grid_codes()
+    print(f'{len(vls)} grids, stacked shape {vls.shape}, {vls.dtype}')
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
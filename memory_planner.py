@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory-budget planner for the splitting stages
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import re
+
+from raster_util import read_raster_info, read_raster_list_info, raster_list_dtype
+from grid.raster_datasets_split import RasterDatasetsSplit
+from grid.raster_group_accumulate import RasterGroupAccumulate
+from grid.label_dataset_split import LabelDatasetSplit
+
+
+def parse_memory_size(size):
+    """
+    解析内存大小，如'16GB'、'512MB'、'1.5G'，或字节数。
+    :param size:
+    :return: 字节数
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(size).upper())
+    assert match, f'invalid memory size {size}'
+    scale = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}[match.group(2)]
+    return int(float(match.group(1)) * scale)
+
+
+def format_memory_size(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(num_bytes) < 1024:
+            return '{:.1f}{}'.format(num_bytes, unit)
+        num_bytes /= 1024
+    return '{:.1f}TB'.format(num_bytes)
+
+
+class MemoryPlanner(object):
+    """
+    内存预算规划。
+    只通过GDAL读取栅格元数据（行列数、波段数、数据类型、分块大小），按memory_budget确定一次处理的时相数与条带行数：
+    栅格整体可放入内存时整体读入；否则按条带流式划分，条带尽量大（并按源栅格分块行数对齐）；
+    连一行切片的全部时相都放不下时，按时相分组累加（RasterGroupAccumulate）。标记栅格同样按预算决定是否流式划分。
+    """
+    def __init__(self, raster_list, label_path=None, patch_size=32, memory_budget='8GB', workers=1,
+                 native_dtype=False, reserve_ratio=0.2):
+        """
+        初始化
+        :param raster_list: 栅格数据列表
+        :param label_path: 标记栅格，None则不规划标记划分
+        :param patch_size: 切片大小
+        :param memory_budget: 内存预算，如'16GB'（YAML配置的memory_budget）
+        :param workers: 并行进程数，流式模式下每个进程各有一个条带缓冲区
+        :param native_dtype: 是否保持源数据类型读入
+        :param reserve_ratio: 预留给写出缓冲、Python对象等的预算比例
+        """
+        self.raster_path_list = raster_list
+        self.label_path = label_path
+        self.patch_size = patch_size
+        self.memory_budget = parse_memory_size(memory_budget)
+        self.workers = workers
+        self.native_dtype = native_dtype
+        self.reserve_ratio = reserve_ratio
+
+        self.raster_info_list = None
+        self.label_info = None
+        self.plan = None
+
+    def prepare_data(self):
+        self.raster_info_list = read_raster_list_info(self.raster_path_list)
+        if self.label_path is not None:
+            self.label_info = read_raster_info(self.label_path)
+
+    def _align_strip_patches(self, strip_patches, rows_patch, block_rows):
+        """
+        条带行数按源栅格分块行数对齐，使每次窗口读取都覆盖完整的分块。
+        """
+        strip_patches = int(min(strip_patches, rows_patch))
+        if block_rows > self.patch_size and block_rows % self.patch_size == 0:
+            block_patches = block_rows // self.patch_size
+            if strip_patches >= block_patches:
+                strip_patches -= strip_patches % block_patches
+        return max(1, strip_patches)
+
+    def make_plan(self):
+        """
+        生成规划。
+        :return: dict
+        """
+        print('### Planning memory for a budget of {}'.format(format_memory_size(self.memory_budget)))
+
+        budget = self.memory_budget * (1 - self.reserve_ratio)
+        first_info = self.raster_info_list[0]
+        rows_patch = first_info['rows'] // self.patch_size
+        strip_cols = (first_info['cols'] // self.patch_size) * self.patch_size
+        itemsize = raster_list_dtype(self.raster_info_list, self.native_dtype).itemsize
+        num_dates = len(self.raster_info_list)
+        date_bands = first_info['bands']
+        num_band = date_bands * num_dates
+
+        raster_bytes = num_band * first_info['rows'] * first_info['cols'] * itemsize
+        # one patch row of all dates, and of one date
+        strip_unit = num_band * self.patch_size * strip_cols * itemsize
+        date_strip_unit = date_bands * self.patch_size * strip_cols * itemsize
+
+        plan = {'num_dates': num_dates, 'num_band': num_band, 'itemsize': itemsize}
+        if raster_bytes <= budget:
+            plan.update(streaming=False, group_size=num_dates, strip_patches=rows_patch, raster_peak=raster_bytes)
+        elif strip_unit * self.workers <= budget:
+            strip_patches = self._align_strip_patches(budget // (strip_unit * self.workers), rows_patch,
+                                                      first_info['block_size'][1])
+            plan.update(streaming=True, group_size=num_dates, strip_patches=strip_patches,
+                        raster_peak=strip_unit * strip_patches * self.workers)
+        else:
+            # RasterGroupAccumulate works in a single process, one patch row at a time
+            group_size = int(max(1, min(num_dates, budget // date_strip_unit)))
+            plan.update(streaming=True, group_size=group_size, strip_patches=1, raster_peak=date_strip_unit * group_size)
+
+        if self.label_info is not None:
+            label_itemsize = self.label_info['dtype'].itemsize
+            label_bytes = self.label_info['rows'] * self.label_info['cols'] * label_itemsize
+            label_strip_unit = self.patch_size * strip_cols * label_itemsize
+            if label_bytes <= budget:
+                plan.update(label_streaming=False, label_strip_patches=rows_patch, label_peak=label_bytes)
+            else:
+                label_strip_patches = self._align_strip_patches(max(1, budget // (label_strip_unit * self.workers)),
+                                                                rows_patch, self.label_info['block_size'][1])
+                plan.update(label_streaming=True, label_strip_patches=label_strip_patches,
+                            label_peak=label_strip_unit * label_strip_patches * self.workers)
+        # if
+
+        self.plan = plan
+        print('Raster: {} bands, {}, {} dates per group, {} patch rows per strip, peak {}'.format(
+            num_band, 'streaming' if plan['streaming'] else 'in memory', plan['group_size'], plan['strip_patches'],
+            format_memory_size(plan['raster_peak'])))
+        if 'label_streaming' in plan:
+            print('Label: {}, {} patch rows per strip, peak {}'.format(
+                'streaming' if plan['label_streaming'] else 'in memory', plan['label_strip_patches'],
+                format_memory_size(plan['label_peak'])))
+        return plan
+
+    def raster_splitter(self, result_folder, incremental=False, **kwargs):
+        """
+        按规划创建栅格划分阶段：时相需分组或增量更新时为RasterGroupAccumulate（集中存储输出），否则为RasterDatasetsSplit。
+        :param result_folder:
+        :param incremental: 是否增量更新（只读取新增或变化的时相）
+        :param kwargs: 传给划分阶段的其他参数
+        :return:
+        """
+        plan = self.plan if self.plan is not None else self.make_plan()
+        if incremental or plan['group_size'] < plan['num_dates']:
+            kwargs.setdefault('output_format', 'store')
+            return RasterGroupAccumulate(self.raster_path_list, result_folder, self.patch_size, plan['group_size'],
+                                         native_dtype=self.native_dtype, incremental=incremental, **kwargs)
+        return RasterDatasetsSplit(self.raster_path_list, result_folder, self.patch_size, streaming=plan['streaming'],
+                                   workers=self.workers, native_dtype=self.native_dtype,
+                                   strip_patches=plan['strip_patches'], **kwargs)
+
+    def label_splitter(self, result_folder, **kwargs):
+        """
+        按规划创建标记划分阶段（LabelDatasetSplit）。
+        :param result_folder:
+        :param kwargs: 传给划分阶段的其他参数
+        :return:
+        """
+        plan = self.plan if self.plan is not None else self.make_plan()
+        return LabelDatasetSplit(self.label_path, result_folder, self.patch_size, workers=self.workers,
+                                 streaming=plan['label_streaming'], strip_patches=plan['label_strip_patches'], **kwargs)
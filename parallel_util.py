@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+Process-pool helpers for per-grid loops
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import glob
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from tqdm import tqdm
+
+_WORKER_STAGE = None
+
+
+def split_chunks(num_items, num_chunks):
+    """
+    将[0, num_items)划分为num_chunks个连续区间。
+    :param num_items:
+    :param num_chunks:
+    :return: list of (start, end)
+    """
+    num_chunks = max(1, min(num_chunks, num_items))
+    bounds = np.linspace(0, num_items, num_chunks + 1).astype(np.int64)
+    return [(int(bounds[ii]), int(bounds[ii + 1])) for ii in range(num_chunks)]
+
+
+def make_grid_folders(folder, num_grid):
+    """
+    预先创建每10000个切片一个的子目录，使并行写出时无需在进程间协调建目录。
+    :param folder:
+    :param num_grid:
+    :return:
+    """
+    if num_grid > 10000:
+        for sub in range((num_grid - 1) // 10000 + 1):
+            sub_folder = os.path.join(folder, '{:0>2d}'.format(sub))
+            if not os.path.exists(sub_folder):
+                os.makedirs(sub_folder)
+    return folder
+
+
+def create_shared_array(shape, dtype):
+    """
+    在共享内存中分配数组，子进程通过attach_shared_array()挂接，无需序列化数据。
+    :param shape:
+    :param dtype:
+    :return: (SharedMemory, ndarray, spec)
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    spec = (shm.name, tuple(shape), dtype.str)
+    return shm, array, spec
+
+
+def attach_shared_array(spec):
+    """
+    挂接create_shared_array()分配的共享内存数组。
+    :param spec: (name, shape, dtype)
+    :return: (SharedMemory, ndarray)
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    # the creating process owns the block: a spawned worker has its own resource tracker, which would unlink the
+    # block when the worker exits; forked workers share the creator's tracker, whose registration must stay
+    if multiprocessing.get_start_method() != 'fork':
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return shm, array
+
+
+def manifest_signature(num_items, grid_codes, **params):
+    """
+    清单头记录：条目数、切片编码的SHA-1及决定输出的参数。切片列表或参数变化后，已完成块的条目区间不再对应相同的切片。
+    :param num_items: 条目总数（切片数或条带数）
+    :param grid_codes: 切片编码（数组或字符串列表）
+    :param params: 输出格式、切片大小等参数，须可JSON序列化
+    :return: dict
+    """
+    sha1 = hashlib.sha1()
+    if isinstance(grid_codes, np.ndarray):
+        sha1.update(np.ascontiguousarray(grid_codes, dtype=np.int64).tobytes())
+    else:
+        sha1.update('\n'.join(grid_codes).encode('utf-8'))
+    signature = {'num_items': int(num_items), 'grid_sha1': sha1.hexdigest()}
+    signature.update(params)
+    return signature
+
+
+class ChunkManifest(object):
+    """
+    已完成块的清单（只追加）。
+    清单文件位于输出目录旁（'{output_folder}.manifest'），不影响按目录列举切片。第一行为头记录（见manifest_signature()），
+    之后每块处理完成并写盘后追加一行记录：条目区间、条目数及该块写出的分块文件（路径与字节数）。
+    重新运行时头记录不一致则清单与分块文件作废、全部重做；否则跳过已完成的块，并核对其分块文件仍然存在且大小一致；
+    每个切片一个文件的输出依靠原子写出（临时文件+重命名）保证完整。
+    """
+    def __init__(self, output_folder, signature=None):
+        """
+        初始化
+        :param output_folder: 输出目录
+        :param signature: 头记录，见manifest_signature()
+        """
+        self.output_folder = output_folder
+        self.manifest_path = output_folder.rstrip('/\\') + '.manifest'
+        self.signature = signature
+
+    def reset(self):
+        """
+        重新开始时删除旧清单。
+        :return:
+        """
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def _read_lines(self):
+        if not os.path.exists(self.manifest_path):
+            return []
+        record_list = []
+        with open(self.manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    record_list.append(json.loads(line))
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+        return record_list
+
+    def header(self):
+        record_list = self._read_lines()
+        return record_list[0].get('header') if record_list else None
+
+    def records(self):
+        return [record for record in self._read_lines() if 'header' not in record]
+
+    @staticmethod
+    def _verify(record):
+        return all(os.path.exists(path) and os.path.getsize(path) == size for path, size in record['outputs'])
+
+    def completed(self):
+        """
+        核对通过的已完成块；核对失败的块删除其分块文件，将被重新处理。
+        未被任何已完成块记录的分块文件（中断的块写出的）也被删除，避免集中存储中出现重复的切片。
+        :return: list of (start, end)
+        """
+        # compared as read back from JSON, tuples become lists
+        if os.path.exists(self.manifest_path) and self.header() != json.loads(json.dumps(self.signature)):
+            print('Manifest {} was written for other grids or parameters, starting over'.format(self.manifest_path))
+            self.reset()
+
+        done_ranges, kept_outputs = [], set()
+        for record in self.records():
+            if self._verify(record):
+                done_ranges.append((record['start'], record['end']))
+                kept_outputs.update(path for path, _ in record['outputs'])
+            else:
+                print('Chunk [{}, {}) failed verification, redoing'.format(record['start'], record['end']))
+        # for
+
+        for path in glob.glob(os.path.join(self.output_folder, 'part_*')):
+            if path not in kept_outputs:
+                os.remove(path)
+        return done_ranges
+
+    def append(self, start, end, count, outputs=()):
+        """
+        记录一个完成的块。
+        :param start:
+        :param end:
+        :param count: 处理的条目数
+        :param outputs: 该块写出的分块文件路径
+        :return:
+        """
+        record = {'start': int(start), 'end': int(end), 'count': int(count),
+                  'outputs': [[path, os.path.getsize(path)] for path in outputs]}
+        new_manifest = not os.path.exists(self.manifest_path)
+        with open(self.manifest_path, 'a') as f:
+            if new_manifest:
+                f.write(json.dumps({'header': self.signature}) + '\n')
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def remaining_chunks(chunks, done_ranges):
+    """
+    从各块中去除已完成的区间。
+    :param chunks: list of (start, end)
+    :param done_ranges: list of (start, end)
+    :return: list of (start, end)
+    """
+    done_ranges = sorted(done_ranges)
+    remaining = []
+    for start, end in chunks:
+        for done_start, done_end in done_ranges:
+            if done_end <= start or done_start >= end:
+                continue
+            if done_start > start:
+                remaining.append((start, done_start))
+            start = max(start, done_end)
+        # for
+        if start < end:
+            remaining.append((start, end))
+    # for
+    return remaining
+
+
+def chunk_result(count, writer=None):
+    """
+    块处理方法的返回值：条目数，以及集中存储写入者写出的分块文件（供ChunkManifest核对）。
+    :param count:
+    :param writer: PatchStoreWriter或SliceMaskTableWriter，None为每个切片一个文件
+    :return: (count, outputs)
+    """
+    return count, list(writer.part_path_list) if writer is not None else []
+
+
+def _init_worker(stage):
+    global _WORKER_STAGE
+    _WORKER_STAGE = stage
+
+
+def _run_worker_chunk(args):
+    method_name, start, end, chunk_id = args
+    return args, getattr(_WORKER_STAGE, method_name)(start, end, chunk_id)
+
+
+def run_chunks(stage, method_name, num_items, workers, desc, chunks_per_worker=8, manifest=None):
+    """
+    将[0, num_items)分块，在进程池中调用stage.method_name(start, end, chunk_id)，并汇总进度。
+    stage在每个子进程中只反序列化一次；方法返回本块处理的条目数（或chunk_result()），用于进度显示。
+    chunk_id为块的起始条目序号，重新运行时块的划分即使不同，也不会与已完成块的输出重名。
+    :param stage: 处理对象，须可pickle
+    :param method_name: 处理方法名
+    :param num_items: 条目总数
+    :param workers: 进程数
+    :param desc: 进度条描述
+    :param chunks_per_worker: 每个进程分得的块数，块越多负载越均衡
+    :param manifest: ChunkManifest，不为None时跳过已完成的块，并在每块完成后追加记录
+    :return: 处理的条目总数
+    """
+    chunks = split_chunks(num_items, max(1, workers) * chunks_per_worker)
+    num_skip = 0
+    if manifest is not None:
+        done_ranges = manifest.completed()
+        chunks = remaining_chunks(chunks, done_ranges)
+        num_skip = num_items - sum(end - start for start, end in chunks)
+        if num_skip > 0:
+            print(f'Resuming, {num_skip} of {num_items} items already done')
+    tasks = [(method_name, start, end, start) for start, end in chunks]
+
+    num_done = 0
+    with tqdm(total=num_items, initial=num_skip, desc=desc) as progress:
+        if workers <= 1:
+            for task in tasks:
+                result = getattr(stage, method_name)(*task[1:])
+                num_done += _finish_chunk(result, task, progress, manifest)
+            return num_done
+
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(stage,)) as pool:
+            for task, result in pool.imap_unordered(_run_worker_chunk, tasks):
+                num_done += _finish_chunk(result, task, progress, manifest)
+        # with
+    return num_done
+
+
+def _finish_chunk(result, task, progress, manifest):
+    count, outputs = result if isinstance(result, tuple) else (result, [])
+    progress.update(count)
+    if manifest is not None:
+        manifest.append(task[1], task[2], count, outputs)
+    return count
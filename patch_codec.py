@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compressed codecs for patch arrays
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import sys
+import time
+import zlib
+import json
+import struct
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 压缩切片文件头：魔数 + 头长度(uint32) + JSON头(dtype, shape, codec)
+CODEC_MAGIC = b'\x93NPCODEC'
+CODEC_FILTERS = ('delta', 'shuffle')
+CODEC_COMPRESSORS = ('none', 'zlib', 'lz4', 'zstd')
+
+
+def available_codecs():
+    """
+    当前环境可用的压缩器。lz4与zstd为可选依赖（pip install lz4 zstandard）。
+    :return:
+    """
+    codecs = ['none', 'zlib']
+    if lz4_frame is not None:
+        codecs.append('lz4')
+    if zstandard is not None:
+        codecs.append('zstd')
+    return codecs
+
+
+def parse_codec(codec):
+    """
+    解析编码字符串，格式为'[过滤器+...]压缩器[:级别]'，如'zlib'、'zstd:3'、'shuffle+lz4'、'delta+shuffle+zstd:9'。
+    :param codec:
+    :return: (filters, compressor, level)
+    """
+    names = codec.split('+')
+    compressor, _, level = names[-1].partition(':')
+    filters = names[:-1]
+
+    if compressor not in CODEC_COMPRESSORS:
+        print(f'### ERROR: unknown codec compressor {compressor}, one of {CODEC_COMPRESSORS}')
+        sys.exit(1)
+    if compressor not in available_codecs():
+        print(f'### ERROR: codec compressor {compressor} is not installed')
+        sys.exit(1)
+    for name in filters:
+        if name not in CODEC_FILTERS:
+            print(f'### ERROR: unknown codec filter {name}, one of {CODEC_FILTERS}')
+            sys.exit(1)
+
+    return filters, compressor, int(level) if level else None
+
+
+def _delta_encode(array):
+    """
+    沿最后一维做差分（整型按原类型回绕，可无损还原），相邻像元的反射率相近，差分后数值集中于0附近。
+    """
+    assert (np.issubdtype(array.dtype, np.integer)), 'delta filter requires an integer array'
+    encoded = array.copy()
+    encoded[..., 1:] = array[..., 1:] - array[..., :-1]
+    return encoded
+
+
+def _delta_decode(array):
+    return np.cumsum(array, axis=-1, dtype=array.dtype)
+
+
+def _shuffle_encode(data, itemsize):
+    """
+    字节重排：将各元素的第k个字节排在一起，高位字节多为0，更易压缩。
+    """
+    if itemsize == 1:
+        return data
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _shuffle_decode(data, itemsize):
+    if itemsize == 1:
+        return data
+    return np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+def _compress(data, compressor, level):
+    if compressor == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    if compressor == 'lz4':
+        return lz4_frame.compress(data, compression_level=0 if level is None else level)
+    if compressor == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    return data
+
+
+def _decompress(data, compressor):
+    if compressor == 'zlib':
+        return zlib.decompress(data)
+    if compressor == 'lz4':
+        return lz4_frame.decompress(data)
+    if compressor == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def encode_array(numpy_array, codec):
+    """
+    编码数组为字节串（含文件头）。
+    :param numpy_array:
+    :param codec: 编码字符串，见parse_codec()
+    :return: bytes
+    """
+    filters, compressor, level = parse_codec(codec)
+    numpy_array = np.ascontiguousarray(numpy_array)
+
+    if 'delta' in filters:
+        numpy_array = _delta_encode(numpy_array)
+    data = numpy_array.tobytes()
+    if 'shuffle' in filters:
+        data = _shuffle_encode(data, numpy_array.dtype.itemsize)
+    data = _compress(data, compressor, level)
+
+    header = json.dumps({'dtype': numpy_array.dtype.str, 'shape': list(numpy_array.shape),
+                         'codec': codec}).encode('utf-8')
+    return CODEC_MAGIC + struct.pack('<I', len(header)) + header + data
+
+
+def decode_array(data):
+    """
+    解码encode_array()的结果。
+    :param data: bytes
+    :return: ndarray
+    """
+    assert (data[:len(CODEC_MAGIC)] == CODEC_MAGIC)
+    header_start = len(CODEC_MAGIC) + 4
+    header_len, = struct.unpack('<I', data[len(CODEC_MAGIC):header_start])
+    header = json.loads(data[header_start:header_start + header_len].decode('utf-8'))
+    filters, compressor, _ = parse_codec(header['codec'])
+    dtype = np.dtype(header['dtype'])
+
+    data = _decompress(data[header_start + header_len:], compressor)
+    if 'shuffle' in filters:
+        data = _shuffle_decode(data, dtype.itemsize)
+    numpy_array = np.frombuffer(data, dtype=dtype).reshape(header['shape']).copy()
+    if 'delta' in filters:
+        numpy_array = _delta_decode(numpy_array)
+    return numpy_array
+
+
+def is_encoded_file(array_path):
+    """
+    判断文件是否为压缩切片（依据文件头魔数，而非扩展名）。
+    :param array_path:
+    :return:
+    """
+    with open(array_path, 'rb') as f:
+        return f.read(len(CODEC_MAGIC)) == CODEC_MAGIC
+
+
+def save_encoded_array(target_path, numpy_array, codec):
+    """
+    以指定编码写出切片。与np.save相同，路径无'.npy'扩展名时自动添加，使后续阶段按'.npy'列举切片不受影响。
+    :param target_path:
+    :param numpy_array:
+    :param codec:
+    :return:
+    """
+    if not target_path.endswith('.npy'):
+        target_path = target_path + '.npy'
+    # written through a temporary file and renamed, like patch_store.save_npy_atomic()
+    temp_path = target_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(encode_array(numpy_array, codec))
+    os.replace(temp_path, target_path)
+    return target_path
+
+
+def load_encoded_array(array_path):
+    with open(array_path, 'rb') as f:
+        return decode_array(f.read())
+
+
+def synthetic_s2_stack(num_dates=24, num_bands=10, patch_size=32, nodata_ratio=0.2, seed=0):
+    """
+    生成类似Sentinel-2的合成切片：UInt16反射率（0-10000），空间平滑、时相相关，部分像元为nodata(0)。
+    :return: (T*B, P, P) uint16
+    """
+    rng = np.random.default_rng(seed)
+    base = rng.uniform(300, 4000, size=(1, num_bands, 1, 1))
+    seasonal = 1 + 0.5 * np.sin(np.linspace(0, np.pi, num_dates)).reshape(num_dates, 1, 1, 1)
+    field = rng.normal(0, 1, size=(num_dates, num_bands, patch_size, patch_size)).cumsum(axis=-1).cumsum(axis=-2)
+    stack = base * seasonal + 20 * field / patch_size
+    stack = np.clip(stack, 0, 10000).astype(np.uint16)
+
+    nodata = rng.random((patch_size, patch_size)) < nodata_ratio
+    stack[:, :, nodata] = 0
+    return stack.reshape(num_dates * num_bands, patch_size, patch_size)
+
+
+def benchmark_codecs(codec_list=None, num_patches=64, native_dtype=True, masked=False, **synthetic_args):
+    """
+    在合成切片上评测各编码的压缩率与编码/解码吞吐量（MB/s，按原始数据量计）。
+    :param codec_list: 编码字符串列表，None为全部可用组合
+    :param num_patches: 切片数
+    :param native_dtype: True为UInt16，False为float32（nodata为NaN）
+    :param masked: 是否按地块掩膜（掩膜外为0），模拟GridParcelSlice等输出的分层切片
+    :return: list of dict
+    """
+    if codec_list is None:
+        codec_list = ['none']
+        for compressor in available_codecs()[1:]:
+            codec_list.extend([compressor, 'shuffle+' + compressor])
+            if native_dtype:
+                codec_list.append('delta+shuffle+' + compressor)
+
+    patches = [synthetic_s2_stack(seed=pp, **synthetic_args) for pp in range(num_patches)]
+    if masked:
+        patch_size = patches[0].shape[-1]
+        for pp, patch in enumerate(patches):
+            rr, cc = np.ogrid[:patch_size, :patch_size]
+            radius = patch_size * (0.15 + 0.1 * (pp % 3))
+            patch[:, (rr - patch_size / 2) ** 2 + (cc - patch_size / 2) ** 2 > radius ** 2] = 0
+    if not native_dtype:
+        patches = [np.where(patch == 0, np.nan, patch).astype(np.float32) for patch in patches]
+    raw_bytes = sum(patch.nbytes for patch in patches)
+
+    results = []
+    for codec in codec_list:
+        time_start = time.time()
+        encoded = [encode_array(patch, codec) for patch in patches]
+        encode_time = time.time() - time_start
+
+        time_start = time.time()
+        for data in encoded:
+            decode_array(data)
+        decode_time = time.time() - time_start
+
+        encoded_bytes = sum(len(data) for data in encoded)
+        results.append({'codec': codec, 'ratio': raw_bytes / encoded_bytes,
+                        'encode_mbs': raw_bytes / 1e6 / max(encode_time, 1e-9),
+                        'decode_mbs': raw_bytes / 1e6 / max(decode_time, 1e-9)})
+    # for
+
+    return results
+
+
+def print_benchmark(results, title=''):
+    print(f'### Codec benchmark {title}')
+    print('{:<24s}{:>10s}{:>14s}{:>14s}'.format('codec', 'ratio', 'encode MB/s', 'decode MB/s'))
+    for result in results:
+        print('{:<24s}{:>10.2f}{:>14.1f}{:>14.1f}'.format(result['codec'], result['ratio'],
+                                                          result['encode_mbs'], result['decode_mbs']))
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    num_patches = 64
+
+    #######################################################
+    # do
+    print_benchmark(benchmark_codecs(num_patches=num_patches, native_dtype=True), 'UInt16 reflectance')
+    print_benchmark(benchmark_codecs(num_patches=num_patches, native_dtype=False), 'float32 reflectance')
+    print_benchmark(benchmark_codecs(num_patches=num_patches, native_dtype=True, masked=True), 'UInt16 parcel slices')
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+"""
+Consolidated patch store for time-series dataset
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import io
+import os
+import glob
+import numpy as np
+
+
+def save_npy_atomic(target_path, numpy_array):
+    """
+    原子写出.npy：先写入同目录的临时文件，再重命名为目标文件，中断时不会留下不完整的目标文件。
+    与np.save相同，路径无'.npy'扩展名时自动添加。
+    :param target_path:
+    :param numpy_array:
+    :return: 目标文件路径
+    """
+    if not target_path.endswith('.npy'):
+        target_path = target_path + '.npy'
+    temp_path = target_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, numpy_array)
+    os.replace(temp_path, target_path)
+    return target_path
+
+
+def grow_npy_channels(array_path, num_channels):
+    """
+    将(C, P, P)的.npy文件沿第一维扩展为num_channels，原有数据不变，新增部分为0。
+    第一维在C顺序中即文件末尾，因此只需改写文件头并延长文件；文件头长度变化时才整体复制。
+    :param array_path:
+    :param num_channels:
+    :return:
+    """
+    with open(array_path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        assert (not fortran_order and num_channels >= shape[0])
+        if num_channels == shape[0]:
+            return array_path
+
+        new_shape = (num_channels,) + tuple(shape[1:])
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                      'fortran_order': False, 'shape': new_shape})
+        if len(header.getvalue()) == data_offset:
+            f.seek(0)
+            f.write(header.getvalue())
+            f.truncate(data_offset + int(np.prod(new_shape)) * dtype.itemsize)
+            return array_path
+    # with
+
+    old_array = np.load(array_path)
+    new_array = np.zeros(new_shape, dtype=dtype)
+    new_array[:shape[0]] = old_array
+    return save_npy_atomic(array_path, new_array)
+
+
+def is_patch_store(folder):
+    """
+    判断目录是否为切片集中存储目录。
+    :param folder:
+    :return:
+    """
+    return os.path.isdir(folder) and len(glob.glob(os.path.join(folder, '*.keys.npy'))) > 0
+
+
+class PatchStoreWriter(object):
+    """
+    切片集中存储（写）。
+    代替每个切片一个.npy文件的方式，将切片依次写入若干分块文件{prefix}_{seq:0>5d}.npy，形状为(N, C, P, P)或(N, P, P)，
+    并在对应的{prefix}_{seq:0>5d}.keys.npy中记录每个切片的编码（即原来的文件名），分块文件可直接内存映射读取。
+    """
+    def __init__(self, store_folder, prefix='part', part_bytes=256 * 1024 * 1024):
+        """
+        初始化
+        :param store_folder: 存储目录
+        :param prefix: 分块文件前缀，多个写入者写同一目录时应各不相同
+        :param part_bytes: 每个分块文件的大致字节数
+        """
+        self.store_folder = store_folder
+        self.prefix = prefix
+        self.part_bytes = part_bytes
+
+        self.part_seq = 0
+        self.num_written = 0
+        self.part_path_list = []
+        self._buffer = None
+        self._keys = []
+
+        if not os.path.exists(self.store_folder):
+            os.makedirs(self.store_folder)
+
+    def write(self, key, array):
+        """
+        写入一个切片。
+        :param key: 切片编码
+        :param array: 切片数据，所有切片形状与数据类型须一致
+        :return:
+        """
+        if self._buffer is None:
+            part_rows = max(1, self.part_bytes // max(1, array.nbytes))
+            self._buffer = np.empty((part_rows,) + array.shape, dtype=array.dtype)
+        assert (array.shape == self._buffer.shape[1:])
+
+        self._buffer[len(self._keys)] = array
+        self._keys.append(key)
+        self.num_written += 1
+
+        if len(self._keys) == self._buffer.shape[0]:
+            self._flush()
+
+    def _flush(self):
+        """
+        将缓存的切片写出为一个分块文件。
+        :return:
+        """
+        num_keys = len(self._keys)
+        if num_keys == 0:
+            return
+
+        # the keys file marks a part as readable, so it is written last
+        part_name = '{}_{:0>5d}'.format(self.prefix, self.part_seq)
+        self.part_path_list.append(save_npy_atomic(os.path.join(self.store_folder, part_name + '.npy'),
+                                                   self._buffer[:num_keys]))
+        self.part_path_list.append(save_npy_atomic(os.path.join(self.store_folder, part_name + '.keys.npy'),
+                                                   np.array(self._keys)))
+
+        self.part_seq += 1
+        self._keys = []
+
+    def close(self):
+        self._flush()
+        self._buffer = None
+        return self.store_folder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PatchStore(object):
+    """
+    切片集中存储（读）。
+    按编码或序号访问切片，分块文件以内存映射方式打开。
+    """
+    def __init__(self, store_folder, mmap_mode='r'):
+        """
+        初始化
+        :param store_folder: 存储目录
+        :param mmap_mode: np.load的mmap_mode，None则整体读入
+        """
+        self.store_folder = store_folder
+        self.mmap_mode = mmap_mode
+
+        self.part_path_list = []
+        self.keys = []
+        self._part_index = None
+        self._key_index = {}
+        self._part_data = {}
+
+        self._load_index()
+
+    def _load_index(self):
+        key_path_list = sorted(glob.glob(os.path.join(self.store_folder, '*.keys.npy')))
+        part_rows = []
+        for pp, key_path in enumerate(key_path_list):
+            part_keys = np.load(key_path)
+            self.part_path_list.append(key_path[:-len('.keys.npy')] + '.npy')
+            self.keys.extend(part_keys.tolist())
+            part_rows.append(np.stack([np.full(len(part_keys), pp), np.arange(len(part_keys))], axis=1))
+        # for
+
+        self._part_index = np.concatenate(part_rows, axis=0) if part_rows else np.zeros((0, 2), dtype=np.int64)
+        self._key_index = {key: ii for ii, key in enumerate(self.keys)}
+        return self.keys
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in the receiving process
+        state = self.__dict__.copy()
+        state['_part_data'] = {}
+        return state
+
+    def _part(self, pp):
+        if pp not in self._part_data:
+            self._part_data[pp] = np.load(self.part_path_list[pp], mmap_mode=self.mmap_mode)
+        return self._part_data[pp]
+
+    def get(self, index):
+        """
+        按序号读取切片。
+        :param index:
+        :return:
+        """
+        pp, row = self._part_index[index]
+        return self._part(pp)[row]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._key_index[key]
+        return self.get(key)
+
+    def __contains__(self, key):
+        return key in self._key_index
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def slice_mask_dtype(patch_size):
+    """
+    位压缩分层记录的数据类型：切片编码、地块ID、类别ID、源分层数据类型、packbits(掩膜)。patch_size=32时每条记录154字节。
+    :param patch_size:
+    :return:
+    """
+    return np.dtype([('grid_code', '<i4', (4,)), ('parcel_id', '<u4'), ('class_id', '<u2'), ('dtype', 'S4'),
+                     ('mask', 'u1', ((patch_size * patch_size + 7) // 8,))])
+
+
+class SliceMaskTableWriter(object):
+    """
+    分层切片的位压缩编码（写）。
+    GridParcelSlice与GridLabelSlice的每个分层只保留一种像元值，因此只需记录(grid_code, parcel_id, class_id, packbits(mask))，
+    无需保存完整的P*P数组。记录依次写入{prefix}_{seq:0>5d}.masks.npy表中。
+    与PatchStoreWriter接口相同，write()的key为分层文件名'{class}_{parcel}_{grid}'。
+    """
+    suffix = '.masks.npy'
+
+    def __init__(self, store_folder, prefix='part', part_rows=1024 * 1024):
+        """
+        初始化
+        :param store_folder: 存储目录
+        :param prefix: 表文件前缀，多个写入者写同一目录时应各不相同
+        :param part_rows: 每个表文件的最大记录数
+        """
+        self.store_folder = store_folder
+        self.prefix = prefix
+        self.part_rows = part_rows
+
+        self.part_seq = 0
+        self.num_written = 0
+        self.part_path_list = []
+        self._records = None
+        self._num_records = 0
+
+        if not os.path.exists(self.store_folder):
+            os.makedirs(self.store_folder)
+
+    def write(self, key, array):
+        """
+        写入一个分层。
+        :param key: 分层文件名，'{class}_{parcel}_{r_s}_{r_e}_{c_s}_{c_e}'
+        :param array: 分层数据，形状为(P, P)，非0像元即掩膜
+        :return:
+        """
+        if self._records is None:
+            self._records = np.zeros(self.part_rows, dtype=self._record_dtype(array.shape[-1]))
+
+        sub_strs = key.split('_')
+        record = self._records[self._num_records]
+        record['class_id'] = int(sub_strs[0])
+        record['parcel_id'] = int(sub_strs[1])
+        record['grid_code'] = [int(ss) for ss in sub_strs[2:6]]
+        self._fill_record(record, np.asarray(array))
+
+        self._num_records += 1
+        self.num_written += 1
+        if self._num_records == self.part_rows:
+            self._flush()
+
+    @staticmethod
+    def _record_dtype(patch_size):
+        return slice_mask_dtype(patch_size)
+
+    @staticmethod
+    def _fill_record(record, array):
+        record['dtype'] = array.dtype.str.encode()
+        record['mask'] = np.packbits(array.ravel() != 0)
+
+    def _flush(self):
+        if self._num_records == 0:
+            return
+
+        part_name = '{}_{:0>5d}'.format(self.prefix, self.part_seq)
+        self.part_path_list.append(save_npy_atomic(os.path.join(self.store_folder, part_name + self.suffix),
+                                                   self._records[:self._num_records]))
+
+        self.part_seq += 1
+        self._num_records = 0
+
+    def close(self):
+        self._flush()
+        self._records = None
+        return self.store_folder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SliceRecordTable(object):
+    """
+    分层记录表（读）：读入目录中全部'*{suffix}'表文件的记录，每条记录含grid_code、parcel_id与class_id。
+    """
+    suffix = None
+
+    def __init__(self, store_folder):
+        self.store_folder = store_folder
+
+        part_path_list = sorted(glob.glob(os.path.join(store_folder, '*' + self.suffix)))
+        self.records = np.concatenate([np.load(path) for path in part_path_list], axis=0)
+
+    def slice_name(self, index):
+        """
+        分层对应的原文件名（不含扩展名）。
+        :param index:
+        :return:
+        """
+        record = self.records[index]
+        return '{:0>2d}_{:0>8d}_{}'.format(int(record['class_id']), int(record['parcel_id']),
+                                           '_'.join('{:0>5d}'.format(int(cc)) for cc in record['grid_code']))
+
+    def __len__(self):
+        return len(self.records)
+
+
+class SliceMaskTable(SliceRecordTable):
+    """
+    分层切片的位压缩编码（读）。
+    按需将记录解码为与原分层相同的稠密数组：掩膜内像元为parcel_id（地块分层）或class_id（类别分层），其余为0。
+    """
+    suffix = SliceMaskTableWriter.suffix
+
+    def __init__(self, store_folder):
+        super(SliceMaskTable, self).__init__(store_folder)
+        self.patch_size = int(np.sqrt(self.records.dtype['mask'].shape[0] * 8))
+        # the dtype of the slices when they were written, uint32 for tables written without it
+        self.dtype = np.dtype(np.uint32)
+        if 'dtype' in self.records.dtype.names and len(self.records) > 0:
+            self.dtype = np.result_type(*[np.dtype(name.decode()) for name in np.unique(self.records['dtype'])])
+
+    def decode(self, index, dtype=None):
+        """
+        解码一条或多条记录为稠密分层。
+        :param index: 整数或整数数组
+        :param dtype: 输出数据类型，None为写出时的源分层数据类型
+        :return: (P, P)或(M, P, P)
+        """
+        dtype = self.dtype if dtype is None else dtype
+        records = self.records[index]
+        patch_size2 = self.patch_size * self.patch_size
+        masks = np.unpackbits(np.atleast_1d(records['mask']).reshape(-1, records['mask'].shape[-1]),
+                              axis=1, count=patch_size2)
+        values = np.where(np.atleast_1d(records['parcel_id']) != 0,
+                          np.atleast_1d(records['parcel_id']), np.atleast_1d(records['class_id']))
+        dense = (masks * values[:, np.newaxis].astype(dtype)).astype(dtype, copy=False)
+        dense = dense.reshape(-1, self.patch_size, self.patch_size)
+        return dense[0] if np.ndim(index) == 0 else dense
+
+
+def sample_index_dtype():
+    """
+    虚拟样本索引的数据类型：切片编码、地块ID、类别ID、像元数，每条记录26字节。
+    :return:
+    """
+    return np.dtype([('grid_code', '<i4', (4,)), ('parcel_id', '<u4'), ('class_id', '<u2'), ('num_pixels', '<u4')])
+
+
+class SampleIndexWriter(SliceMaskTableWriter):
+    """
+    虚拟样本索引（写）。
+    只记录每个分层的(grid_code, parcel_id, class_id, 像元数)，不保存分层或掩膜后的栅格副本：
+    读取时由切片的标记（或地块）数据与parcel_id/class_id比较得到掩膜，再与堆叠栅格切片相乘（见dataset.SliceDataset）。
+    记录依次写入{prefix}_{seq:0>5d}.samples.npy表中，接口与SliceMaskTableWriter相同。
+    """
+    suffix = '.samples.npy'
+
+    @staticmethod
+    def _record_dtype(patch_size):
+        return sample_index_dtype()
+
+    @staticmethod
+    def _fill_record(record, array):
+        record['num_pixels'] = np.count_nonzero(array)
+
+
+class SampleIndex(SliceRecordTable):
+    """
+    虚拟样本索引（读）。记录中没有掩膜，掩膜在读取时由标记切片得到（见dataset.SliceDataset）。
+    """
+    suffix = SampleIndexWriter.suffix
+
+
+def has_sample_index(folder):
+    return os.path.isdir(folder) and len(glob.glob(os.path.join(folder, '*' + SampleIndexWriter.suffix))) > 0
+
+
+def open_patch_writer(output_format, store_folder, prefix='part'):
+    """
+    按输出格式创建写入者：'npy'返回None（每个切片一个.npy文件），'store'为集中存储，'mask'为位压缩分层表，
+    'index'为虚拟样本索引（不写出分层数据）。
+    :param output_format:
+    :param store_folder:
+    :param prefix:
+    :return:
+    """
+    if output_format == 'store':
+        return PatchStoreWriter(store_folder, prefix=prefix)
+    if output_format == 'mask':
+        return SliceMaskTableWriter(store_folder, prefix=prefix)
+    if output_format == 'index':
+        return SampleIndexWriter(store_folder, prefix=prefix)
+    return None
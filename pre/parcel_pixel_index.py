@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parcel to pixel CSR index over the rasterised parcel map
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+from tqdm import tqdm
+
+from raster_util import read_raster_info, read_label_window, read_raster_list_info, read_raster_list_window
+
+
+class ParcelPixelIndex(object):
+    """
+    地块→像元的CSR（压缩稀疏行）索引。
+    按条带流式读取一次polygon_rasterize_id生成的RSTIZE_ID栅格：每个条带的标记像元按地块ID稳定排序（argsort）后追加到临时文件，
+    同时以bincount累计每个地块的像元数；读完后由累计像元数得到indptr，再将各条带的有序片段放入最终位置。
+    地块p的像元为indices[indptr[p]:indptr[p + 1]]，即按升序排列的展平像元序号（row * cols + col）。
+    索引保存于栅格旁：'{prefix}.parcel_indptr.npz'（indptr、栅格大小及栅格文件的大小与修改时间）与
+    '{prefix}.parcel_pixels.npy'（indices，可内存映射）。栅格重新生成后，open()据此重建索引。
+    提取一个地块在全部时相的像元时，只需从内存映射的(C, H, W)堆叠中按indices取值，代价与地块像元数成正比。
+    """
+    def __init__(self, parcel_path, index_prefix=None, block_rows=1024):
+        """
+        初始化
+        :param parcel_path: 地块ID栅格（RSTIZE_ID，UInt32，0为背景）
+        :param index_prefix: 索引文件前缀，None则为栅格路径去掉扩展名
+        :param block_rows: 每个条带的行数
+        """
+        self.parcel_path = parcel_path
+        self.index_prefix = index_prefix if index_prefix else os.path.splitext(parcel_path)[0]
+        self.block_rows = block_rows
+
+        self.rows, self.cols = 0, 0
+        self.indptr = None
+        self.indices = None
+
+    @property
+    def indptr_path(self):
+        return self.index_prefix + '.parcel_indptr.npz'
+
+    @property
+    def indices_path(self):
+        return self.index_prefix + '.parcel_pixels.npy'
+
+    def prepare_data(self):
+        """
+        读取栅格元数据，条带行数按源栅格分块行数对齐。
+        :return:
+        """
+        parcel_info = read_raster_info(self.parcel_path)
+        self.rows, self.cols = parcel_info['rows'], parcel_info['cols']
+        block_rows = parcel_info['block_size'][1]
+        if self.block_rows > block_rows:
+            self.block_rows -= self.block_rows % block_rows
+
+    def build(self):
+        """
+        流式建立索引并保存。
+        :return:
+        """
+        print('### Building parcel pixel index of {}'.format(self.parcel_path))
+        assert (self.rows > 0 and self.cols > 0)
+
+        offset_dtype = np.uint32 if self.rows * self.cols <= np.iinfo(np.uint32).max else np.int64
+        temp_prefix = self.index_prefix + '.parcel_build'
+        counts = np.zeros(1, dtype=np.int64)
+        block_bounds = [0]
+
+        # 1. one pass over the raster, every block's labelled pixels as runs sorted by parcel
+        with open(temp_prefix + '.ids', 'wb') as id_file, open(temp_prefix + '.offsets', 'wb') as offset_file:
+            block_data = None
+            for row_start in tqdm(range(0, self.rows, self.block_rows), desc='Indexing parcel pixels ...'):
+                num_rows = min(self.block_rows, self.rows - row_start)
+                if block_data is not None and block_data.shape[0] != num_rows:
+                    block_data = None
+                block_data = read_label_window(self.parcel_path, 0, row_start, self.cols, num_rows, buf_obj=block_data)
+
+                block_flat = block_data.ravel()
+                offsets = np.flatnonzero(block_flat)
+                ids = block_flat[offsets].astype(np.int64)
+                # stable, so the offsets of one parcel stay in ascending order
+                order = np.argsort(ids, kind='stable')
+
+                block_counts = np.bincount(ids)
+                if block_counts.size > counts.size:
+                    counts = np.concatenate([counts, np.zeros(block_counts.size - counts.size, dtype=np.int64)])
+                counts[:block_counts.size] += block_counts
+
+                ids[order].astype(np.uint32).tofile(id_file)
+                (offsets[order] + row_start * self.cols).astype(offset_dtype).tofile(offset_file)
+                block_bounds.append(block_bounds[-1] + ids.size)
+            # for
+        # with
+
+        # 2. parcel p starts at indptr[p], every block's run goes after the runs of the blocks above it
+        counts[0] = 0
+        self.indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        num_pixels = int(self.indptr[-1])
+        temp_indices_path = self.indices_path + '.tmp'
+        indices = np.lib.format.open_memmap(temp_indices_path, mode='w+', dtype=offset_dtype, shape=(num_pixels,))
+        if num_pixels > 0:
+            run_ids = np.memmap(temp_prefix + '.ids', dtype=np.uint32, mode='r')
+            run_offsets = np.memmap(temp_prefix + '.offsets', dtype=offset_dtype, mode='r')
+            filled = self.indptr[:-1].copy()
+            for start, end in zip(block_bounds[:-1], block_bounds[1:]):
+                if start == end:
+                    continue
+                ids = run_ids[start:end].astype(np.int64)
+                parcel_ids, parcel_starts, parcel_counts = np.unique(ids, return_index=True, return_counts=True)
+                rank = np.arange(end - start) - np.repeat(parcel_starts, parcel_counts)
+                indices[filled[ids] + rank] = run_offsets[start:end]
+                filled[parcel_ids] += parcel_counts
+            # for
+            del run_ids, run_offsets
+        indices.flush()
+        del indices
+
+        os.replace(temp_indices_path, self.indices_path)
+        os.remove(temp_prefix + '.ids')
+        os.remove(temp_prefix + '.offsets')
+        self._save_indptr()
+        self.indices = np.load(self.indices_path, mmap_mode='r')
+
+        print(f'{np.count_nonzero(counts)} parcels, {num_pixels} pixels indexed on {self.indices_path}')
+        return self
+
+    def _source_stat(self):
+        """
+        地块栅格文件的大小与修改时间，用于判断索引是否过期。
+        :return: (size, mtime)
+        """
+        return os.path.getsize(self.parcel_path), os.path.getmtime(self.parcel_path)
+
+    def _save_indptr(self):
+        source_size, source_mtime = self._source_stat()
+        temp_path = self.indptr_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, indptr=self.indptr, shape=(self.rows, self.cols), source_size=source_size,
+                     source_mtime=source_mtime)
+        os.replace(temp_path, self.indptr_path)
+        return self.indptr_path
+
+    def is_current(self):
+        """
+        已保存的索引是否与当前地块栅格一致（栅格大小、文件大小与修改时间）。
+        :return:
+        """
+        if not (os.path.exists(self.indptr_path) and os.path.exists(self.indices_path)):
+            return False
+        indptr_data = np.load(self.indptr_path)
+        if 'source_size' not in indptr_data or 'source_mtime' not in indptr_data:
+            return False
+        parcel_info = read_raster_info(self.parcel_path)
+        source_size, source_mtime = self._source_stat()
+        return (tuple(int(vv) for vv in indptr_data['shape']) == (parcel_info['rows'], parcel_info['cols']) and
+                int(indptr_data['source_size']) == source_size and float(indptr_data['source_mtime']) == source_mtime)
+
+    @staticmethod
+    def open(parcel_path, index_prefix=None, block_rows=1024, mmap_mode='r'):
+        """
+        读取已保存的索引，索引不存在或与当前地块栅格不一致时重新建立。
+        :param parcel_path: 地块ID栅格
+        :param index_prefix: 索引文件前缀，None则为栅格路径去掉扩展名
+        :param block_rows: 建立索引时每个条带的行数
+        :param mmap_mode: indices的读取方式，None则整体读入
+        :return: ParcelPixelIndex
+        """
+        index = ParcelPixelIndex(parcel_path, index_prefix, block_rows)
+        if index.is_current():
+            return ParcelPixelIndex.load(parcel_path, index_prefix, mmap_mode)
+
+        print('### Parcel pixel index of {} is missing or out of date'.format(parcel_path))
+        index.prepare_data()
+        return index.build()
+
+    @staticmethod
+    def load(parcel_path, index_prefix=None, mmap_mode='r'):
+        """
+        读取已保存的索引。
+        :param parcel_path: 地块ID栅格
+        :param index_prefix: 索引文件前缀，None则为栅格路径去掉扩展名
+        :param mmap_mode: indices的读取方式，None则整体读入
+        :return: ParcelPixelIndex
+        """
+        index = ParcelPixelIndex(parcel_path, index_prefix)
+        indptr_data = np.load(index.indptr_path)
+        index.indptr = indptr_data['indptr']
+        index.rows, index.cols = [int(vv) for vv in indptr_data['shape']]
+        index.indices = np.load(index.indices_path, mmap_mode=mmap_mode)
+        return index
+
+    def parcel_ids(self):
+        """
+        有像元的地块ID。
+        :return:
+        """
+        return np.flatnonzero(np.diff(self.indptr))
+
+    def num_pixels(self, parcel_id):
+        if parcel_id + 1 >= self.indptr.size:
+            return 0
+        return int(self.indptr[parcel_id + 1] - self.indptr[parcel_id])
+
+    def pixels(self, parcel_id):
+        """
+        地块的展平像元序号（升序）。
+        :param parcel_id:
+        :return:
+        """
+        if parcel_id + 1 >= self.indptr.size:
+            return self.indices[:0]
+        return self.indices[self.indptr[parcel_id]:self.indptr[parcel_id + 1]]
+
+    def pixel_rows_cols(self, parcel_id):
+        """
+        地块像元的行列号。
+        :return: (rows, cols)
+        """
+        return np.divmod(self.pixels(parcel_id).astype(np.int64), self.cols)
+
+    def gather(self, stack, parcel_id):
+        """
+        从(..., H, W)的堆叠数组（可为内存映射）中取出地块的全部像元。
+        :param stack: 如read_raster_list()的(T*B, H, W)结果
+        :param parcel_id:
+        :return: (..., N)
+        """
+        assert (stack.shape[-2:] == (self.rows, self.cols))
+        stack_flat = stack.reshape(stack.shape[:-2] + (-1,))
+        return stack_flat[..., self.pixels(parcel_id).astype(np.intp)]
+
+    def read_parcel(self, info_list, parcel_id, native_dtype=False, nodata_fill=None):
+        """
+        以GDAL窗口读取地块外接矩形，再取出地块像元，无需读入整个栅格。
+        :param info_list: read_raster_list_info()的结果
+        :param parcel_id:
+        :param native_dtype: 是否保持源数据类型
+        :param nodata_fill: nodata填充值
+        :return: (T*B, N)
+        """
+        pixel_rows, pixel_cols = self.pixel_rows_cols(parcel_id)
+        num_band = sum(info['bands'] for info in info_list)
+        if pixel_rows.size == 0:
+            return np.empty((num_band, 0), dtype=np.float32)
+
+        row_start, row_end = int(pixel_rows[0]), int(pixel_rows[-1]) + 1
+        col_start, col_end = int(pixel_cols.min()), int(pixel_cols.max()) + 1
+        window_data = read_raster_list_window(info_list, col_start, row_start, col_end - col_start,
+                                              row_end - row_start, native_dtype=native_dtype, nodata_fill=nodata_fill)
+        window_flat = window_data.reshape(num_band, -1)
+        return window_flat[:, (pixel_rows - row_start) * (col_end - col_start) + (pixel_cols - col_start)]
+
+
+def main():
+    print("##################################################################")
+    print("###                                      #########################")
+    print("##################################################################")
+
+    #######################################################
+    # cmd line
+    parcel_path = r'G:\FF\application_dataset\2020-france-agri-grid\parcel_dirong\polygon\parcel_dirong_maincrop_removesmall_utm_polygon.tif'
+    raster_list = [
+        r'G:\FF\application_dataset\2020-france-agri\s2_l2a_tif_masked\10m\L1C_T31TFN_20190103_masked_10m.tif',
+    ]
+
+    #######################################################
+    # do
+    ppi = ParcelPixelIndex(parcel_path)
+    ppi.prepare_data()
+    ppi.build()
+
+    parcel_ids = ppi.parcel_ids()
+    info_list = read_raster_list_info(raster_list)
+    parcel_pixels = ppi.read_parcel(info_list, parcel_ids[0])
+    print(f'Parcel {parcel_ids[0]}: {parcel_pixels.shape}')
+
+    #######################################################
+    # close
+
+    print('### Task complete !')
+
+
+if __name__ == '__main__':
+    main()
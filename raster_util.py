@@ -8,24 +8,36 @@ Date: 2021-09-16
 """
 import os, sys, time
 import gc
+import threading
+import contextlib
 import numpy as np
 import matplotlib.pyplot as plt
 import warnings
 
-from osgeo import gdal
+from concurrent.futures import ThreadPoolExecutor
+from osgeo import gdal, gdal_array, osr
+
+from patch_codec import CODEC_MAGIC, save_encoded_array, decode_array
+from patch_store import save_npy_atomic
 
 warnings.filterwarnings('ignore')
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
 os.environ['PROJ_LIB'] = r'D:\develop-envi\anaconda3\envs\py38\Lib\site-packages\pyproj\proj_dir\share\proj'
 gdal.UseExceptions()
 
+# background writer used by write_numpy_array() / write_slice_array(), see async_write()
+_ASYNC_WRITER = None
+
 
-def read_raster(raster_path, print_info=False):
+def read_raster(raster_path, print_info=False, native_dtype=False, nodata_fill=None, return_mask=False):
     """
 
     :param raster_path:
     :param print_info:
-    :return: ndarry
+    :param native_dtype: 保持源数据类型（如UInt16），不转换为float32
+    :param nodata_fill: nodata像元的填充值，None则float32时为NaN、源数据类型时保持原值
+    :param return_mask: 同时返回nodata掩膜（True为nodata）
+    :return: ndarry，或(ndarry, mask)
     """
     print("### Reading raster image {}".format(raster_path))
 
@@ -47,10 +59,14 @@ def read_raster(raster_path, print_info=False):
 
     # 2. get data
     raster_array = raster_ds.ReadAsArray()
-    # np.nan has type float
     no_data = raster_ds.GetRasterBand(1).GetNoDataValue()
-    raster_array = raster_array.astype(np.float32)
-    raster_array[raster_array == no_data] = np.nan
+    nodata_mask = raster_array == no_data
+    if not native_dtype:
+        # np.nan has type float
+        raster_array = raster_array.astype(np.float32)
+    nodata_fill = _nodata_fill_value(raster_array.dtype, nodata_fill)
+    if nodata_fill is not None:
+        raster_array[nodata_mask] = nodata_fill
 
     print(f'Array shape: {raster_array.shape}')
     if raster_array.ndim != 3:
@@ -60,6 +76,8 @@ def read_raster(raster_path, print_info=False):
 
     # 3. return
     raster_ds = None
+    if return_mask:
+        return raster_array, nodata_mask
     return raster_array
 
 
@@ -82,24 +100,187 @@ def read_raster_list1(raster_list):
     return all_data
 
 
-def read_raster_list(raster_list):
-    print("### Reading reference raster {}".format(raster_list))
+def read_raster_info(raster_path):
+    """
+    只读取栅格元数据，不读取像元。
+    :param raster_path:
+    :return: dict, 波段数、行列数、数据类型、nodata、分块大小及空间参考
+    """
+    raster_ds = gdal.Open(raster_path, gdal.GA_ReadOnly)
+    if not raster_ds:
+        print('Unable to open image {}'.format(raster_path))
+        sys.exit(1)
 
-    all_data = None
-    num_reference = len(raster_list)
-    for rr in range(num_reference):
-        path = raster_list[rr]
-        raster_data = read_raster(path, (True if rr == 0 else False))
-        if rr == 0:
-            num_band = raster_data.shape[0]
-            all_data = np.concatenate([raster_data], axis=0)
-        else:
-            assert (num_band == raster_data.shape[0])
-            all_data = np.concatenate([all_data, raster_data], axis=0)
-        del raster_data
-        gc.collect()
+    raster_band = raster_ds.GetRasterBand(1)
+    raster_info = {
+        'path': raster_path,
+        'bands': raster_ds.RasterCount,
+        'rows': raster_ds.RasterYSize,
+        'cols': raster_ds.RasterXSize,
+        'datatype': raster_band.DataType,
+        'dtype': np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(raster_band.DataType)),
+        'nodata': raster_band.GetNoDataValue(),
+        'block_size': tuple(raster_band.GetBlockSize()),
+        'projection': raster_ds.GetProjection(),
+        'geo_transform': raster_ds.GetGeoTransform(),
+    }
+
+    raster_ds = None
+    return raster_info
+
+
+def read_raster_list_info(raster_list):
+    """
+    读取栅格列表的元数据，并在读取任何像元之前，检查所有栅格是否位于同一网格（行列数、波段数、仿射参数、投影）。
+    :param raster_list:
+    :return: list of dict
+    """
+    print("### Checking raster list {}".format(raster_list))
+
+    info_list = [read_raster_info(path) for path in raster_list]
+    first_info = info_list[0]
+    first_srs = osr.SpatialReference(wkt=first_info['projection'])
+    for info in info_list[1:]:
+        if (info['rows'], info['cols'], info['bands']) != (first_info['rows'], first_info['cols'], first_info['bands']):
+            print('Raster {} does not match the size or band count of {}'.format(info['path'], first_info['path']))
+            sys.exit(1)
+        if not np.allclose(info['geo_transform'], first_info['geo_transform']):
+            print('Raster {} does not match the geo-transform of {}'.format(info['path'], first_info['path']))
+            sys.exit(1)
+        if not first_srs.IsSame(osr.SpatialReference(wkt=info['projection'])):
+            print('Raster {} does not match the projection of {}'.format(info['path'], first_info['path']))
+            sys.exit(1)
+    # for
+
+    print(f'Project: {first_info["projection"]}')
+    print(f'GeoTransform: {first_info["geo_transform"]}')
+    print(f'XSize, YSize, BandCount: {(first_info["cols"], first_info["rows"], first_info["bands"])}')
+    return info_list
+
+
+def _nodata_fill_value(dtype, nodata_fill=None):
+    """
+    nodata填充值：未指定时，浮点型为NaN，整型保持源nodata值（返回None）。
+    """
+    if nodata_fill is not None:
+        return nodata_fill
+    return np.nan if np.issubdtype(dtype, np.floating) else None
+
+
+def raster_list_dtype(info_list, native_dtype=False):
+    """
+    栅格列表读入后的数据类型：默认float32（nodata为NaN）；native_dtype时为各栅格源数据类型的公共类型。
+    :param info_list: read_raster_list_info()的结果
+    :param native_dtype:
+    :return: np.dtype
+    """
+    if not native_dtype:
+        return np.dtype(np.float32)
+    return np.result_type(*[info['dtype'] for info in info_list])
+
+
+def open_raster_list(info_list):
+    """
+    一次打开栅格列表中的全部数据集，供同一条带或同一块内的多次窗口读取复用，避免每个窗口重复gdal.Open。
+    返回的元数据带有'dataset'句柄，只在当前进程内使用，释放列表即关闭数据集。
+    :param info_list: read_raster_list_info()的结果
+    :return: list of dict
+    """
+    opened_list = []
+    for info in info_list:
+        raster_ds = gdal.Open(info['path'], gdal.GA_ReadOnly)
+        if not raster_ds:
+            print('Unable to open image {}'.format(info['path']))
+            sys.exit(1)
+        opened_list.append(dict(info, dataset=raster_ds))
+    # for
+    return opened_list
+
+
+def _read_raster_list_into(info_list, raster_array, xoff, yoff, xsize, ysize, nodata_fill=None, mask_array=None):
+    """
+    将栅格列表中每个波段的指定窗口，直接读入预分配数组的对应切片，并处理nodata。
+    :param info_list: read_raster_list_info()或open_raster_list()的结果，后者复用已打开的数据集
+    :param raster_array: 预分配数组，形状为(T*B, ysize, xsize)，数据类型决定读入类型
+    :param nodata_fill: nodata填充值，None则浮点型为NaN、整型保持原值
+    :param mask_array: 可选的(T*B, ysize, xsize)布尔数组，写入nodata掩膜
+    :return: raster_array
+    """
+    nodata_fill = _nodata_fill_value(raster_array.dtype, nodata_fill)
+
+    channel = 0
+    for info in info_list:
+        raster_ds = info.get('dataset')
+        if raster_ds is None:
+            raster_ds = gdal.Open(info['path'], gdal.GA_ReadOnly)
+        no_data = info['nodata']
+        for bb in range(info['bands']):
+            band_array = raster_array[channel]
+            raster_ds.GetRasterBand(bb + 1).ReadAsArray(int(xoff), int(yoff), int(xsize), int(ysize),
+                                                        buf_obj=band_array)
+            if no_data is not None and (nodata_fill is not None or mask_array is not None):
+                nodata_mask = band_array == no_data
+                if mask_array is not None:
+                    mask_array[channel] = nodata_mask
+                if nodata_fill is not None:
+                    band_array[nodata_mask] = nodata_fill
+            elif mask_array is not None:
+                mask_array[channel] = False
+            channel += 1
+        # for
+        raster_ds = None
     # for
 
+    return raster_array
+
+
+def read_raster_list_window(info_list, xoff, yoff, xsize, ysize, buf_obj=None, native_dtype=False,
+                            nodata_fill=None, mask_obj=None):
+    """
+    按窗口读取栅格列表（GDAL窗口读取），用于按条带流式处理。
+    :param info_list: read_raster_list_info()的结果，多次读取时传入open_raster_list()的结果
+    :param xoff: 起始列
+    :param yoff: 起始行
+    :param xsize: 窗口列数
+    :param ysize: 窗口行数
+    :param buf_obj: 可复用的(T*B, ysize, xsize)数组，其数据类型决定读入类型
+    :param native_dtype: buf_obj为None时，是否按源数据类型分配
+    :param nodata_fill: nodata填充值，None则浮点型为NaN、整型保持原值
+    :param mask_obj: 可选的(T*B, ysize, xsize)布尔数组，写入nodata掩膜
+    :return: ndarray
+    """
+    num_band = sum(info['bands'] for info in info_list)
+    if buf_obj is None:
+        buf_obj = np.empty((num_band, ysize, xsize), dtype=raster_list_dtype(info_list, native_dtype))
+    assert (buf_obj.shape == (num_band, ysize, xsize))
+
+    return _read_raster_list_into(info_list, buf_obj, xoff, yoff, xsize, ysize, nodata_fill, mask_obj)
+
+
+def read_raster_list(raster_list, native_dtype=False, nodata_fill=None, return_mask=False):
+    """
+    读取多时相栅格列表。先读取全部元数据并检查网格一致性，然后一次性分配(T*B, H, W)数组，
+    由GDAL将各时相直接读入其所在切片，避免逐时相np.concatenate带来的重复拷贝。
+    默认转换为float32并将nodata置为NaN；native_dtype时保持源数据类型（如UInt16，内存减半），nodata以填充值或掩膜表示。
+    :param raster_list:
+    :param native_dtype: 保持源数据类型
+    :param nodata_fill: nodata填充值，None则float32时为NaN、源数据类型时保持原值
+    :param return_mask: 同时返回(T*B, H, W)的nodata掩膜
+    :return: ndarray，或(ndarray, mask)
+    """
+    print("### Reading reference raster {}".format(raster_list))
+
+    info_list = read_raster_list_info(raster_list)
+    num_band = sum(info['bands'] for info in info_list)
+    rows, cols = info_list[0]['rows'], info_list[0]['cols']
+
+    all_data = np.empty((num_band, rows, cols), dtype=raster_list_dtype(info_list, native_dtype))
+    nodata_mask = np.empty((num_band, rows, cols), dtype=bool) if return_mask else None
+    _read_raster_list_into(info_list, all_data, 0, 0, cols, rows, nodata_fill, nodata_mask)
+
+    print(f'Array shape: {all_data.shape}, {all_data.dtype}')
+    if return_mask:
+        return all_data, nodata_mask
     return all_data
 
 
@@ -126,6 +307,32 @@ def read_label_data(label_path):
     return raster_array
 
 
+def read_label_window(label_path, xoff, yoff, xsize, ysize, buf_obj=None):
+    """
+    按窗口读取标记栅格，nodata置为0，用于按条带流式处理。
+    :param label_path:
+    :param xoff: 起始列
+    :param yoff: 起始行
+    :param xsize: 窗口列数
+    :param ysize: 窗口行数
+    :param buf_obj: 可复用的(ysize, xsize)数组
+    :return: ndarray
+    """
+    raster_ds = gdal.Open(label_path, gdal.GA_ReadOnly)
+    if not raster_ds:
+        print('Unable to open image {}'.format(label_path))
+        sys.exit(1)
+
+    raster_band = raster_ds.GetRasterBand(1)
+    raster_array = raster_band.ReadAsArray(int(xoff), int(yoff), int(xsize), int(ysize), buf_obj=buf_obj)
+    no_data = raster_band.GetNoDataValue()
+    if no_data is not None:
+        raster_array[raster_array == no_data] = 0
+
+    raster_ds = None
+    return raster_array
+
+
 def write_raster_ref(raster_array, result_path, ref_path, format='GTiff'):
     print('### Writing result image...')
 
@@ -163,26 +370,262 @@ def write_raster_ref(raster_array, result_path, ref_path, format='GTiff'):
     print("### Success @ write_raster_with_ref() ##################")
 
 
-def write_slice_array(class_type, raster_data, target_path):
+class AsyncArrayWriter(object):
+    """
+    后台写出切片。
+    写请求进入有界队列，由线程池写盘，主循环可继续切片；队列已满时提交者阻塞（背压），内存占用有界。
+    flush()等待全部写请求完成，并抛出其间发生的所有写错误。
+    """
+    def __init__(self, max_workers=4, max_pending=256):
+        """
+        初始化
+        :param max_workers: 写盘线程数
+        :param max_pending: 队列中最多未完成的写请求数
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._futures = set()
+        self._errors = []
+
+    def submit(self, func, *args):
+        self._slots.acquire()
+        future = self._executor.submit(func, *args)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def flush(self):
+        """
+        等待全部写请求完成。
+        :return:
+        """
+        while True:
+            with self._lock:
+                pending = list(self._futures)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()
+        # while
+
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            messages = '\n'.join(str(err) for err in errors)
+            raise IOError('{} patch writes failed:\n{}'.format(len(errors), messages)) from errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+@contextlib.contextmanager
+def async_write(max_workers=4, max_pending=256):
+    """
+    在with块内，write_numpy_array()与write_slice_array()透明地交由后台线程写盘，退出时刷新并抛出写错误。
+    max_workers<=0时不启用，同步写出。
+    :param max_workers: 写盘线程数
+    :param max_pending: 队列中最多未完成的写请求数
+    :return:
+    """
+    global _ASYNC_WRITER
+    if max_workers <= 0 or _ASYNC_WRITER is not None:
+        yield _ASYNC_WRITER
+        return
+
+    _ASYNC_WRITER = AsyncArrayWriter(max_workers, max_pending)
+    try:
+        yield _ASYNC_WRITER
+    except BaseException as body_error:
+        # the block's own exception is the one raised, failed writes are chained to it
+        writer, _ASYNC_WRITER = _ASYNC_WRITER, None
+        try:
+            writer.close()
+        except IOError as flush_error:
+            raise body_error from flush_error
+        raise
+    writer, _ASYNC_WRITER = _ASYNC_WRITER, None
+    writer.close()
+
+
+def _save_numpy(target_path, numpy_array, codec=None):
+    """
+    写出一个切片：codec为None时为.npy文件，否则为压缩切片（扩展名仍为.npy，见patch_codec）。均经临时文件原子写出。
+    """
+    if codec is None:
+        save_npy_atomic(target_path, numpy_array)
+    else:
+        save_encoded_array(target_path, numpy_array, codec)
+
+
+def _save_numpy_array(target_path, numpy_array, codec=None):
+    if _ASYNC_WRITER is None:
+        _save_numpy(target_path, numpy_array, codec)
+        return
+
+    # views (e.g. of a reused strip buffer) may change before the write runs, so write a private copy
+    if not numpy_array.flags.owndata:
+        numpy_array = numpy_array.copy()
+    _ASYNC_WRITER.submit(_save_numpy, target_path, numpy_array, codec)
+
+
+def write_slice_array(class_type, raster_data, target_path, codec=None):
     print(f'Saving for type {class_type} on {target_path}')
 
     parent_dir = os.path.dirname(target_path)
     if not os.path.exists(parent_dir):
         os.makedirs(parent_dir)
 
-    np.save(target_path, raster_data)
+    _save_numpy_array(target_path, raster_data, codec)
     pass
 
 
-def write_numpy_array(numpy_array, target_path):
+def _save_numpy_batch(target_path_list, numpy_batch, codec=None):
+    for target_path, numpy_array in zip(target_path_list, numpy_batch):
+        _save_numpy(target_path, numpy_array, codec)
+
+
+def label_type_counts(label_data):
+    """
+    切片中各类别（0除外）的像元数。类别值较小时以bincount计数（不排序）；
+    出现负值，或最大值远大于切片像元数（如地块ID）时，改用np.unique，避免按最大值分配计数数组。
+    :param label_data: 标记切片
+    :return: (types, counts)，types升序
+    """
+    label_flat = label_data.ravel()
+    if label_flat.size > 0 and np.issubdtype(label_flat.dtype, np.integer) and \
+            label_flat.min() >= 0 and label_flat.max() <= 4 * label_flat.size:
+        counts = np.bincount(label_flat.astype(np.intp, copy=False))
+        counts[0] = 0
+        types = np.flatnonzero(counts)
+        return types, counts[types]
+
+    types, counts = np.unique(label_flat, return_counts=True)
+    keep = types != 0
+    return types[keep], counts[keep]
+
+
+def write_slice_batch(class_types, slice_batch, target_path_list, codec=None):
+    """
+    批量写出多个分层切片，slice_batch形状为(K, P, P)，后台写出时整批作为一个写请求。
+    :param class_types: K个类别（或地块ID）
+    :param slice_batch: 分层数组
+    :param target_path_list: K个写出路径
+    :param codec: 压缩编码，None为不压缩
+    :return:
+    """
+    for class_type, target_path in zip(class_types, target_path_list):
+        print(f'Saving for type {class_type} on {target_path}')
+
+    for parent_dir in set(os.path.dirname(target_path) for target_path in target_path_list):
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+
+    if _ASYNC_WRITER is None:
+        _save_numpy_batch(target_path_list, slice_batch, codec)
+        return
+    if not slice_batch.flags.owndata:
+        slice_batch = slice_batch.copy()
+    _ASYNC_WRITER.submit(_save_numpy_batch, list(target_path_list), slice_batch, codec)
+
+
+def write_patch_sample(class_type, raster_data, target_path, codec=None):
+    """
+    写出样本切片（栅格数据按类别掩膜后的切片），与write_slice_array相同。
+    """
+    return write_slice_array(class_type, raster_data, target_path, codec)
+
+
+def write_numpy_array(numpy_array, target_path, codec=None):
 
     # parent_dir = os.path.dirname(target_path)
     # if not os.path.exists(parent_dir):
     #     os.makedirs(parent_dir)
 
-    np.save(target_path, numpy_array)
+    _save_numpy_array(target_path, numpy_array, codec)
     pass
 
 
-def load_numpy_array(array_path):
-    return np.load(array_path)
+def load_numpy_array(array_path, mmap_mode=None):
+    """
+    读取切片，依据文件头自动识别.npy与压缩切片（见patch_codec）。
+    :param array_path:
+    :param mmap_mode: None整体读入；'r'等则以内存映射方式打开，只有被访问的页才会读入。压缩切片不能内存映射，总是解码读入
+    :return:
+    """
+    # the file is opened once, its first bytes tell a compressed patch from an .npy file
+    with open(array_path, 'r+b' if mmap_mode == 'r+' else 'rb') as f:
+        magic = f.read(len(CODEC_MAGIC))
+        if magic == CODEC_MAGIC:
+            return decode_array(magic + f.read())
+        f.seek(0)
+        if mmap_mode is None:
+            return np.lib.format.read_array(f)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return np.load(array_path, mmap_mode=mmap_mode)
+        return np.memmap(f, dtype=dtype, mode=mmap_mode, shape=shape, order='F' if fortran_order else 'C',
+                         offset=f.tell())
+
+
+class NumpyArrayReader(object):
+    """
+    .npy切片读取器。
+    mmap_mode不为None时以内存映射方式打开切片；reuse_buffer为True时，相同槽位、形状与数据类型的切片复用同一缓冲区，
+    直接将文件内容读入缓冲区，避免每个切片一次内存分配。复用缓冲区时，返回的数组在同一槽位下一次读取前有效。
+    """
+    def __init__(self, mmap_mode=None, reuse_buffer=False):
+        self.mmap_mode = mmap_mode
+        self.reuse_buffer = reuse_buffer
+        self._buffers = {}
+
+    def read(self, array_path, slot=0):
+        """
+        读取切片。
+        :param array_path:
+        :param slot: 缓冲区槽位，需要同时持有多个切片时使用不同槽位
+        :return:
+        """
+        if self.mmap_mode is not None or not self.reuse_buffer:
+            return load_numpy_array(array_path, self.mmap_mode)
+
+        with open(array_path, 'rb') as f:
+            if f.read(len(np.lib.format.MAGIC_PREFIX)) != np.lib.format.MAGIC_PREFIX:
+                # compressed patch, decoded into a fresh array
+                return load_numpy_array(array_path)
+            f.seek(0)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                return load_numpy_array(array_path)
+            if fortran_order or dtype.hasobject:
+                return load_numpy_array(array_path)
+
+            key = (slot, shape, dtype.str)
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = np.empty(shape, dtype=dtype)
+                self._buffers[key] = buffer
+            num_read = f.readinto(buffer.reshape(-1).view(np.uint8))
+            assert (num_read == buffer.nbytes)
+
+        return buffer
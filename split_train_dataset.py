@@ -10,7 +10,8 @@ import os, sys, time
 import argparse
 import yaml
 
-from pre import TrainDatasetSplit
+from memory_planner import MemoryPlanner
+from cost_estimator import CostEstimator, calibrate_throughput
 
 
 def parse_args():
@@ -18,6 +19,12 @@ def parse_args():
     parser.add_argument('--config_path', required=False, type=str,
                         default="./config/conf.yaml",
                         help='configure file for main process in YAML format')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='only estimate grid and slice counts, output size, peak RAM and time of the run')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='measure the throughput of this machine into temp_folder before the dry run')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only split new or changed rasters and append their bands to the stacked grids')
     opts = parser.parse_args()
     return opts
 
@@ -34,8 +41,12 @@ def configure_info(yaml_path):
 
         patch_size = int(cfg['patch_size'])
         min_pixel_percent = float(cfg['min_pixel_percent'])
+        memory_budget = cfg.get('memory_budget', '8GB')
+        temp_folder = cfg.get('temp_folder')
+        workers = int(cfg.get('workers', 1))
 
-    return config_name, label_path, raster_list, result_folder, patch_size, min_pixel_percent
+    return config_name, label_path, raster_list, result_folder, patch_size, min_pixel_percent, memory_budget, \
+        temp_folder, workers
 
 
 def main():
@@ -49,14 +60,41 @@ def main():
     yaml_path = opts.config_path
     yaml_path = r'E:\develop_project\github-self\timeseries_dataset\config\dijon_train.yaml'
 
-    config_name, label_path, raster_list, result_folder, patch_size, min_pixel_percent = configure_info(yaml_path)
+    config_name, label_path, raster_list, result_folder, patch_size, min_pixel_percent, memory_budget, \
+        temp_folder, workers = configure_info(yaml_path)
+
+    #######################################################
+    # dry run
+    if opts.dry_run:
+        if opts.calibrate:
+            calibrate_throughput(temp_folder, patch_size, raster_path=raster_list[0])
+        estimator = CostEstimator(raster_list, label_path, patch_size, min_pixel_percent, memory_budget, temp_folder,
+                                  workers=workers, incremental=opts.incremental)
+        estimator.prepare_data()
+        estimator.report()
+        return
 
     #######################################################
     # do
-    tdsd = TrainDatasetSplit(label_path, raster_list, result_folder, patch_size, min_pixel_percent)
-    tdsd.generate_grid_code()
-    tdsd.prepare_data()
-    # tdsd.generate()
+    planner = MemoryPlanner(raster_list, label_path, patch_size, memory_budget, workers=workers)
+    planner.prepare_data()
+    plan = planner.make_plan()
+
+    lds = planner.label_splitter(os.path.join(result_folder, config_name, 'label'))
+    lds.prepare_data()
+    lds.generate_grid_code()
+    lds.split_grid_label()
+    # the label and raster stages are each planned against the whole budget, so they must not overlap
+    lds.release_data()
+    del lds
+
+    rds = planner.raster_splitter(os.path.join(result_folder, config_name, 'raster'), incremental=opts.incremental)
+    rds.prepare_data()
+    rds.generate_grid_code()
+    if opts.incremental or plan['group_size'] < plan['num_dates']:
+        rds.accumulate_grid_raster()
+    else:
+        rds.split_grid_raster()
 
     #######################################################
     # close
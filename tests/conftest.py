@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared fixtures: in-memory replacements of the GDAL window readers in raster_util
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import sys
+import types
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def random_parcel_map():
+    """
+    随机地块ID栅格：num_parcels个地块（ID可稀疏地分布到max_id），background比例的像元为背景0。
+    """
+    def make_parcel_map(rng, rows, cols, num_parcels, max_id=None, background=0.3):
+        parcel_ids = np.arange(1, num_parcels + 1) if max_id is None else \
+            np.sort(rng.choice(np.arange(1, max_id + 1), num_parcels, replace=False))
+        parcel_data = parcel_ids[rng.integers(0, num_parcels, (rows, cols))].astype(np.uint32)
+        parcel_data[rng.random((rows, cols)) < background] = 0
+        return parcel_data
+    return make_parcel_map
+
+
+@pytest.fixture
+def raster_readers():
+    """
+    由内存数组生成与raster_util相同签名的读取函数。
+    """
+    def label_window(label_data):
+        def read_label_window(label_path, xoff, yoff, xsize, ysize, buf_obj=None):
+            window = label_data[yoff:yoff + ysize, xoff:xoff + xsize]
+            if buf_obj is None:
+                return window.copy()
+            buf_obj[...] = window
+            return buf_obj
+        return read_label_window
+
+    def raster_list_window(raster_data):
+        def read_raster_list_window(info_list, xoff, yoff, xsize, ysize, buf_obj=None, native_dtype=False,
+                                    nodata_fill=None, mask_obj=None):
+            window = raster_data[:, yoff:yoff + ysize, xoff:xoff + xsize]
+            if buf_obj is None:
+                return window.copy()
+            buf_obj[...] = window
+            return buf_obj
+        return read_raster_list_window
+
+    def raster_info(rows, cols, bands=1, block_rows=8, nodata=None, dtype=np.float32):
+        def read_raster_info(raster_path):
+            return {'path': raster_path, 'rows': rows, 'cols': cols, 'bands': bands,
+                    'block_size': (cols, block_rows), 'nodata': nodata, 'dtype': np.dtype(dtype)}
+        return read_raster_info
+
+    return types.SimpleNamespace(label_window=label_window, raster_list_window=raster_list_window,
+                                 raster_info=raster_info)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the chunk manifest: crash and resume, and reruns over other grids
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+import pytest
+
+from parallel_util import ChunkManifest, manifest_signature, run_chunks, chunk_result
+from patch_store import PatchStore, PatchStoreWriter
+
+
+class StoreStage(object):
+    """
+    每个条目写入一个切片的集中存储阶段，start >= fail_at的块写出一半后中断。
+    """
+    def __init__(self, store_folder, grid_codes, fail_at=None):
+        self.store_folder = store_folder
+        self.grid_codes = grid_codes
+        self.fail_at = fail_at
+        self.processed = []
+
+    def _chunk(self, start, end, chunk_id):
+        writer = PatchStoreWriter(self.store_folder, prefix='part_{:0>8d}'.format(chunk_id), part_bytes=64)
+        for ii in range(start, end):
+            if self.fail_at is not None and start >= self.fail_at and ii > start:
+                raise RuntimeError('crash in chunk {}'.format(start))
+            writer.write(self.grid_codes[ii], np.full((2, 4, 4), ii, dtype=np.int32))
+            self.processed.append(ii)
+        writer.close()
+        return chunk_result(end - start, writer)
+
+
+def grid_codes(num_grid, offset=0):
+    return ['{:0>5d}_{:0>5d}_00000_00004'.format((ii + offset) * 4, (ii + offset + 1) * 4) for ii in range(num_grid)]
+
+
+def run_stage(store_folder, codes, fail_at=None, patch_size=4):
+    stage = StoreStage(store_folder, codes, fail_at)
+    manifest = ChunkManifest(store_folder, manifest_signature(len(codes), codes, output_format='store',
+                                                              patch_size=patch_size))
+    run_chunks(stage, '_chunk', len(codes), 1, desc='test', chunks_per_worker=8, manifest=manifest)
+    return stage
+
+
+def check_store(store_folder, codes):
+    store = PatchStore(store_folder)
+    assert sorted(store.keys) == sorted(codes)
+    for code in codes:
+        assert np.all(store[code] == codes.index(code))
+
+
+def test_resume_after_crash(tmp_path):
+    store_folder = str(tmp_path / 'store')
+    codes = grid_codes(40)
+    with pytest.raises(RuntimeError):
+        run_stage(store_folder, codes, fail_at=20)
+    # the crashed chunk left a part file that no manifest record covers
+    assert any(name.startswith('part_00000020') for name in os.listdir(store_folder))
+
+    stage = run_stage(store_folder, codes)
+    assert stage.processed == list(range(20, 40))
+    check_store(store_folder, codes)
+
+
+def test_rerun_over_other_grids_starts_over(tmp_path):
+    store_folder = str(tmp_path / 'store')
+    run_stage(store_folder, grid_codes(40))
+
+    # same number of grids, but other grids
+    new_codes = grid_codes(40, offset=3)
+    stage = run_stage(store_folder, new_codes)
+    assert stage.processed == list(range(40))
+    check_store(store_folder, new_codes)
+
+    # same grids, other parameters
+    stage = run_stage(store_folder, new_codes, patch_size=8)
+    assert stage.processed == list(range(40))
+
+    stage = run_stage(store_folder, new_codes, patch_size=8)
+    assert stage.processed == []
+
+
+def test_manifest_without_header_is_discarded(tmp_path):
+    store_folder = str(tmp_path / 'store')
+    codes = grid_codes(16)
+    run_stage(store_folder, codes)
+
+    manifest = ChunkManifest(store_folder)
+    with open(manifest.manifest_path, 'r') as f:
+        lines = f.readlines()
+    with open(manifest.manifest_path, 'w') as f:
+        f.writelines(lines[1:])
+
+    stage = run_stage(store_folder, codes)
+    assert stage.processed == list(range(16))
+    check_store(store_folder, codes)
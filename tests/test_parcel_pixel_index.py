@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the parcel to pixel CSR index on synthetic parcel maps
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+import pre.parcel_pixel_index as parcel_pixel_index
+from pre.parcel_pixel_index import ParcelPixelIndex
+
+
+@pytest.fixture
+def parcel_raster(tmp_path, monkeypatch, raster_readers, random_parcel_map):
+    """
+    地块ID栅格（内存数组），返回(栅格路径, 数组)；栅格文件只用于判断索引是否过期。
+    """
+    rng = np.random.default_rng(0)
+    parcel_data = random_parcel_map(rng, 53, 41, 30, max_id=100000)
+    # one parcel split into two far apart pieces
+    parcel_data[50:, :4] = parcel_data[0, 0] if parcel_data[0, 0] else 7
+    parcel_path = str(tmp_path / 'parcel.tif')
+    with open(parcel_path, 'wb') as f:
+        f.write(b'parcel')
+
+    monkeypatch.setattr(parcel_pixel_index, 'read_raster_info', raster_readers.raster_info(*parcel_data.shape))
+    monkeypatch.setattr(parcel_pixel_index, 'read_label_window', raster_readers.label_window(parcel_data))
+    return parcel_path, parcel_data
+
+
+def build_index(parcel_path, block_rows):
+    index = ParcelPixelIndex(parcel_path, block_rows=block_rows)
+    index.prepare_data()
+    return index.build()
+
+
+@pytest.mark.parametrize('block_rows', [1, 7, 1024])
+def test_index_matches_flatnonzero(parcel_raster, block_rows):
+    parcel_path, parcel_data = parcel_raster
+    index = build_index(parcel_path, block_rows)
+
+    parcel_flat = parcel_data.ravel()
+    assert np.array_equal(index.parcel_ids(), np.unique(parcel_flat[parcel_flat > 0]))
+    assert index.indptr[-1] == np.count_nonzero(parcel_flat)
+    assert index.indptr.size == parcel_flat.max() + 2
+    for parcel_id in index.parcel_ids():
+        assert np.array_equal(index.pixels(parcel_id), np.flatnonzero(parcel_flat == parcel_id))
+        assert index.num_pixels(parcel_id) == np.count_nonzero(parcel_flat == parcel_id)
+    assert index.pixels(parcel_flat.max() + 10).size == 0
+
+
+def test_load_round_trip(parcel_raster):
+    parcel_path, parcel_data = parcel_raster
+    index = build_index(parcel_path, 8)
+    loaded = ParcelPixelIndex.load(parcel_path, mmap_mode=None)
+
+    assert (loaded.rows, loaded.cols) == parcel_data.shape
+    assert np.array_equal(loaded.indptr, index.indptr)
+    assert np.array_equal(loaded.indices, index.indices)
+    assert not os.path.exists(index.index_prefix + '.parcel_build.ids')
+
+
+def test_open_rebuilds_stale_index(parcel_raster, monkeypatch, raster_readers, random_parcel_map):
+    parcel_path, parcel_data = parcel_raster
+    build_index(parcel_path, 8)
+    assert ParcelPixelIndex(parcel_path).is_current()
+
+    # a regenerated parcel map: different IDs, and a different file
+    new_data = random_parcel_map(np.random.default_rng(1), 53, 41, 60)
+    monkeypatch.setattr(parcel_pixel_index, 'read_label_window', raster_readers.label_window(new_data))
+    with open(parcel_path, 'ab') as f:
+        f.write(b'regenerated')
+    assert not ParcelPixelIndex(parcel_path).is_current()
+
+    index = ParcelPixelIndex.open(parcel_path)
+    new_flat = new_data.ravel()
+    assert np.array_equal(index.parcel_ids(), np.unique(new_flat[new_flat > 0]))
+    assert ParcelPixelIndex(parcel_path).is_current()
+
+    # a raster of another size invalidates the index as well
+    monkeypatch.setattr(parcel_pixel_index, 'read_raster_info', raster_readers.raster_info(54, 41))
+    assert not ParcelPixelIndex(parcel_path).is_current()
+
+
+def test_gather_and_read_parcel(parcel_raster, monkeypatch, raster_readers):
+    parcel_path, parcel_data = parcel_raster
+    index = build_index(parcel_path, 16)
+    stack = np.random.default_rng(2).random((5,) + parcel_data.shape).astype(np.float32)
+    monkeypatch.setattr(parcel_pixel_index, 'read_raster_list_window', raster_readers.raster_list_window(stack))
+    info_list = [{'bands': 5}]
+
+    for parcel_id in index.parcel_ids():
+        expected = stack[:, parcel_data == parcel_id]
+        assert np.array_equal(index.gather(stack, parcel_id), expected)
+        assert np.array_equal(index.read_parcel(info_list, parcel_id), expected)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the per-parcel temporal statistics against NumPy references
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import warnings
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+import dataset.parcel_statistics as parcel_statistics
+import pre.parcel_pixel_index as parcel_pixel_index
+from dataset.parcel_statistics import ParcelStatistics, grouped_percentiles
+
+NUM_DATES, DATE_BANDS = 3, 2
+PERCENTILES = (0, 10, 25, 50, 75, 90, 100)
+
+
+def nan_reference(values, percentiles=PERCENTILES):
+    """
+    (C, N)像元值的NumPy统计量，无有效值时为NaN。
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        reference = {'mean': np.nanmean(values, axis=1), 'std': np.nanstd(values, axis=1),
+                     'min': np.nanmin(values, axis=1), 'max': np.nanmax(values, axis=1)}
+        for percentile in percentiles:
+            reference['p{:0>2d}'.format(percentile)] = np.nanpercentile(values, percentile, axis=1)
+    return reference
+
+
+def test_grouped_percentiles():
+    rng = np.random.default_rng(0)
+    values = rng.normal(100, 30, (4, 500))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    group_index = rng.integers(0, 12, 500)
+    values[:, group_index == 5] = np.nan
+
+    # group 12 has no values at all
+    result = grouped_percentiles(values, group_index, 13, PERCENTILES)
+    assert result.shape == (len(PERCENTILES), 4, 13)
+    assert np.all(np.isnan(result[:, :, 12]))
+    for gg in range(12):
+        reference = nan_reference(values[:, group_index == gg])
+        for qq, percentile in enumerate(PERCENTILES):
+            assert np.allclose(result[qq, :, gg], reference['p{:0>2d}'.format(percentile)], equal_nan=True)
+
+
+@pytest.fixture
+def synthetic_rasters(tmp_path, monkeypatch, raster_readers, random_parcel_map):
+    """
+    float32时序栅格（含NaN）与稀疏大ID的地块ID栅格，返回(地块栅格路径, 时序栅格, 地块栅格)。
+    """
+    rng = np.random.default_rng(0)
+    parcel_data = random_parcel_map(rng, 61, 37, 25, max_id=10 ** 7)
+    parcel_ids = np.unique(parcel_data[parcel_data > 0])
+    # a parcel that reappears far below, one without valid values and one without valid values on a channel
+    parcel_data[55:, :6] = parcel_ids[0]
+    raster_data = rng.normal(1000, 300, (NUM_DATES * DATE_BANDS,) + parcel_data.shape).astype(np.float32)
+    raster_data[rng.random(raster_data.shape) < 0.1] = np.nan
+    raster_data[:, parcel_data == parcel_ids[1]] = np.nan
+    raster_data[0, parcel_data == parcel_ids[2]] = np.nan
+
+    parcel_path = str(tmp_path / 'parcel.tif')
+    with open(parcel_path, 'wb') as f:
+        f.write(b'parcel')
+    info = raster_readers.raster_info(*parcel_data.shape, bands=DATE_BANDS)
+    monkeypatch.setattr(parcel_statistics, 'read_raster_list_info',
+                        lambda raster_list: [info(path) for path in raster_list])
+    monkeypatch.setattr(parcel_statistics, 'open_raster_list', lambda info_list: info_list)
+    monkeypatch.setattr(parcel_statistics, 'read_raster_list_window', raster_readers.raster_list_window(raster_data))
+    monkeypatch.setattr(parcel_statistics, 'read_label_window', raster_readers.label_window(parcel_data))
+    monkeypatch.setattr(parcel_pixel_index, 'read_raster_info', info)
+    monkeypatch.setattr(parcel_pixel_index, 'read_label_window', raster_readers.label_window(parcel_data))
+    return parcel_path, raster_data, parcel_data
+
+
+def compute(tmp_path, parcel_path, block_rows, percentiles=PERCENTILES):
+    pst = ParcelStatistics(['raster'] * NUM_DATES, parcel_path, str(tmp_path / 'statistics.npz'),
+                           block_rows=block_rows, percentiles=percentiles)
+    pst.prepare_data()
+    pst.compute_statistics()
+    return pst
+
+
+def check_features(pst, raster_data, parcel_data, percentiles=PERCENTILES):
+    parcel_ids, pixel_count, feature_names, features = pst.feature_table()
+    assert np.array_equal(parcel_ids, np.unique(parcel_data[parcel_data > 0]))
+    channel_names = ['t{:0>2d}_b{:0>2d}'.format(cc // DATE_BANDS, cc % DATE_BANDS)
+                     for cc in range(NUM_DATES * DATE_BANDS)]
+
+    for ii, parcel_id in enumerate(parcel_ids):
+        parcel_values = raster_data[:, parcel_data == parcel_id].astype(np.float64)
+        assert pixel_count[ii] == parcel_values.shape[1]
+        for stat, reference in nan_reference(parcel_values, percentiles).items():
+            columns = [feature_names.index('{}_{}'.format(stat, name)) for name in channel_names]
+            assert np.allclose(features[ii, columns], reference, rtol=1e-5, atol=1e-3, equal_nan=True), stat
+
+
+@pytest.mark.parametrize('block_rows', [1, 5, 64])
+def test_statistics_match_numpy(tmp_path, synthetic_rasters, block_rows):
+    parcel_path, raster_data, parcel_data = synthetic_rasters
+    pst = compute(tmp_path, parcel_path, block_rows)
+
+    # accumulators are sized by the parcels, not by the largest parcel ID
+    assert pst.count.shape == (NUM_DATES * DATE_BANDS, np.unique(parcel_data[parcel_data > 0]).size)
+    check_features(pst, raster_data, parcel_data)
+
+    result = np.load(pst.save())
+    assert result['features'].shape[0] == result['parcel_id'].size
+
+
+def test_statistics_without_percentiles(tmp_path, synthetic_rasters):
+    parcel_path, raster_data, parcel_data = synthetic_rasters
+    pst = compute(tmp_path, parcel_path, 8, percentiles=None)
+    check_features(pst, raster_data, parcel_data, percentiles=())
+
+
+def test_stale_index_is_rebuilt(tmp_path, synthetic_rasters, monkeypatch, raster_readers, random_parcel_map):
+    parcel_path, raster_data, parcel_data = synthetic_rasters
+    compute(tmp_path, parcel_path, 8)
+
+    # the parcel map is regenerated with other IDs after the index was built
+    new_data = random_parcel_map(np.random.default_rng(1), *parcel_data.shape, 40)
+    monkeypatch.setattr(parcel_statistics, 'read_label_window', raster_readers.label_window(new_data))
+    monkeypatch.setattr(parcel_pixel_index, 'read_label_window', raster_readers.label_window(new_data))
+    with open(parcel_path, 'ab') as f:
+        f.write(b'regenerated')
+
+    pst = compute(tmp_path, parcel_path, 8)
+    check_features(pst, raster_data, new_data)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the pixel-set export on synthetic rasters
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+import dataset.pixel_set as pixel_set
+from dataset.pixel_set import PixelSetExport, PixelSetStore, PixelSetDataset
+
+NUM_DATES, DATE_BANDS = 4, 3
+
+
+@pytest.fixture
+def synthetic_rasters(monkeypatch, random_parcel_map):
+    """
+    UInt16时序栅格（nodata为0）、地块ID栅格与类别栅格。
+    """
+    rng = np.random.default_rng(0)
+    parcel_data = random_parcel_map(rng, 40, 50, 80, max_id=5000)
+    label_data = rng.integers(0, 6, parcel_data.shape).astype(np.uint8)
+    raster_data = rng.integers(1, 10000, (NUM_DATES * DATE_BANDS,) + parcel_data.shape).astype(np.uint16)
+    raster_data[rng.random(raster_data.shape) < 0.05] = 0
+
+    def read_raster_list(raster_list, native_dtype=False, nodata_fill=None, return_mask=False):
+        if native_dtype:
+            return raster_data.copy()
+        return np.where(raster_data == 0, np.nan, raster_data).astype(np.float32)
+
+    monkeypatch.setattr(pixel_set, 'read_raster_list', read_raster_list)
+    monkeypatch.setattr(pixel_set, 'read_raster_info', lambda path: {'bands': DATE_BANDS})
+    monkeypatch.setattr(pixel_set, 'read_raster_list_info',
+                        lambda raster_list: [{'bands': DATE_BANDS, 'nodata': 0}] * NUM_DATES)
+    monkeypatch.setattr(pixel_set, 'read_label_data', lambda path: {'parcel': parcel_data, 'label': label_data}[path])
+    return raster_data, parcel_data, label_data
+
+
+def export(tmp_path, **kwargs):
+    result_folder = str(tmp_path / 'pixel_set')
+    pse = PixelSetExport(['raster'] * NUM_DATES, 'parcel', result_folder, label_path='label', **kwargs)
+    pse.prepare_data()
+    pse.export_pixel_set(chunk_pixels=100)
+    return PixelSetStore(result_folder)
+
+
+def parcel_reference(raster_data, parcel_data, parcel_id):
+    return raster_data[:, parcel_data == parcel_id].T.reshape(-1, NUM_DATES, DATE_BANDS)
+
+
+def test_full_export_matches_raster(tmp_path, synthetic_rasters):
+    raster_data, parcel_data, label_data = synthetic_rasters
+    store = export(tmp_path)
+
+    assert not store.has_mask
+    assert np.array_equal(store.parcel_id, np.unique(parcel_data[parcel_data > 0]))
+    for ii, parcel_id in enumerate(store.parcel_id):
+        reference = parcel_reference(raster_data, parcel_data, parcel_id)
+        pixels = store.parcel(parcel_id)
+        assert pixels.dtype == np.float32
+        assert np.array_equal(np.isnan(pixels), reference == 0)
+        assert np.array_equal(np.nan_to_num(pixels), reference)
+
+        class_counts = np.bincount(label_data[parcel_data == parcel_id])
+        assert class_counts[store.label[ii]] == class_counts.max()
+
+
+def test_native_dtype_exports_nodata_mask(tmp_path, synthetic_rasters):
+    raster_data, parcel_data, _ = synthetic_rasters
+    store = export(tmp_path, native_dtype=True, shard_pixels=300)
+
+    assert store.has_mask
+    for ii, parcel_id in enumerate(store.parcel_id):
+        reference = parcel_reference(raster_data, parcel_data, parcel_id)
+        assert store.get(ii).dtype == np.uint16
+        assert np.array_equal(store.get(ii), reference)
+        assert np.array_equal(store.get_mask(ii), reference == 0)
+
+
+@pytest.mark.parametrize('shard_pixels', [1, 40, 50, 300, 10 ** 9])
+def test_shards_respect_the_size_limit(tmp_path, synthetic_rasters, shard_pixels):
+    raster_data, parcel_data, _ = synthetic_rasters
+    store = export(tmp_path, shard_pixels=shard_pixels)
+
+    shard_sizes = np.array([np.load(path, mmap_mode='r').shape[0] for path in store.shard_path_list])
+    shard_parcels = np.bincount(store.shard, minlength=shard_sizes.size)
+    assert shard_sizes.sum() == np.count_nonzero(parcel_data)
+    # only a parcel larger than the limit makes an oversized shard, alone
+    assert np.all((shard_sizes <= shard_pixels) | (shard_parcels == 1))
+    # greedy: the next shard's first parcel did not fit in the previous shard
+    first_parcel = np.searchsorted(store.shard, np.arange(1, shard_sizes.size))
+    assert np.all(shard_sizes[:-1] + store.count[first_parcel] > shard_pixels)
+
+    # parcels are contiguous within their shard and stay in ID order
+    assert np.all(np.diff(store.shard) >= 0)
+    assert np.all(store.start + store.count <= shard_sizes[store.shard])
+    for ii, parcel_id in enumerate(store.parcel_id):
+        assert np.array_equal(np.nan_to_num(store.get(ii)), parcel_reference(raster_data, parcel_data, parcel_id))
+
+
+def test_pixel_sampling(tmp_path, synthetic_rasters):
+    raster_data, parcel_data, _ = synthetic_rasters
+    sample_pixels = 8
+    store = export(tmp_path, sample_pixels=sample_pixels, shard_pixels=100, seed=3)
+    position = np.load(str(tmp_path / 'pixel_set' / 'parcels.npz'))['position']
+
+    full_counts = np.array([np.count_nonzero(parcel_data == pp) for pp in store.parcel_id])
+    assert np.array_equal(store.count, np.minimum(full_counts, sample_pixels))
+    assert position.size == store.count.sum()
+
+    parcel_offsets = np.concatenate([[0], np.cumsum(store.count)])
+    raster_flat = raster_data.reshape(NUM_DATES * DATE_BANDS, -1)
+    for ii, parcel_id in enumerate(store.parcel_id):
+        parcel_position = position[parcel_offsets[ii]:parcel_offsets[ii + 1]]
+        # distinct pixels of the parcel, in raster order
+        assert np.all(np.diff(parcel_position) > 0)
+        assert np.all(parcel_data.ravel()[parcel_position] == parcel_id)
+        expected = raster_flat[:, parcel_position].T.reshape(-1, NUM_DATES, DATE_BANDS)
+        assert np.array_equal(np.nan_to_num(store.get(ii)), expected)
+
+    # the same seed draws the same pixels
+    same_store = export(tmp_path, sample_pixels=sample_pixels, shard_pixels=100, seed=3)
+    assert np.array_equal(np.load(str(tmp_path / 'pixel_set' / 'parcels.npz'))['position'], position)
+    assert np.array_equal(same_store.count, store.count)
+
+
+def test_dataset_samples(tmp_path, synthetic_rasters):
+    export(tmp_path, native_dtype=True)
+    sample_pixels = 16
+    dataset = PixelSetDataset(str(tmp_path / 'pixel_set'), sample_pixels=sample_pixels, to_tensor=False)
+    store = dataset.store
+
+    for ii in range(len(dataset)):
+        pixel_data, pixel_mask, label = dataset[ii]
+        num_pixels = int(store.count[ii])
+        assert pixel_data.shape == (sample_pixels, NUM_DATES, DATE_BANDS)
+        assert pixel_data.dtype == np.float32
+        assert pixel_mask.sum() == min(num_pixels, sample_pixels)
+        assert label == store.label[ii]
+        # nodata of the native-dtype export is NaN in the samples
+        parcel_values = store.get(ii).astype(np.float32)
+        parcel_values[store.get_mask(ii)] = np.nan
+        for pixel in pixel_data:
+            assert np.any(np.all((parcel_values == pixel) | (np.isnan(parcel_values) & np.isnan(pixel)), axis=(1, 2)))
+
+
+def test_reexport_removes_stale_shards(tmp_path, synthetic_rasters):
+    raster_data, parcel_data, _ = synthetic_rasters
+    store = export(tmp_path, native_dtype=True, shard_pixels=40)
+    assert store.has_mask and len(store.shard_path_list) > 1
+
+    # fewer shards and no masks this time
+    store = export(tmp_path, shard_pixels=10 ** 9)
+    assert not store.has_mask
+    assert len(store.shard_path_list) == 1
+    for ii, parcel_id in enumerate(store.parcel_id):
+        assert np.array_equal(np.nan_to_num(store.get(ii)), parcel_reference(raster_data, parcel_data, parcel_id))
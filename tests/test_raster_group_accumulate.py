@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the grouped raster accumulation and its incremental update
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+import grid.raster_group_accumulate as raster_group_accumulate
+from grid.raster_group_accumulate import RasterGroupAccumulate
+from patch_store import PatchStore, grow_npy_channels
+
+ROWS, COLS, DATE_BANDS, PATCH_SIZE = 20, 24, 2, 4
+
+
+def save_npy_padded(array_path, numpy_array):
+    """
+    以其他写出方式的文件头写出.npy：文件头比np.save多补齐128字节，扩展时文件头长度随之变化。
+    """
+    header = repr({'descr': np.lib.format.dtype_to_descr(numpy_array.dtype), 'fortran_order': False,
+                   'shape': numpy_array.shape})
+    header += ' ' * (-(len(np.lib.format.MAGIC_PREFIX) + 4 + len(header) + 1) % 64 + 128) + '\n'
+    with open(array_path, 'wb') as f:
+        f.write(np.lib.format.MAGIC_PREFIX + bytes([1, 0]) + len(header).to_bytes(2, 'little') + header.encode())
+        f.write(np.ascontiguousarray(numpy_array).tobytes())
+
+
+@pytest.mark.parametrize('save', [np.save, save_npy_padded])
+def test_grow_npy_channels(tmp_path, save):
+    array_path = str(tmp_path / 'grid.npy')
+    old_array = np.arange(2 * 4 * 4, dtype=np.float32).reshape(2, 4, 4)
+    save(array_path, old_array)
+    header_size = os.path.getsize(array_path) - old_array.nbytes
+
+    grow_npy_channels(array_path, 12)
+    new_array = np.load(array_path)
+    assert new_array.shape == (12, 4, 4)
+    assert np.array_equal(new_array[:2], old_array)
+    assert not np.any(new_array[2:])
+    if save is np.save:
+        assert os.path.getsize(array_path) - new_array.nbytes == header_size
+    else:
+        assert os.path.getsize(array_path) - new_array.nbytes != header_size
+
+    assert grow_npy_channels(array_path, 12) == array_path
+    assert np.array_equal(np.load(array_path), new_array)
+
+
+class SyntheticSources(object):
+    """
+    每个时相一个小文件（用于源栅格标识）与一个(B, H, W)数组，读取时记录被读取的时相。
+    """
+    def __init__(self, tmp_path, monkeypatch, raster_readers):
+        self.tmp_path = tmp_path
+        self.rng = np.random.default_rng(0)
+        self.data = {}
+        self.bands = {}
+        self.read_paths = []
+
+        def read_raster_list_info(raster_list):
+            info_list = []
+            for path in raster_list:
+                info = raster_readers.raster_info(ROWS, COLS, bands=self.bands[path])(path)
+                info['geo_transform'] = (0.0, 10.0, 0.0, 0.0, 0.0, -10.0)
+                info_list.append(info)
+            return info_list
+
+        def read_raster_list_window(info_list, xoff, yoff, xsize, ysize, buf_obj=None, **kwargs):
+            self.read_paths.extend(info['path'] for info in info_list)
+            stack = np.concatenate([self.data[info['path']] for info in info_list], axis=0)
+            return raster_readers.raster_list_window(stack)(info_list, xoff, yoff, xsize, ysize, buf_obj=buf_obj)
+
+        monkeypatch.setattr(raster_group_accumulate, 'read_raster_list_info', read_raster_list_info)
+        monkeypatch.setattr(raster_group_accumulate, 'read_raster_list_window', read_raster_list_window)
+        monkeypatch.setattr(raster_group_accumulate, 'open_raster_list', lambda info_list: info_list)
+
+    def write(self, date, bands=DATE_BANDS):
+        path = str(self.tmp_path / 'date_{:0>2d}.tif'.format(date))
+        self.data[path] = self.rng.normal(1000, 300, (bands, ROWS, COLS)).astype(np.float32)
+        self.bands[path] = bands
+        with open(path, 'wb') as f:
+            f.write(self.data[path].tobytes())
+        return path
+
+    def stack(self, raster_list):
+        return np.concatenate([self.data[path] for path in raster_list], axis=0)
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch, raster_readers):
+    return SyntheticSources(tmp_path, monkeypatch, raster_readers)
+
+
+def accumulate(tmp_path, raster_list, output_format, incremental=True):
+    rga = RasterGroupAccumulate(raster_list, str(tmp_path / 'raster'), PATCH_SIZE, group_size=2,
+                                output_format=output_format, incremental=incremental)
+    rga.prepare_data()
+    rga.generate_grid_code()
+    rga.accumulate_grid_raster()
+    return rga
+
+
+def check_outputs(rga, stack):
+    num_grid = rga.grid_code.shape[0]
+    store = PatchStore(rga.result_folder) if rga.output_format == 'store' else None
+    for gg, code in enumerate(rga.grid_code):
+        r_s, r_e, c_s, c_e = code
+        grid_data = store[rga.grid_name(code)] if store is not None else np.load(rga._grid_path(gg, num_grid))
+        assert np.array_equal(grid_data, stack[:, r_s:r_e, c_s:c_e])
+
+
+@pytest.mark.parametrize('output_format', ['npy', 'store'])
+def test_appending_dates_reads_only_new_rasters(tmp_path, sources, output_format):
+    raster_list = [sources.write(dd) for dd in range(3)]
+    rga = accumulate(tmp_path, raster_list, output_format)
+    check_outputs(rga, sources.stack(raster_list))
+    assert sorted(set(sources.read_paths)) == raster_list
+
+    sources.read_paths.clear()
+    raster_list += [sources.write(dd) for dd in range(3, 6)]
+    rga = accumulate(tmp_path, raster_list, output_format)
+    assert sorted(set(sources.read_paths)) == raster_list[3:]
+    check_outputs(rga, sources.stack(raster_list))
+
+    # nothing changed, nothing read
+    sources.read_paths.clear()
+    rga = accumulate(tmp_path, raster_list, output_format)
+    assert sources.read_paths == []
+    check_outputs(rga, sources.stack(raster_list))
+
+
+@pytest.mark.parametrize('output_format', ['npy', 'store'])
+def test_changed_source_is_reread(tmp_path, sources, output_format):
+    raster_list = [sources.write(dd) for dd in range(4)]
+    accumulate(tmp_path, raster_list, output_format)
+
+    # date 1 reprocessed: new content of another size
+    sources.write(1)
+    with open(raster_list[1], 'ab') as f:
+        f.write(b'reprocessed')
+    rga = RasterGroupAccumulate(raster_list, str(tmp_path / 'raster'), PATCH_SIZE, group_size=2,
+                                output_format=output_format, incremental=True)
+    rga.prepare_data()
+    rga.generate_grid_code()
+    assert rga._dirty_sources() == [1]
+
+    sources.read_paths.clear()
+    rga.accumulate_grid_raster()
+    assert sorted(set(sources.read_paths)) == [raster_list[1]]
+    check_outputs(rga, sources.stack(raster_list))
+
+
+def test_layout_changes_rebuild_all(tmp_path, sources):
+    raster_list = [sources.write(dd) for dd in range(3)]
+    accumulate(tmp_path, raster_list, 'npy')
+
+    def dirty_sources(raster_list, **kwargs):
+        rga = RasterGroupAccumulate(raster_list, str(tmp_path / 'raster'), kwargs.get('patch_size', PATCH_SIZE),
+                                    group_size=2, output_format=kwargs.get('output_format', 'npy'), incremental=True)
+        rga.prepare_data()
+        rga.generate_grid_code()
+        return rga._dirty_sources()
+
+    assert dirty_sources(raster_list) == []
+    assert dirty_sources(raster_list, patch_size=8) is None
+    assert dirty_sources(raster_list, output_format='store') is None
+    assert dirty_sources(raster_list[:2]) is None
+
+    # same position, another band count
+    sources.write(2, bands=DATE_BANDS + 1)
+    assert dirty_sources(raster_list) is None
+    rga = accumulate(tmp_path, raster_list, 'npy')
+    check_outputs(rga, sources.stack(raster_list))
+
+
+def test_cache_is_not_trusted_after_a_full_build(tmp_path, sources):
+    raster_list = [sources.write(dd) for dd in range(3)]
+    rga = accumulate(tmp_path, raster_list, 'store')
+    assert os.path.exists(rga.cache_path)
+
+    accumulate(tmp_path, raster_list, 'store', incremental=False)
+    assert not os.path.exists(rga.cache_path)